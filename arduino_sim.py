@@ -0,0 +1,449 @@
+"""
+Simulated Carwash Arduino (pseudo-terminal)
+===========================================
+Speaks the vendo serial protocol over a pty so the real receive path
+(SerialLink -> VendingEngine.process_serial_message -> lane timers) can be soak-tested
+without hardware.
+
+    python arduino_sim.py --link /tmp/ttyCARWASH --duration 3600 &
+    CARWASH_SERIAL_PORT=/tmp/ttyCARWASH python main.py
+
+Protocol
+--------
+  App -> Arduino : RELAY_ON:<L|R>, RELAY_OFF:<L|R>, ENABLE_COIN:<L|R>,
+                   DISABLE_COIN:<L|R>, BEEP_ON, BEEP_OFF
+  Arduino -> App : ACK:<command>, COIN:<value>:<acceptor>:<seq>
+
+Scripted mode (--script FILE) replays lines of `<delay_s> <ACTION>` where
+ACTION is a raw frame (e.g. `COIN:5:L`), `DISCONNECT` or `GARBAGE`.
+Without a script, coins, garbage and disconnects are randomised at the
+configured rates.
+
+Relay timing is checked against the credit the simulator inserted: a lane's
+relay must not switch on without credit and must switch off no later than
+its paid seconds (+ tolerance). Paid seconds are priced like the app prices
+them — PricingEngine over the settings in the app's local store (pricing
+rules, bonuses and remote config included), re-read every SETTINGS_REFRESH
+seconds. Any violation makes the process exit 1.
+
+Coin stress mode (--coin-stress N) runs a VendingEngine in the same process
+against the pty and sends N coins alternating between the L and R
+acceptors, back to back: sequenced frames, some of them retransmitted, and
+legacy frames without a sequence number. Every coin must be credited to its
+own lane exactly once.
+
+    python arduino_sim.py --coin-stress 2000 --link /tmp/ttyCARWASH-stress
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import select
+import sys
+import time
+import tty
+
+from local_store import read_settings
+from vending_engine import PricingEngine
+
+STORE_FILE = "json_data/carwash.db"
+SETTINGS_FILE = "json_data/carwash_settings.json"  # JSON mirror, used only when there is no store
+SETTINGS_REFRESH = 5.0                              # seconds between re-reads of the app's settings
+DEFAULT_SETTINGS = {"water_timer": 60, "foaming_timer": 60, "pricing_rules": []}
+LANES = ("L", "R")
+COIN_VALUES = (5, 10, 20)
+
+log = logging.getLogger("arduino_sim")
+
+
+def load_settings(store=STORE_FILE, mirror=SETTINGS_FILE):
+    """The app's effective settings: its local store, else the JSON mirror of a checkout that never ran."""
+    data = read_settings(store)
+    if not data:
+        try:
+            with open(mirror, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+    return dict(DEFAULT_SETTINGS, **data)
+
+
+class LaneModel:
+    """What the simulated board knows about one lane."""
+
+    def __init__(self):
+        self.coin_enabled = False
+        self.relay_on = False
+        self.paid_seconds = 0        # credit inserted since the last RELAY_OFF
+        self.run_started = None      # monotonic time of the first RELAY_ON of a session
+        self.last_cmd_at = None
+
+
+class SimulatedArduino:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.settings = load_settings(args.store, args.settings)
+        self.pricing = PricingEngine(self.settings)
+        self.settings_read_at = time.monotonic()
+        self.lanes = {k: LaneModel() for k in LANES}
+        self.master = None
+        self.slave = None
+        self.rx_buffer = b""
+        self.seq = 0
+        self.violations = []
+        self.stats = {
+            "coins": 0, "acks": 0, "acks_dropped": 0, "garbage": 0,
+            "disconnects": 0, "commands": 0, "relay_sessions": 0,
+        }
+        self.script = self._load_script(args.script) if args.script else None
+
+    # --------------------------
+    # pty lifecycle
+    # --------------------------
+    def open_port(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if self.args.link:
+            try:
+                os.unlink(self.args.link)
+            except FileNotFoundError:
+                pass
+            os.symlink(path, self.args.link)
+        log.info(f"Serial port ready: {path}" + (f" -> {self.args.link}" if self.args.link else ""))
+
+    def close_port(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = self.slave = None
+        self.rx_buffer = b""
+
+    def disconnect(self):
+        """Drop the link like a USB unplug; the board resets and all relays fall off."""
+        self.stats["disconnects"] += 1
+        log.info("DISCONNECT")
+        self.close_port()
+        for lane in self.lanes.values():
+            lane.relay_on = False
+            lane.coin_enabled = False
+        time.sleep(self.args.down_time)
+        self.open_port()
+
+    # --------------------------
+    # TX
+    # --------------------------
+    def send(self, frame):
+        if self.master is None:
+            return
+        data = frame if isinstance(frame, bytes) else (frame + "\n").encode()
+        try:
+            os.write(self.master, data)
+        except OSError as e:
+            log.warning(f"TX failed: {e}")
+
+    def refresh_pricing(self):
+        """Pick up price changes the app has committed (local edits, remote config)."""
+        self.settings_read_at = time.monotonic()
+        settings = load_settings(self.args.store, self.args.settings)
+        if settings != self.settings:
+            self.settings = settings
+            self.pricing = PricingEngine(settings)
+            log.info("Settings changed — pricing reloaded")
+
+    def send_coin(self, lane_key, value, sequenced=True):
+        """Insert one coin; returns the frame sent (legacy firmware frames carry no sequence number)."""
+        lane = self.lanes[lane_key]
+        lane.paid_seconds += self.pricing.seconds_for(lane_key, value)
+        self.stats["coins"] += 1
+        if sequenced:
+            self.seq += 1
+            frame = f"COIN:{value}:{lane_key}:{self.seq}"
+        else:
+            frame = f"COIN:{value}:{lane_key}"
+        self.send(frame)
+        return frame
+
+    def send_garbage(self):
+        self.stats["garbage"] += 1
+        junk = bytes(self.rng.randrange(256) for _ in range(self.rng.randint(1, 24)))
+        self.send(junk + b"\n")
+
+    # --------------------------
+    # RX
+    # --------------------------
+    def read_commands(self, timeout):
+        if self.master is None:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return
+        try:
+            chunk = os.read(self.master, 1024)
+        except OSError:
+            return
+        self.rx_buffer += chunk
+        while b"\n" in self.rx_buffer:
+            line, self.rx_buffer = self.rx_buffer.split(b"\n", 1)
+            cmd = line.decode(errors="ignore").strip()
+            if cmd:
+                self.handle_command(cmd)
+
+    def handle_command(self, cmd):
+        self.stats["commands"] += 1
+        name, _, lane_key = cmd.partition(":")
+        lane = self.lanes.get(lane_key)
+        now = time.monotonic()
+
+        if name == "RELAY_ON" and lane:
+            if not lane.relay_on:
+                if lane.paid_seconds <= 0:
+                    self.violation(f"RELAY_ON:{lane_key} with no credit inserted")
+                if lane.run_started is None:
+                    lane.run_started = now
+                    self.stats["relay_sessions"] += 1
+            lane.relay_on = True
+        elif name == "RELAY_OFF" and lane:
+            if lane.run_started is not None:
+                self.check_overrun(lane_key, now, final=True)
+            lane.relay_on = False
+            lane.run_started = None
+            lane.paid_seconds = 0
+        elif name == "ENABLE_COIN" and lane:
+            lane.coin_enabled = True
+        elif name == "DISABLE_COIN" and lane:
+            lane.coin_enabled = False
+        elif name not in ("BEEP_ON", "BEEP_OFF"):
+            log.warning(f"Unknown command: {cmd}")
+            return
+
+        if lane:
+            lane.last_cmd_at = now
+        if self.rng.random() < self.args.ack_drop:
+            self.stats["acks_dropped"] += 1
+            return
+        self.stats["acks"] += 1
+        self.send(f"ACK:{cmd}")
+
+    # --------------------------
+    # Assertions
+    # --------------------------
+    def violation(self, text):
+        log.error(f"VIOLATION: {text}")
+        self.violations.append(text)
+
+    def check_overrun(self, lane_key, now, final=False):
+        lane = self.lanes[lane_key]
+        if lane.run_started is None:
+            return
+        elapsed = now - lane.run_started
+        allowed = lane.paid_seconds + self.args.tolerance
+        if elapsed > allowed:
+            self.violation(
+                f"Lane {lane_key} relay ran {elapsed:.1f}s for {lane.paid_seconds}s of credit"
+            )
+            lane.run_started = None  # report each session once
+        elif final:
+            log.info(f"Lane {lane_key} session OK: {elapsed:.1f}s of {lane.paid_seconds}s paid")
+
+    # --------------------------
+    # Traffic generation
+    # --------------------------
+    @staticmethod
+    def _load_script(path):
+        steps = []
+        with open(path, "r") as f:
+            for raw in f:
+                line = raw.strip()
+                if not line or line.startswith("#"):
+                    continue
+                delay, action = line.split(None, 1)
+                steps.append((float(delay), action.strip()))
+        return steps
+
+    def run_script_step(self, action):
+        if action == "DISCONNECT":
+            self.disconnect()
+        elif action == "GARBAGE":
+            self.send_garbage()
+        else:
+            self.send(action)
+            if action.startswith("COIN:"):
+                parts = action.split(":")
+                lane_key = parts[2] if len(parts) > 2 else "L"
+                if lane_key in self.lanes:
+                    self.lanes[lane_key].paid_seconds += self.pricing.seconds_for(lane_key, int(parts[1]))
+                self.stats["coins"] += 1
+
+    def random_traffic(self, dt):
+        a = self.args
+        for lane_key, lane in self.lanes.items():
+            if (lane.coin_enabled or a.ignore_enable) and self.rng.random() < a.coin_rate / 60.0 * dt:
+                for _ in range(self.rng.randint(1, a.burst)):
+                    self.send_coin(lane_key, self.rng.choice(COIN_VALUES))
+        if self.rng.random() < a.garbage_rate / 60.0 * dt:
+            self.send_garbage()
+        if a.disconnect_every and self.rng.random() < dt / a.disconnect_every:
+            self.disconnect()
+
+    # --------------------------
+    # Main loop
+    # --------------------------
+    def run(self):
+        self.open_port()
+        start = last = time.monotonic()
+        script_at = start
+        step = 0
+
+        try:
+            while time.monotonic() - start < self.args.duration:
+                self.read_commands(0.05)
+                now = time.monotonic()
+                if now - self.settings_read_at >= SETTINGS_REFRESH:
+                    self.refresh_pricing()
+
+                if self.script is not None:
+                    while step < len(self.script) and now >= script_at + self.script[step][0]:
+                        script_at += self.script[step][0]
+                        self.run_script_step(self.script[step][1])
+                        step += 1
+                else:
+                    self.random_traffic(now - last)
+
+                for lane_key in LANES:
+                    self.check_overrun(lane_key, now)
+                last = now
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close_port()
+            if self.args.link:
+                try:
+                    os.unlink(self.args.link)
+                except OSError:
+                    pass
+
+        log.info(f"Summary: {json.dumps(self.stats)} violations={len(self.violations)}")
+        return 1 if self.violations else 0
+
+
+def run_coin_stress(args):
+    """
+    Interleaved L/R coins through the real receive path (SerialLink ->
+    process_serial_message -> LaneState). Returns 1 if any coin was lost,
+    double-counted or credited to the wrong lane.
+    """
+    from vending_engine import COIN_DEBOUNCE, CoinAccepted, ServiceCore, VendingEngine
+
+    sim = SimulatedArduino(args)
+    sim.open_port()
+    os.environ["CARWASH_SERIAL_PORT"] = args.link or os.ttyname(sim.slave)
+    logging.getLogger().setLevel(logging.WARNING)  # the engine logs every coin
+
+    core = ServiceCore()
+    core.start()
+    engine = VendingEngine(sim.settings, core=core)
+    credited = {k: [0, 0] for k in LANES}  # lane -> [coins, pesos] seen by the engine
+
+    def on_coin(ev):
+        credited[ev.lane_key][0] += 1
+        credited[ev.lane_key][1] += ev.value
+
+    engine.bus.subscribe(CoinAccepted, on_coin)
+    engine.start()
+    inserted = {k: [0, 0] for k in LANES}
+    try:
+        deadline = time.monotonic() + 5
+        while not engine.serial_link.connected and time.monotonic() < deadline:
+            sim.read_commands(0.05)
+        if not engine.serial_link.connected:
+            log.error("Engine never opened the simulated port")
+            return 1
+        for lane_key in LANES:
+            engine.set_coin_input(lane_key, True)
+
+        last_legacy = {k: 0.0 for k in LANES}
+        for i in range(args.coin_stress):
+            lane_key = LANES[i % 2]
+            value = sim.rng.choice(COIN_VALUES)
+            roll = sim.rng.random()
+            if roll < 0.1:
+                # Legacy frame: a real acceptor never takes two coins within the debounce window
+                wait = last_legacy[lane_key] + COIN_DEBOUNCE * 2 - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                sim.send_coin(lane_key, value, sequenced=False)
+                last_legacy[lane_key] = time.monotonic()
+            else:
+                frame = sim.send_coin(lane_key, value)
+                if roll < 0.2:
+                    sim.send(frame)  # retransmitted after a line glitch: must count once
+            inserted[lane_key][0] += 1
+            inserted[lane_key][1] += value
+            sim.read_commands(0)
+            if args.coin_gap:
+                time.sleep(args.coin_gap)
+
+        deadline = time.monotonic() + 5
+        while credited != inserted and time.monotonic() < deadline:
+            sim.read_commands(0.05)
+        sim.read_commands(0.5)  # late duplicates would land here
+    finally:
+        engine.stop()
+        core.stop()
+        sim.close_port()
+        if args.link:
+            try:
+                os.unlink(args.link)
+            except OSError:
+                pass
+
+    failed = False
+    for lane_key in LANES:
+        coins, pesos = credited[lane_key]
+        want_coins, want_pesos = inserted[lane_key]
+        lane = engine.lane(lane_key)
+        if (coins, pesos, lane.coins) != (want_coins, want_pesos, want_pesos):
+            failed = True
+            log.error(f"Lane {lane_key}: inserted {want_coins} coins / ₱{want_pesos}, engine credited "
+                      f"{coins} coins / ₱{pesos} (lane credit ₱{lane.coins})")
+        else:
+            log.warning(f"Lane {lane_key}: {coins} coins / ₱{pesos} credited exactly once")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Simulated carwash Arduino on a pseudo-terminal")
+    p.add_argument("--link", default="/tmp/ttyCARWASH", help="stable symlink to the current pty ('' to disable)")
+    p.add_argument("--duration", type=float, default=600, help="seconds to run")
+    p.add_argument("--script", help="scripted traffic file (`<delay_s> <ACTION>` per line)")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--store", default=STORE_FILE, help="the app's local store, read for prices")
+    p.add_argument("--settings", default=SETTINGS_FILE, help="settings JSON used when there is no store")
+    p.add_argument("--coin-rate", type=float, default=6, help="coin bursts per minute per enabled lane")
+    p.add_argument("--burst", type=int, default=3, help="max coins per burst")
+    p.add_argument("--ignore-enable", action="store_true", help="insert coins even when the acceptor is disabled")
+    p.add_argument("--garbage-rate", type=float, default=1, help="garbage frames per minute")
+    p.add_argument("--disconnect-every", type=float, default=0, help="mean seconds between disconnects (0 = never)")
+    p.add_argument("--down-time", type=float, default=2.0, help="seconds the link stays down per disconnect")
+    p.add_argument("--ack-drop", type=float, default=0.0, help="probability of not ACKing a command")
+    p.add_argument("--tolerance", type=float, default=3.0, help="allowed relay overrun in seconds")
+    p.add_argument("--coin-stress", type=int, metavar="COINS", help="run the engine against interleaved L/R coins")
+    p.add_argument("--coin-gap", type=float, default=0.0, help="seconds between stress coins")
+    args = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [SIM] %(message)s")
+    if args.coin_stress:
+        return run_coin_stress(args)
+    return SimulatedArduino(args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
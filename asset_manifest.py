@@ -0,0 +1,317 @@
+"""
+Carwash Asset Manifest
+======================
+Images and fonts used by the UI, built once and preloaded behind the splash.
+
+`python asset_manifest.py build` collects every image and font that
+carwash.kv and main.py reference, packs the small images (both sides up to
+ATLAS_MAX_SIDE) into power-of-two atlas pages under build/assets, and
+writes build/assets/manifest.json with each asset's bytes, pixel size and
+SHA-256. kv sources go through `asset()`: it returns the atlas:// url of a
+packed image while the atlas exists and the source still has the size it
+had at build time, and the plain file name otherwise, so an unbuilt
+checkout runs as before.
+
+At startup `AssetPreloader` decodes the atlas pages and the large images on
+the service executor while my_splash.jpg is shown, uploads each texture on
+the UI thread and keeps it cached; only then does the app set
+`assets_ready`, which gives the kv images their sources, so no screen or
+popup decodes a PNG on the UI thread. The decode and upload time of every
+asset is logged.
+
+    python asset_manifest.py build     # atlas + manifest (needs Pillow)
+    python asset_manifest.py verify    # which sources changed since the build
+    python asset_manifest.py report    # first-frame decode/upload time per asset (needs a GL context)
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+if __name__ == "__main__":
+    os.environ.setdefault("KIVY_NO_ARGS", "1")  # the CLI below owns sys.argv
+
+from kivy.cache import Cache
+from kivy.core.image import ImageLoader
+from kivy.resources import resource_find
+
+from vending_engine import safe_log
+from local_store import write_json_atomic
+
+ASSET_SOURCES = ("carwash.kv", "main.py")   # files scanned for image and font references
+SPLASH_IMAGE = "my_splash.jpg"
+BUILD_DIR = "build/assets"
+MANIFEST_FILE = os.path.join(BUILD_DIR, "manifest.json")
+ATLAS_NAME = "ui"                           # build/assets/ui.atlas, ui-0.png, ...
+ATLAS_PAGE = 1024                           # atlas page side (power of two)
+ATLAS_MAX_SIDE = 512                        # larger images stay separate files
+PINNED = float("inf")                       # Cache timeout for preloaded textures: never expire
+
+IMAGE_REF = re.compile(r"""["']([^"'\s]+\.(?:png|jpe?g))["']""", re.IGNORECASE)
+FONT_REF = re.compile(r"""font_name\s*[:=]\s*["']([^"']+)["']""")
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def referenced_assets(sources=ASSET_SOURCES):
+    """(images, fonts) referenced by the kv file and the app, in first-use order; commented lines are skipped."""
+    images, fonts = [SPLASH_IMAGE], []
+    for source in sources:
+        try:
+            with open(source, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            continue
+        for line in lines:
+            if line.lstrip().startswith("#"):
+                continue
+            for name in IMAGE_REF.findall(line):
+                if name not in images:
+                    images.append(name)
+            for name in FONT_REF.findall(line):
+                path = name if os.path.splitext(name)[1].lower() in (".ttf", ".otf") else name + ".ttf"
+                if path not in fonts:
+                    fonts.append(path)
+    return images, fonts
+
+
+# --------------------------
+# Runtime lookup
+# --------------------------
+_manifest = None
+_resolved = {}
+
+
+def load_manifest():
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST_FILE, "r") as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def asset(name, ready=True):
+    """
+    kv helper: where to load image `name` from — its atlas region once built,
+    else the file itself. Pass `app.assets_ready` as `ready`: until the
+    preloader has finished the source stays empty, so building the widget
+    tree decodes nothing on the UI thread.
+    """
+    if not ready:
+        return ""
+    url = _resolved.get(name)
+    if url is None:
+        url = name
+        manifest = load_manifest()
+        entry = manifest.get("images", {}).get(name)
+        if entry and entry.get("atlas") and os.path.exists(manifest.get("atlas") or ""):
+            try:
+                stale = os.path.getsize(name) != entry["bytes"]
+            except OSError:
+                stale = False  # source not shipped; the atlas still has it
+            if not stale:
+                url = entry["atlas"]
+        _resolved[name] = url
+    return url
+
+
+class AssetPreloader:
+    """
+    Decodes images on the service core's executor and uploads them on the
+    UI thread. Textures go into Kivy's texture cache under the same keys
+    Image widgets and canvas sources look up, pinned so they never expire;
+    the atlas is registered where atlas:// urls look for it.
+    """
+
+    def __init__(self, core):
+        self.core = core
+        self.timings = {}  # asset -> (bytes, decode ms, upload ms)
+        self.done = False
+
+    def items(self):
+        """(name, path) of every image file to decode: atlas pages, then unpacked images. Splash excluded."""
+        manifest = load_manifest()
+        images, _ = referenced_assets()
+        atlas_path = manifest.get("atlas")
+        items, packed = [], set()
+        if atlas_path and os.path.exists(atlas_path):
+            with open(atlas_path, "r") as f:
+                pages = json.load(f)
+            for page in pages:
+                items.append((page, os.path.join(os.path.dirname(atlas_path), page)))
+            packed = {n for n, e in manifest.get("images", {}).items() if asset(n) != n and e.get("atlas")}
+        for name in images:
+            if name != SPLASH_IMAGE and name not in packed:
+                items.append((name, name))
+        return [(name, resource_find(path)) for name, path in items if resource_find(path)]
+
+    def start(self, on_done=None):
+        def finished(decoded):
+            self.upload(decoded)
+            if on_done is not None:
+                on_done()
+
+        self.core.submit(self.decode_all, on_done=finished)
+
+    def decode_all(self):
+        """Worker thread: decode every image (no GL calls) and read the fonts into the page cache."""
+        decoded = []
+        for name, path in self.items():
+            t0 = time.perf_counter()
+            try:
+                image = ImageLoader.load(path)
+            except Exception as e:
+                safe_log("warning",f"Preload of {name} failed: {e}")
+                continue
+            decoded.append((name, path, image, (time.perf_counter() - t0) * 1000))
+        _, fonts = referenced_assets()
+        for font in fonts:
+            t0 = time.perf_counter()
+            try:
+                with open(font, "rb") as f:
+                    size = len(f.read())
+            except OSError:
+                continue
+            self.timings[font] = (size, (time.perf_counter() - t0) * 1000, 0.0)
+        return decoded
+
+    def upload(self, decoded):
+        """UI thread: create the textures, pin them, register the atlas and log the timings."""
+        for name, path, image, decode_ms in decoded:
+            t0 = time.perf_counter()
+            texture = image.texture
+            Cache.append("kv.texture", f"{path}|0|0", texture, timeout=PINNED)
+            self.timings[name] = (os.path.getsize(path), decode_ms, (time.perf_counter() - t0) * 1000)
+
+        atlas_path = load_manifest().get("atlas")
+        if atlas_path and resource_find(atlas_path):
+            from kivy.atlas import Atlas
+
+            Cache.append("kv.atlas", os.path.splitext(atlas_path)[0], Atlas(resource_find(atlas_path)))
+
+        self.done = True
+        total = sum(d + u for _, d, u in self.timings.values())
+        safe_log("info",f"🖼️ Preloaded {len(self.timings)} assets in {total:.0f} ms "
+                        f"(decode off the UI thread, upload on it)")
+        for name, (size, decode_ms, upload_ms) in self.timings.items():
+            safe_log("debug",f"   {name:<40} {size / 1024:8.0f} KB  decode {decode_ms:6.1f} ms  "
+                             f"upload {upload_ms:6.1f} ms")
+
+
+# --------------------------
+# Build
+# --------------------------
+def build(out_dir=BUILD_DIR):
+    """Pack small images into the atlas and write the manifest. Returns the manifest."""
+    try:
+        from PIL import Image as PILImage
+    except ImportError:
+        raise SystemExit("The asset build needs Pillow (pip install pillow)")
+    from kivy.atlas import Atlas
+
+    os.makedirs(out_dir, exist_ok=True)
+    images, fonts = referenced_assets()
+    manifest = {"version": 1, "built_at": time.time(), "atlas": None, "images": {}, "fonts": {}, "missing": []}
+
+    to_pack, stems = [], set()
+    for name in images:
+        if not os.path.exists(name):
+            manifest["missing"].append(name)
+            continue
+        with PILImage.open(name) as im:
+            width, height = im.size
+        manifest["images"][name] = {"bytes": os.path.getsize(name), "sha256": sha256_file(name),
+                                    "size": [width, height], "atlas": None}
+        stem = os.path.splitext(os.path.basename(name))[0]
+        if name != SPLASH_IMAGE and max(width, height) <= ATLAS_MAX_SIDE and stem not in stems:
+            stems.add(stem)
+            to_pack.append(name)
+
+    for name in fonts:
+        if not os.path.exists(name):
+            manifest["missing"].append(name)
+            continue
+        manifest["fonts"][name] = {"bytes": os.path.getsize(name), "sha256": sha256_file(name)}
+
+    outname = os.path.join(out_dir, ATLAS_NAME)
+    for old in os.listdir(out_dir):
+        if old.startswith(ATLAS_NAME + "-") or old == ATLAS_NAME + ".atlas":
+            os.remove(os.path.join(out_dir, old))
+    if to_pack and Atlas.create(outname, to_pack, ATLAS_PAGE, padding=2):
+        manifest["atlas"] = outname + ".atlas"
+        for name in to_pack:
+            stem = os.path.splitext(os.path.basename(name))[0]
+            manifest["images"][name]["atlas"] = f"atlas://{outname}/{stem}"
+
+    write_json_atomic(os.path.join(out_dir, "manifest.json"), manifest)
+    return manifest
+
+
+def verify():
+    """Names of assets whose source differs from the build (or vanished). Empty list = up to date."""
+    manifest = load_manifest()
+    changed = []
+    for kind in ("images", "fonts"):
+        for name, entry in manifest.get(kind, {}).items():
+            try:
+                if os.path.getsize(name) != entry["bytes"] or sha256_file(name) != entry["sha256"]:
+                    changed.append(name)
+            except OSError:
+                changed.append(name)
+    images, fonts = referenced_assets()
+    known = set(manifest.get("images", {})) | set(manifest.get("fonts", {})) | set(manifest.get("missing", []))
+    changed += [name for name in images + fonts if name not in known and os.path.exists(name)]
+    return changed
+
+
+def report():
+    """Cold first-frame cost per asset: decode and texture upload, bypassing Kivy's caches."""
+    from kivy.base import EventLoop
+
+    EventLoop.ensure_window()
+    print(f"{'asset':<40} {'KB':>8} {'pixels':>11} {'decode ms':>10} {'upload ms':>10}")
+    images = referenced_assets()[0]
+    rows = [(name, resource_find(name)) for name in images]
+    rows += [(f"[atlas] {name}", path) for name, path in AssetPreloader(None).items() if name not in images]
+    for name, path in rows:
+        if not path:
+            print(f"{name:<40} {'missing':>8}")
+            continue
+        t0 = time.perf_counter()
+        image = ImageLoader.load(path, nocache=True)
+        t1 = time.perf_counter()
+        texture = image.texture
+        t2 = time.perf_counter()
+        print(f"{name:<40} {os.path.getsize(path) / 1024:8.0f} {texture.width:>5}x{texture.height:<5} "
+              f"{(t1 - t0) * 1000:10.1f} {(t2 - t1) * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Asset manifest, atlas build and preload report for the carwash UI")
+    parser.add_argument("command", choices=("build", "verify", "report"))
+    args = parser.parse_args()
+
+    if args.command == "build":
+        result = build()
+        packed = [n for n, e in result["images"].items() if e["atlas"]]
+        print(f"{len(result['images'])} images ({len(packed)} packed into {result['atlas']}), "
+              f"{len(result['fonts'])} fonts, {len(result['missing'])} missing: {', '.join(result['missing'])}")
+    elif args.command == "verify":
+        changed = verify()
+        for name in changed:
+            print(f"changed since build: {name}")
+        raise SystemExit(1 if changed else 0)
+    else:
+        report()
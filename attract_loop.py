@@ -0,0 +1,383 @@
+"""
+Carwash Attract Loop
+====================
+Promo clips for the idle video screen. The playlist is a Firestore document
+(`fleets/{FLEET_ID}/config/attract` for every bay, overridden by
+`machines/{MACHINE_ID}/config/attract` when that one lists clips):
+
+    {"version": 4, "clips": [
+        {"name": "october-promo.mp4", "sha256": "<hex>", "size": 18734512,
+         "url": "https://firebasestorage.googleapis.com/..."},     # or
+        {"name": "wax.mp4", "sha256": "<hex>", "size": 9120331, "path": "attract/wax.mp4"}]}
+
+`MediaLibrary` keeps the clips in a local cache named by their SHA-256. A
+document is applied when its scope (fleet or machine) or its clip list
+differs from the one last applied; `version` only orders documents of the
+same scope and may be left out. A new clip is downloaded to a temporary
+file and only enters the playlist once its size and hash match. Clips that
+would push the playlist past the quota are skipped, and clips no longer
+listed are deleted before a download would take the cache past it. The playable
+playlist is saved as `playlist.json`, so the bay keeps rotating the same
+promos offline. With nothing cached it plays the bundled intro once, as
+before.
+
+The first frame of each clip is decoded once into a PNG poster (needs
+ffpyplayer) and kept as a texture, so the screen never shows black while a
+clip opens.
+
+    python attract_loop.py status                # playlist, cache use, posters
+    python attract_loop.py verify                # re-hash every cached clip
+    python attract_loop.py sync playlist.json    # apply a playlist document from a file
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.parse
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    from ffpyplayer.player import MediaPlayer
+    from ffpyplayer.writer import MediaWriter
+except ImportError:
+    MediaPlayer = None
+
+from local_store import write_json_atomic
+from vending_engine import safe_log
+
+ATTRACT_DIR = "media/attract"
+ATTRACT_QUOTA = 1024 * 1024 * 1024  # bytes of promo clips kept on the SD card
+FALLBACK_CLIP = "intro_video.mp4"   # bundled clip, played once when nothing is cached
+DOWNLOAD_CHUNK = 1 << 20
+WARM_HEAD = 4 << 20                 # bytes read at once when warming a clip (container header, first seconds)
+POSTER_TIMEOUT = 5.0                # seconds to wait for a clip's first decoded frame
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def warm_file(path, head=WARM_HEAD):
+    """Pull a clip into the page cache before it plays: read its head now, ask the kernel for the rest."""
+    try:
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            f.read(head)
+        return True
+    except OSError:
+        return False
+
+
+def fetch(clip, dest, bucket=None):
+    """Download one clip to `dest`: `url` over HTTP(S) (or a local file), `path` from the Storage bucket."""
+    url = clip.get("url")
+    if url:
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme in ("http", "https"):
+            if requests is None:
+                raise RuntimeError("HTTP downloads need requests (pip install requests)")
+            with requests.get(url, stream=True, timeout=(10, 60)) as r:
+                r.raise_for_status()
+                with open(dest, "wb") as f:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+        else:
+            shutil.copyfile(parsed.path if parsed.scheme == "file" else url, dest)
+        return
+    if clip.get("path") and bucket is not None:
+        bucket.blob(clip["path"]).download_to_filename(dest)
+        return
+    raise ValueError(f"clip {clip.get('name')} has neither a url nor a Storage path")
+
+
+class MediaLibrary:
+    """
+    Local promo cache and playlist rotation. `sync()` and `verify()` run on
+    a worker thread; the UI thread only calls `next_clip()`, `peek()` and
+    `poster_texture()`, which read the last fully verified playlist.
+    """
+
+    def __init__(self, root=ATTRACT_DIR, quota=ATTRACT_QUOTA, fallback=FALLBACK_CLIP):
+        self.root = root
+        self.quota = quota
+        self.fallback = fallback
+        self.manifest_path = os.path.join(root, "playlist.json")
+        self.scope = None  # document the playlist came from ("fleet" / "machine")
+        self.version = 0
+        self.digest = None  # SHA-256 of that document's clip list
+        self.complete = True
+        self.clips = []    # [{"name", "sha256", "size"}] — cached and verified, in play order
+        self.position = 0  # rotation carries on across visits to the video screen
+        self._textures = {}
+        self.load()
+
+    def _manifest(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self):
+        data = self._manifest()
+        self.scope = data.get("scope")
+        self.version = int(data.get("version", 0))
+        self.digest = data.get("digest")
+        self.complete = bool(data.get("complete", True))
+        self.clips = [c for c in data.get("clips") or () if self._present(c)]
+
+    # --------------------------
+    # Playlist (UI thread)
+    # --------------------------
+    def file_path(self, clip):
+        ext = os.path.splitext(clip.get("name", ""))[1].lower() or ".mp4"
+        return os.path.join(self.root, f"{clip['sha256']}{ext}")
+
+    def poster_path(self, clip_path):
+        return os.path.join(self.root, os.path.splitext(os.path.basename(clip_path))[0] + ".png")
+
+    @property
+    def looping(self):
+        """True once promos are cached; the bundled intro alone plays once and returns."""
+        return bool(self.clips)
+
+    def playlist(self):
+        return [self.file_path(c) for c in self.clips] or [self.fallback]
+
+    def peek(self):
+        clips = self.playlist()
+        return clips[self.position % len(clips)]
+
+    def next_clip(self):
+        clips = self.playlist()
+        clip = clips[self.position % len(clips)]
+        self.position = (self.position + 1) % len(clips)
+        return clip
+
+    def poster_texture(self, clip_path):
+        """Decoded poster for a clip, loaded once and kept while the clip is in the playlist."""
+        texture = self._textures.get(clip_path)
+        if texture is None:
+            poster = self.poster_path(clip_path)
+            if not os.path.exists(poster):
+                return None
+            from kivy.core.image import Image as CoreImage
+
+            playing = set(self.playlist())
+            self._textures = {p: t for p, t in self._textures.items() if p in playing}
+            texture = self._textures[clip_path] = CoreImage(poster).texture
+        return texture
+
+    # --------------------------
+    # Cache (worker thread)
+    # --------------------------
+    def _present(self, clip):
+        try:
+            return os.path.getsize(self.file_path(clip)) == int(clip["size"])
+        except (OSError, KeyError, TypeError, ValueError):
+            return False
+
+    def _save(self, complete, clips):
+        write_json_atomic(self.manifest_path, {"scope": self.scope, "version": self.version, "digest": self.digest,
+                                               "complete": complete, "clips": clips, "synced_at": time.time()})
+        self.complete, self.clips = complete, clips
+
+    def sync(self, document, bucket=None, scope="fleet"):
+        """Apply a playlist document: fetch and verify missing clips, then switch playlists. Returns clips downloaded."""
+        try:
+            version = int(document.get("version") or 0)
+        except (TypeError, ValueError):
+            version = 0
+        digest = hashlib.sha256(json.dumps(document.get("clips") or [], sort_keys=True, default=str)
+                                .encode()).hexdigest()
+        if scope == self.scope:
+            if version < self.version:
+                return 0  # older copy of the document already applied
+            if digest == self.digest and self.complete:
+                return 0
+        os.makedirs(self.root, exist_ok=True)
+
+        wanted, used = [], 0
+        for clip in document.get("clips") or ():
+            try:
+                entry = {"name": str(clip.get("name") or clip["sha256"]),
+                         "sha256": str(clip["sha256"]).lower(), "size": int(clip["size"])}
+            except (KeyError, TypeError, ValueError, AttributeError):
+                safe_log("warning", f"Attract clip malformed — skipped: {clip}")
+                continue
+            if used + entry["size"] > self.quota:
+                safe_log("warning", f"Attract clip {entry['name']} skipped — cache quota "
+                                    f"{self.quota // (1 << 20)} MB reached")
+                continue
+            used += entry["size"]
+            wanted.append((entry, clip))
+
+        listed = [self.file_path(entry) for entry, _ in wanted]
+        self.evict(listed)  # leftovers and partial downloads; the playing clips stay for now
+        ready, downloaded = [], 0
+        for entry, clip in wanted:
+            if self._present(entry):
+                ready.append(entry)
+            elif self._make_room(entry["size"], listed) and self._download(entry, clip, bucket):
+                ready.append(entry)
+                downloaded += 1
+
+        self.scope, self.version, self.digest = scope, version, digest
+        self._save(len(ready) == len(wanted), ready)
+        self.evict()
+        for path in self.playlist():
+            self.make_poster(path)
+        safe_log("info", f"🎞️ Attract playlist ({scope} v{version}): {len(ready)}/{len(wanted)} clips ready "
+                         f"({used // (1 << 20)} MB), {downloaded} downloaded")
+        return downloaded
+
+    def _make_room(self, size, listed):
+        """
+        Keep the cache within the quota for a download of `size` bytes: clips
+        of the playing playlist that the new one drops leave the rotation and
+        the card first. False if it still does not fit.
+        """
+        if self.usage() + size <= self.quota:
+            return True
+        kept = [c for c in self.clips if self.file_path(c) in listed]
+        if kept != self.clips:
+            self._save(False, kept)
+            self.evict(listed)
+        if self.usage() + size <= self.quota:
+            return True
+        safe_log("warning", f"Attract clip of {size // (1 << 20)} MB not downloaded — cache quota "
+                            f"{self.quota // (1 << 20)} MB reached")
+        return False
+
+    def _download(self, entry, clip, bucket):
+        final = self.file_path(entry)
+        partial = final + ".part"
+        try:
+            fetch(clip, partial, bucket)
+            size = os.path.getsize(partial)
+            digest = sha256_file(partial)
+            if size != entry["size"] or digest != entry["sha256"]:
+                safe_log("error", f"❌ Attract clip {entry['name']} failed verification "
+                                  f"(size {size}, sha256 {digest[:12]}…) — discarded")
+                os.remove(partial)
+                return False
+            os.replace(partial, final)
+            return True
+        except Exception as e:
+            safe_log("warning", f"Attract clip {entry['name']} not downloaded: {e}")
+            try:
+                os.remove(partial)
+            except OSError:
+                pass
+            return False
+
+    def evict(self, also_keep=()):
+        """Delete cached files (clips, posters, partial downloads) neither the playlist nor `also_keep` uses."""
+        keep = {os.path.basename(self.manifest_path)}
+        for path in list(self.playlist()) + list(also_keep):
+            keep.add(os.path.basename(path))
+            keep.add(os.path.basename(self.poster_path(path)))
+        try:
+            names = os.listdir(self.root)
+        except OSError:
+            return
+        for name in names:
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+
+    def verify(self):
+        """Re-hash every cached clip and drop the ones that no longer match. Returns (ok, bad)."""
+        good, bad = [], 0
+        for clip in self._manifest().get("clips") or ():
+            try:
+                ok = sha256_file(self.file_path(clip)) == clip["sha256"]
+            except OSError:
+                ok = False
+            if ok:
+                good.append(clip)
+            else:
+                bad += 1
+                safe_log("error", f"❌ Cached attract clip {clip['name']} is corrupt — removed")
+        if bad:
+            self._save(False, good)
+            self.evict()
+        return len(good), bad
+
+    def make_poster(self, clip_path):
+        """Decode a clip's first frame into its PNG poster (once). Returns the poster path or None."""
+        poster = self.poster_path(clip_path)
+        if os.path.exists(poster):
+            return poster
+        if MediaPlayer is None or not os.path.exists(clip_path):
+            return None
+        player = MediaPlayer(clip_path, ff_opts={"an": True, "out_fmt": "rgb24"})
+        try:
+            deadline = time.monotonic() + POSTER_TIMEOUT
+            while time.monotonic() < deadline:
+                frame, val = player.get_frame()
+                if val == "eof":
+                    break
+                if frame is None:
+                    time.sleep(0.01)
+                    continue
+                image, _ = frame
+                width, height = image.get_size()
+                os.makedirs(self.root, exist_ok=True)
+                writer = MediaWriter(poster, [{"pix_fmt_in": "rgb24", "width_in": width, "height_in": height,
+                                               "codec": "png", "frame_rate": (1, 1)}])
+                writer.write_frame(img=image, pts=0, stream=0)
+                writer.close()
+                return poster
+        except Exception as e:
+            safe_log("warning", f"Poster for {clip_path} not made: {e}")
+        finally:
+            player.close_player()
+        return None
+
+    def usage(self):
+        total = 0
+        for name in os.listdir(self.root) if os.path.isdir(self.root) else ():
+            total += os.path.getsize(os.path.join(self.root, name))
+        return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Promo playlist cache for the carwash attract loop")
+    parser.add_argument("command", choices=("status", "verify", "sync"))
+    parser.add_argument("document", nargs="?", help="playlist JSON for sync (clip urls may be local paths)")
+    parser.add_argument("--dir", default=ATTRACT_DIR, help="cache directory")
+    parser.add_argument("--quota-mb", type=int, default=ATTRACT_QUOTA >> 20)
+    parser.add_argument("--scope", choices=("fleet", "machine"), default="fleet", help="which document sync applies")
+    args = parser.parse_args()
+
+    library = MediaLibrary(args.dir, quota=args.quota_mb << 20)
+    if args.command == "sync":
+        if not args.document:
+            parser.error("sync needs a playlist JSON file")
+        with open(args.document, "r") as f:
+            library.sync(json.load(f), scope=args.scope)
+    elif args.command == "verify":
+        ok, bad = library.verify()
+        print(f"{ok} clips verified, {bad} corrupt")
+        raise SystemExit(1 if bad else 0)
+
+    print(f"playlist {library.scope or 'none'} v{library.version} ({'complete' if library.complete else 'incomplete'}), "
+          f"cache {library.usage() / (1 << 20):.1f} of {library.quota >> 20} MB")
+    for path in library.playlist():
+        poster = "poster" if os.path.exists(library.poster_path(path)) else "no poster"
+        print(f"  {path}  ({poster})")
@@ -0,0 +1,235 @@
+"""
+Carwash Digit Labels
+====================
+Timer ("MM:SS") and credit displays drawn from pre-rendered glyphs.
+
+A Kivy Label rasterises its whole texture with the TTF font every time its
+text changes, and animating `font_size` rasterises it again on every frame.
+`GlyphAtlas` renders 0-9, ':' and '-' once per (font, size, bold) into one
+texture; `DigitLabel` draws a value as one textured rectangle per character
+and only swaps texture regions when the value changes. Size animations go
+through a Scale instruction (`scale`), so they never touch the font.
+
+    python digit_label.py --bench 2000    # CPU time per timer update, Label vs DigitLabel
+"""
+
+import argparse
+import os
+import time
+
+if __name__ == "__main__":
+    os.environ.setdefault("KIVY_NO_ARGS", "1")  # the CLI below owns sys.argv
+
+from kivy.core.text import Label as CoreLabel
+from kivy.graphics import Color, InstructionGroup, PopMatrix, PushMatrix, Rectangle, Scale
+from kivy.properties import BooleanProperty, ColorProperty, NumericProperty, OptionProperty, StringProperty
+from kivy.uix.widget import Widget
+
+ATLAS_GLYPHS = "0123456789:-"
+
+
+class GlyphAtlas:
+    """
+    One texture holding every glyph in ATLAS_GLYPHS, plus a cache of static
+    strings (prefixes such as "Credit's: "). Shared by every label that uses
+    the same font, size and weight.
+    """
+
+    _atlases = {}
+
+    @classmethod
+    def get(cls, font_name, font_size, bold=False):
+        key = (font_name, int(font_size), bool(bold))
+        atlas = cls._atlases.get(key)
+        if atlas is None:
+            atlas = cls._atlases[key] = cls(*key)
+        return atlas
+
+    def __init__(self, font_name, font_size, bold=False):
+        self.options = {"font_name": font_name, "font_size": font_size, "bold": bold}
+        label = CoreLabel(text=ATLAS_GLYPHS, **self.options)
+        label.refresh()
+        self.texture = label.texture
+        self.height = self.texture.height
+        self.glyphs = {}  # char -> (texture region, width)
+        x = 0
+        for char in ATLAS_GLYPHS:
+            width = label.get_extents(char)[0]
+            self.glyphs[char] = (self.texture.get_region(x, 0, width, self.height), width)
+            x += width
+        self.rasterised = 1
+        self._static = {}
+
+    def static(self, text):
+        """Texture for fixed text, rendered the first time it is asked for."""
+        texture = self._static.get(text)
+        if texture is None:
+            label = CoreLabel(text=text, **self.options)
+            label.refresh()
+            texture = self._static[text] = label.texture
+            self.rasterised += 1
+        return texture
+
+
+class DigitLabel(Widget):
+    """
+    Drop-in for the timer and credit Labels: `text` holds the digits, ':' and
+    '-' (other characters are skipped), `prefix` is fixed text drawn before
+    them. `scale` enlarges the drawing around the centre without re-rendering.
+    """
+
+    text = StringProperty("")
+    prefix = StringProperty("")
+    font_name = StringProperty("Roboto")
+    font_size = NumericProperty("15sp")
+    bold = BooleanProperty(False)
+    color = ColorProperty([1, 1, 1, 1])
+    halign = OptionProperty("center", options=["left", "center", "right"])
+    valign = OptionProperty("middle", options=["bottom", "middle", "top"])
+    scale = NumericProperty(1.0)
+
+    def __init__(self, **kwargs):
+        self._atlas = None
+        self._rects = []
+        super().__init__(**kwargs)
+        with self.canvas:
+            self._color = Color(*self.color)
+            PushMatrix()
+            self._scale = Scale(1, 1, 1)
+            self._glyph_group = InstructionGroup()
+            PopMatrix()
+
+        for name in ("font_name", "font_size", "bold"):
+            self.fbind(name, self._load_atlas)
+        for name in ("text", "prefix", "pos", "size", "halign", "valign"):
+            self.fbind(name, self._layout)
+        self.fbind("color", self._update_color)
+        self.fbind("scale", self._update_scale)
+        self.fbind("center", self._update_scale)
+        self._load_atlas()
+        self._update_scale()
+
+    def _load_atlas(self, *args):
+        self._atlas = GlyphAtlas.get(self.font_name, self.font_size, self.bold)
+        self._layout()
+
+    def _update_color(self, *args):
+        self._color.rgba = self.color
+
+    def _update_scale(self, *args):
+        self._scale.origin = self.center
+        self._scale.xyz = (self.scale, self.scale, 1)
+
+    def _layout(self, *args):
+        atlas = self._atlas
+        if atlas is None:
+            return
+        parts = []
+        if self.prefix:
+            texture = atlas.static(self.prefix)
+            parts.append((texture, texture.width))
+        glyphs = atlas.glyphs
+        for char in self.text:
+            glyph = glyphs.get(char)
+            if glyph is not None:
+                parts.append(glyph)
+
+        width = sum(w for _, w in parts)
+        if self.halign == "left":
+            x = self.x
+        elif self.halign == "right":
+            x = self.right - width
+        else:
+            x = self.center_x - width / 2.0
+        if self.valign == "bottom":
+            y = int(self.y)
+        elif self.valign == "top":
+            y = int(self.top - atlas.height)
+        else:
+            y = int(self.center_y - atlas.height / 2.0)
+
+        rects = self._rects
+        while len(rects) < len(parts):
+            rect = Rectangle(size=(0, 0))
+            self._glyph_group.add(rect)
+            rects.append(rect)
+        for rect, (texture, w) in zip(rects, parts):
+            if rect.texture is not texture:
+                rect.texture = texture
+            rect.pos = (int(x), y)
+            rect.size = (w, texture.height)
+            x += w
+        for rect in rects[len(parts):]:
+            rect.size = (0, 0)
+
+
+# --------------------------
+# Benchmark
+# --------------------------
+def format_time(seconds):
+    m, s = divmod(int(seconds), 60)
+    return f"{m:02d}:{s:02d}"
+
+
+def run_benchmark(updates=2000, font_name="Roboto", font_size=40):
+    """
+    CPU time per timer update and per pulse-animation frame: Label (text /
+    font_size change + texture_update) against DigitLabel (text / scale
+    change). Needs a GL context; use SDL_VIDEODRIVER=offscreen without a display.
+    """
+    from kivy.base import EventLoop
+    from kivy.uix.label import Label
+
+    EventLoop.ensure_window()
+
+    label = Label(font_name=font_name, font_size=font_size, bold=True, size=(300, 80))
+    digits = DigitLabel(font_name=font_name, font_size=font_size, bold=True, size=(300, 80))
+    digits.text = "00:00"
+
+    def timed(fn):
+        cpu, wall = time.process_time(), time.perf_counter()
+        for i in range(updates):
+            fn(i)
+        return ((time.process_time() - cpu) / updates * 1e6, (time.perf_counter() - wall) / updates * 1e6)
+
+    def label_tick(i):
+        label.text = format_time(3600 - i)
+        label.texture_update()
+
+    def digits_tick(i):
+        digits.text = format_time(3600 - i)
+
+    def label_pulse(i):
+        label.font_size = font_size + (i % 10) * 0.5
+        label.texture_update()
+
+    def digits_pulse(i):
+        digits.scale = 1.0 + (i % 10) * 0.0125
+
+    results = {
+        "Label timer update": timed(label_tick),
+        "DigitLabel timer update": timed(digits_tick),
+        "Label font_size pulse frame": timed(label_pulse),
+        "DigitLabel scale pulse frame": timed(digits_pulse),
+    }
+    for name, (cpu, wall) in results.items():
+        print(f"{name:<30} {cpu:8.1f} µs CPU  {wall:8.1f} µs wall")
+    atlas = GlyphAtlas.get(font_name, font_size, True)
+    print(f"{updates} updates each; glyph atlas rasterised {atlas.rasterised} texture(s) "
+          f"({atlas.texture.width}x{atlas.texture.height})")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Digit-atlas labels for the carwash timers")
+    parser.add_argument("--bench", type=int, metavar="UPDATES", help="CPU time per update, Label vs DigitLabel")
+    parser.add_argument("--font", default="Roboto", help="font name or path")
+    parser.add_argument("--font-size", type=int, default=40)
+    parser.add_argument("--max-ratio", type=float, default=0.75,
+                        help="fail if DigitLabel costs more than this fraction of a Label update")
+    args = parser.parse_args()
+    if args.bench:
+        results = run_benchmark(args.bench, args.font, args.font_size)
+        ratio = results["DigitLabel timer update"][0] / max(results["Label timer update"][0], 1e-9)
+        raise SystemExit(0 if ratio <= args.max_ratio else 1)
+    parser.print_help()
@@ -0,0 +1,300 @@
+"""
+Carwash Fleet Report
+====================
+Revenue per bay, day and lane for every machine of an owner, read from
+Firestore (or the local emulator) or from a JSON Lines export made with
+`dump`. Machines are read in pages; each worker streams one machine's
+transactions and reduces them to that machine's output (report rows or a
+dump line) before taking the next machine, and a page is written before
+the next one is fetched, so memory stays bounded by one page of machine
+results however many months are covered.
+
+    python fleet_report.py report --owner OWNER_ID --out fleet.csv
+    python fleet_report.py report --emulator localhost:8080 --project demo-carwash --format parquet --out fleet.parquet
+    python fleet_report.py dump --owner OWNER_ID --out fleet.jsonl
+    python fleet_report.py report --export fleet.jsonl --since 2026-09-01 --out september.csv
+
+Transactions are the per-coin documents each machine uploads to
+`machines/{MACHINE_ID}/transactions` (`ts`, `lane`, `amount`, `seconds`).
+"""
+
+import argparse
+import calendar
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ACCOUNT_DATA = "serviceAccountKey.json"
+PAGE_SIZE = 300          # machines per Firestore page
+TRANSACTION_PAGE = 1000  # transactions per Firestore page
+WORKERS = 8              # machines whose transactions are fetched in parallel
+UTC_OFFSET_HOURS = 8     # days are cut at local midnight (Philippine time)
+COLUMNS = ("machine_id", "location", "day", "lane", "coins", "revenue", "seconds")
+
+log = logging.getLogger("fleet_report")
+
+
+# --------------------------
+# Sources
+# --------------------------
+def connect_firestore(args):
+    if args.emulator:
+        os.environ["FIRESTORE_EMULATOR_HOST"] = args.emulator
+        from google.cloud import firestore as gfirestore
+        return gfirestore.Client(project=args.project)
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(args.credentials))
+    return firestore.client()
+
+
+def paginate(query, page_size):
+    """Stream a query in pages with start_after (bounded reads per request)."""
+    last = None
+    while True:
+        page = query.limit(page_size)
+        if last is not None:
+            page = page.start_after(last)
+        docs = list(page.stream())
+        yield docs
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+class FirestoreSource:
+    def __init__(self, db, owner=None, since=None, until=None, page_size=PAGE_SIZE):
+        self.db = db
+        self.owner = owner
+        self.since = since
+        self.until = until
+        self.page_size = page_size
+
+    def machine_pages(self, process):
+        """
+        Pages of `process(machine_id, data, transactions)` results. The
+        machines of a page are handled in parallel; each worker streams its
+        machine's transactions straight into `process`.
+        """
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = self.db.collection("machines")
+        if self.owner:
+            query = query.where(filter=FieldFilter("ownerId", "==", self.owner))
+        query = query.order_by("__name__")
+
+        with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+            for docs in paginate(query, self.page_size):
+                yield list(pool.map(lambda d: process(d.id, d.to_dict() or {}, self.transactions(d.id)), docs))
+
+    def transactions(self, machine_id):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        query = self.db.collection("machines").document(machine_id).collection("transactions")
+        if self.since is not None:
+            query = query.where(filter=FieldFilter("ts", ">=", self.since))
+        if self.until is not None:
+            query = query.where(filter=FieldFilter("ts", "<", self.until))
+        query = query.order_by("ts")
+        for docs in paginate(query, TRANSACTION_PAGE):
+            for d in docs:
+                yield d.to_dict() or {}
+
+
+class ExportSource:
+    """JSON Lines: one machine per line, `{"id", "data", "transactions": [...]}`."""
+
+    def __init__(self, path, owner=None, since=None, until=None, page_size=PAGE_SIZE):
+        self.path = path
+        self.owner = owner
+        self.since = since
+        self.until = until
+        self.page_size = page_size
+
+    def machine_pages(self, process):
+        page = []
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                data = record.get("data") or {}
+                if self.owner and data.get("ownerId") != self.owner:
+                    continue
+                transactions = [
+                    t for t in record.get("transactions") or ()
+                    if (self.since is None or t.get("ts", 0) >= self.since)
+                    and (self.until is None or t.get("ts", 0) < self.until)
+                ]
+                page.append(process(record["id"], data, transactions))
+                if len(page) >= self.page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
+
+
+# --------------------------
+# Aggregation
+# --------------------------
+def aggregate_machine(machine_id, data, transactions, utc_offset=UTC_OFFSET_HOURS):
+    """Report rows for one machine: one per (day, lane), sorted."""
+    offset = utc_offset * 3600
+    buckets = {}
+    count = 0
+    for t in transactions:
+        try:
+            ts = float(t["ts"])
+            amount = int(t.get("amount", 0))
+        except (KeyError, TypeError, ValueError):
+            continue
+        day = time.strftime("%Y-%m-%d", time.gmtime(ts + offset))
+        key = (day, t.get("lane", "?"))
+        row = buckets.get(key)
+        if row is None:
+            row = buckets[key] = [0, 0, 0]
+        row[0] += 1
+        row[1] += amount
+        row[2] += int(t.get("seconds", 0))
+        count += 1
+
+    location = data.get("location", "")
+    rows = [
+        (machine_id, location, day, lane, coins, revenue, seconds)
+        for (day, lane), (coins, revenue, seconds) in sorted(buckets.items())
+    ]
+    return rows, count
+
+
+# --------------------------
+# Writers
+# --------------------------
+class CsvReport:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="") if path != "-" else sys.stdout
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetReport:
+    """One row group per page of machines."""
+
+    def __init__(self, path):
+        if pyarrow is None:
+            raise SystemExit("Parquet output needs pyarrow (pip install pyarrow)")
+        self.schema = pyarrow.schema([
+            ("machine_id", pyarrow.string()), ("location", pyarrow.string()),
+            ("day", pyarrow.string()), ("lane", pyarrow.string()),
+            ("coins", pyarrow.int64()), ("revenue", pyarrow.int64()), ("seconds", pyarrow.int64()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        if rows:
+            columns = list(zip(*rows))
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(c, type=f.type) for c, f in zip(columns, self.schema)], schema=self.schema
+            ))
+
+    def close(self):
+        self.writer.close()
+
+
+# --------------------------
+# Commands
+# --------------------------
+def run_report(source, out, fmt, utc_offset):
+    report = ParquetReport(out) if fmt == "parquet" else CsvReport(out)
+    machines = transactions = 0
+    start = time.perf_counter()
+    try:
+        for page in source.machine_pages(lambda m, data, txs: aggregate_machine(m, data, txs, utc_offset)):
+            rows = []
+            for machine_rows, count in page:
+                rows.extend(machine_rows)
+                transactions += count
+            machines += len(page)
+            report.write(rows)
+            log.info(f"{machines} machines, {transactions} transactions")
+    finally:
+        report.close()
+    elapsed = time.perf_counter() - start
+    log.info(f"Done: {machines} machines, {transactions} transactions in {elapsed:.2f}s "
+             f"({transactions / elapsed if elapsed else 0:,.0f} transactions/s)")
+
+
+def dump_line(machine_id, data, transactions):
+    return json.dumps({"id": machine_id, "data": data, "transactions": list(transactions)}, default=str) + "\n"
+
+
+def run_dump(source, out):
+    machines = 0
+    with open(out, "w") as f:
+        for page in source.machine_pages(dump_line):
+            f.writelines(page)
+            machines += len(page)
+            log.info(f"{machines} machines dumped")
+
+
+def day_start(text, utc_offset):
+    """Epoch seconds of local midnight at the start of `text` (YYYY-MM-DD)."""
+    return calendar.timegm(time.strptime(text, "%Y-%m-%d")) - utc_offset * 3600
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Fleet revenue report per bay, day and lane")
+    p.add_argument("command", choices=("report", "dump"))
+    p.add_argument("--owner", help="only machines with this ownerId")
+    p.add_argument("--export", help="read a JSON Lines export instead of Firestore")
+    p.add_argument("--emulator", help="Firestore emulator host:port")
+    p.add_argument("--project", default="demo-carwash", help="project id for the emulator")
+    p.add_argument("--credentials", default=ACCOUNT_DATA, help="service account key for Firestore")
+    p.add_argument("--since", help="first day (YYYY-MM-DD, inclusive)")
+    p.add_argument("--until", help="last day (YYYY-MM-DD, exclusive)")
+    p.add_argument("--utc-offset", type=float, default=UTC_OFFSET_HOURS, help="hours east of UTC for day boundaries")
+    p.add_argument("--page-size", type=int, default=PAGE_SIZE, help="machines per page")
+    p.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    p.add_argument("--out", default="-", help="output file ('-' = stdout, csv only)")
+    args = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [FLEET] %(message)s", stream=sys.stderr)
+    since = day_start(args.since, args.utc_offset) if args.since else None
+    until = day_start(args.until, args.utc_offset) if args.until else None
+
+    if args.export:
+        source = ExportSource(args.export, args.owner, since, until, args.page_size)
+    else:
+        source = FirestoreSource(connect_firestore(args), args.owner, since, until, args.page_size)
+
+    if args.command == "dump":
+        if args.out == "-":
+            p.error("dump needs --out")
+        run_dump(source, args.out)
+    else:
+        if args.format == "parquet" and args.out == "-":
+            p.error("parquet output needs --out")
+        run_report(source, args.out, args.format, args.utc_offset)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Carwash Frame Carousel
+======================
+Promo frames on the menu screen (`car_frame_carousel`). Owners drop any
+number of PNG/JPEG frames into CAROUSEL_DIR; the carousel shows them in
+turn every CAROUSEL_INTERVAL seconds, but only while the menu is on screen.
+
+The carousel owns three slide widgets (previous, current, next) whatever
+the number of frames, and takes their textures from `SlideCache`: at most
+CAROUSEL_CACHE decoded frames, least recently used dropped first. A frame
+is decoded on the service executor (the next one while the current one
+shows) and uploaded on the UI thread; frames above CAROUSEL_MAX_PIXELS are
+skipped. Memory use is the same for 3 frames or 300.
+"""
+
+import os
+from collections import OrderedDict
+
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.core.image import ImageLoader
+from kivy.properties import ListProperty, NumericProperty, StringProperty
+from kivy.uix.carousel import Carousel
+from kivy.uix.image import Image
+
+from vending_engine import safe_log
+
+CAROUSEL_DIR = "media/frames"
+CAROUSEL_INTERVAL = 4.0             # seconds per frame
+CAROUSEL_CACHE = 4                  # decoded frames kept: previous, current, next and the one after
+CAROUSEL_MAX_PIXELS = 1920 * 1080   # larger frames are skipped (one would cost 8+ MB of texture)
+FRAME_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+class SlideCache:
+    """
+    Decoded frame textures, least recently used first. `get()` returns the
+    texture or None; a miss starts a background decode and `on_ready(path)`
+    is called on the UI thread once the texture is in (or the frame was
+    rejected).
+    """
+
+    def __init__(self, core, size=CAROUSEL_CACHE, on_ready=None):
+        self.core = core
+        self.size = size
+        self.on_ready = on_ready
+        self.textures = OrderedDict()  # path -> texture
+        self.pending = set()
+        self.rejected = set()          # unreadable or oversized until the next rescan
+
+    def get(self, path):
+        texture = self.textures.get(path)
+        if texture is not None:
+            self.textures.move_to_end(path)
+            return texture
+        if path not in self.pending and path not in self.rejected:
+            self.pending.add(path)
+            self.core.submit(self.decode, path, on_done=lambda image: self.loaded(path, image))
+        return None
+
+    def decode(self, path):
+        """Worker thread: decode without touching GL or Kivy's image cache."""
+        try:
+            image = ImageLoader.load(path, nocache=True)
+        except Exception as e:
+            safe_log("warning",f"Carousel frame {os.path.basename(path)} unreadable: {e}")
+            return None
+        if image.width * image.height > CAROUSEL_MAX_PIXELS:
+            safe_log("warning",f"Carousel frame {os.path.basename(path)} is {image.width}x{image.height} "
+                               f"— over the {CAROUSEL_MAX_PIXELS} pixel cap, skipped")
+            return None
+        return image
+
+    def loaded(self, path, image):
+        self.pending.discard(path)
+        if image is None:
+            self.rejected.add(path)
+        else:
+            self.textures[path] = image.texture
+            while len(self.textures) > self.size:
+                self.textures.popitem(last=False)
+        if self.on_ready is not None:
+            self.on_ready(path)
+
+
+class FrameCarousel(Carousel):
+    """
+    Looping carousel over the frames in `folder`. `start()` / `stop()` follow
+    the menu screen; swipes work as in a plain Carousel.
+    """
+
+    folder = StringProperty(CAROUSEL_DIR)
+    interval = NumericProperty(CAROUSEL_INTERVAL)
+    frames = ListProperty()
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("loop", True)
+        super().__init__(**kwargs)
+        self.position = 0  # frame on the current slide
+        self._shown_index = 0
+        self._cache = None
+        self._event = None
+        self.slide_images = [Image(allow_stretch=True, opacity=0) for _ in range(3)]
+        for image in self.slide_images:
+            self.add_widget(image)
+        self.fbind("index", self._on_index)
+
+    def scan(self):
+        try:
+            names = sorted(os.listdir(self.folder))
+        except OSError:
+            names = []
+        self.frames = [os.path.join(self.folder, n) for n in names if n.lower().endswith(FRAME_EXTENSIONS)]
+        if self.frames:
+            self.position %= len(self.frames)
+
+    def start(self):
+        """Menu shown: pick up new frames and rotate."""
+        self.stop()
+        if self._cache is None:
+            self._cache = SlideCache(App.get_running_app().core, on_ready=self._on_frame_ready)
+        self._cache.rejected.clear()
+        self.scan()
+        self._refresh()
+        if len(self.frames) > 1:
+            self._event = Clock.schedule_interval(lambda dt: self.load_next(), self.interval)
+
+    def stop(self):
+        """Menu hidden: no timer and no decoding until it is shown again."""
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+
+    def _on_frame_ready(self, path):
+        if path in self._cache.rejected and path in self.frames:
+            # Drop it from the rotation, keeping the frame on screen where it is
+            current = self.frames[self.position % len(self.frames)]
+            self.frames = [f for f in self.frames if f not in self._cache.rejected]
+            if current in self.frames:
+                self.position = self.frames.index(current)
+            if len(self.frames) < 2:
+                self.stop()
+        self._refresh()
+
+    def _on_index(self, carousel, index):
+        if index is None:
+            return
+        if index == (self._shown_index + 1) % 3:
+            self.position += 1
+        elif index == (self._shown_index - 1) % 3:
+            self.position -= 1
+        self._shown_index = index
+        self._refresh()
+
+    def _refresh(self):
+        count = len(self.frames)
+        if not count or self._cache is None:
+            return
+        for offset in (-1, 0, 1):
+            path = self.frames[(self.position + offset) % count]
+            texture = self._cache.get(path)
+            slide = self.slide_images[(self._shown_index + offset) % 3]
+            slide.texture = texture
+            slide.opacity = 1 if texture is not None else 0
+        if count > 3:
+            self._cache.get(self.frames[(self.position + 2) % count])  # prefetch the one after next
@@ -0,0 +1,955 @@
+"""
+Carwash Local Store
+===================
+One embedded SQLite database (WAL mode) for everything the machine keeps on
+its SD card: settings, lifetime coin totals, the coin transaction log, the
+outbox of records waiting to be uploaded, and device metadata.
+
+The schema is versioned with `PRAGMA user_version`; `MIGRATIONS` are applied
+in order on open. The first run imports the old JSON files
+(carwash_settings.json, account_data.json) so no prices or totals are lost.
+
+`SettingsService` sits on top of the store: a validated in-memory copy of
+the settings that the coin path reads without touching the disk, with
+change notifications for the UI.
+
+`WriteBehind` keeps non-critical writes (settings mirror, licence token,
+log lines) in RAM/tmpfs and flushes them every few minutes; coin commits are
+fsynced at once. `WearMeter` counts the bytes each subsystem writes.
+
+    python local_store.py --bench 2000    # per-coin commit cost vs the old JSON rewrite
+    python local_store.py --wear-bench 24 # SD bytes per subsystem, direct vs write-behind
+"""
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+from vending_engine import safe_log
+
+STORE_FILE = "json_data/carwash.db"
+LEGACY_SETTINGS_FILE = "json_data/carwash_settings.json"
+LEGACY_DATA_FILE = "json_data/account_data.json"
+STORE_SYNCHRONOUS = "NORMAL"   # WAL + NORMAL for ordinary commits; coins commit with FULL (fsynced)
+STORE_BUSY_TIMEOUT = 5.0       # seconds to wait on a locked database
+SPOOL_DIR = os.environ.get("CARWASH_SPOOL_DIR") or (
+    "/dev/shm/carwash" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "carwash")
+)
+WRITE_BEHIND_INTERVAL = 300    # seconds between flushes of non-critical writes to the SD card
+SPOOL_MAX_BYTES = 1 << 20      # flush early once a spool holds this much
+LOG_FILE = "json_data/logs/carwash.log"
+ROTATE_BYTES = 5 << 20         # appended files rotate to `<name>.1` past this size
+TOTAL_FIELDS = {"L": "water_coins", "R": "foaming_coins"}
+SALVAGE_TABLES = ("settings", "totals", "transactions", "outbox", "device", "remote_config", "processed_commands")
+SETTING_LIMITS = {               # key -> (type, min, max); other keys are stored as given
+    "water_timer": (int, 10, 300),
+    "foaming_timer": (int, 10, 300),
+}
+
+# Hot-path statements. sqlite3 keeps compiled statements per connection keyed
+# by SQL text, so reusing these constants means each is prepared only once.
+SQL_INSERT_TRANSACTION = "INSERT INTO transactions (uid, ts, lane, amount, seconds) VALUES (?, ?, ?, ?, ?)"
+SQL_ADD_TOTAL = (
+    "INSERT INTO totals (field, amount) VALUES (?, ?) "
+    "ON CONFLICT(field) DO UPDATE SET amount = amount + excluded.amount"
+)
+SQL_SELECT_TOTALS = "SELECT field, amount FROM totals"
+SQL_UPSERT_SETTING = (
+    "INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?) "
+    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at"
+)
+
+
+# --------------------------
+# Migrations
+# --------------------------
+SCHEMA_V1 = """
+        CREATE TABLE settings (
+            key        TEXT PRIMARY KEY,
+            value      TEXT NOT NULL,          -- JSON encoded
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE totals (
+            field  TEXT PRIMARY KEY,           -- water_coins / foaming_coins
+            amount INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE transactions (
+            id      INTEGER PRIMARY KEY,
+            ts      REAL NOT NULL,
+            lane    TEXT NOT NULL,
+            amount  INTEGER NOT NULL,
+            seconds INTEGER NOT NULL
+        );
+        CREATE INDEX transactions_ts ON transactions (ts);
+        CREATE TABLE outbox (
+            id         INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            kind       TEXT NOT NULL,
+            payload    TEXT NOT NULL,          -- JSON encoded
+            attempts   INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE device (
+            key   TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+"""
+
+
+def _migrate_schema(conn, store):
+    # Statement by statement: executescript() would commit the migration transaction
+    for statement in SCHEMA_V1.split(";"):
+        if statement.strip():
+            conn.execute(statement)
+
+
+def _migrate_legacy_json(conn, store):
+    """Import the JSON files the app used before the store existed (left in place)."""
+    now = time.time()
+    settings = _read_json(store.legacy_settings_file)
+    for key, value in settings.items():
+        conn.execute(SQL_UPSERT_SETTING, (key, json.dumps(value), now))
+
+    data = _read_json(store.legacy_data_file)
+    for field in TOTAL_FIELDS.values():
+        if isinstance(data.get(field), (int, float)):
+            conn.execute(SQL_ADD_TOTAL, (field, int(data[field])))
+
+    if settings or data:
+        safe_log("info", f"Imported legacy JSON into local store: {len(settings)} settings, "
+                         f"water={data.get('water_coins', 0)}, foam={data.get('foaming_coins', 0)}")
+
+
+def _migrate_remote_config(conn, store):
+    conn.execute("""
+        CREATE TABLE remote_config (
+            scope      TEXT PRIMARY KEY,       -- fleet / machine
+            version    INTEGER NOT NULL,
+            settings   TEXT NOT NULL,          -- JSON encoded
+            fetched_at REAL NOT NULL
+        )
+    """)
+
+
+def _migrate_processed_commands(conn, store):
+    conn.execute("""
+        CREATE TABLE processed_commands (
+            key          TEXT PRIMARY KEY,     -- idempotency key
+            type         TEXT NOT NULL,
+            processed_at REAL NOT NULL
+        )
+    """)
+
+
+def _migrate_transaction_uid(conn, store):
+    # Rows written before this had their rowid as Firestore document id; keep it for them
+    conn.execute("ALTER TABLE transactions ADD COLUMN uid TEXT")
+    _backfill_transaction_uid(conn)
+
+
+def _backfill_transaction_uid(conn):
+    conn.execute("UPDATE transactions SET uid = CAST(id AS TEXT) WHERE uid IS NULL")
+
+
+MIGRATIONS = [
+    _migrate_schema,                # v1
+    _migrate_legacy_json,           # v2
+    _migrate_remote_config,         # v3
+    _migrate_processed_commands,    # v4
+    _migrate_transaction_uid,       # v5
+]
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def read_settings(path=STORE_FILE):
+    """
+    Settings as the app last committed them (remote config included), read
+    through a read-only connection so a tool running beside the app neither
+    migrates nor locks its store. {} if there is no readable store.
+    """
+    try:
+        conn = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(path))}?mode=ro", uri=True,
+                               timeout=STORE_BUSY_TIMEOUT)
+        try:
+            rows = conn.execute("SELECT key, value FROM settings").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+    return {key: json.loads(value) for key, value in rows}
+
+
+def write_json_atomic(path, data, sync=True, **dump_kwargs):
+    """
+    Write JSON to a temp file, fsync it, then rename over `path` (never a
+    half-written file). sync=False skips both fsyncs. Returns the bytes written.
+    """
+    tmp = f"{path}.tmp"
+    body = json.dumps(data, **dump_kwargs)
+    with open(tmp, "w") as f:
+        f.write(body)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+    # Make the rename itself durable
+    if sync and hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return len(body)
+
+
+# --------------------------
+# Local Store
+# --------------------------
+class LocalStore:
+    """
+    Thread-safe wrapper around one SQLite connection. Every public method is
+    a single transaction, so a crash leaves either the old or the new state,
+    never a half-written file.
+    """
+
+    def __init__(self, path=STORE_FILE, synchronous=STORE_SYNCHRONOUS,
+                 legacy_settings_file=LEGACY_SETTINGS_FILE, legacy_data_file=LEGACY_DATA_FILE, meter=None):
+        self.path = path
+        self.synchronous = synchronous
+        self.meter = meter  # WearMeter counting each commit's writes per subsystem
+        self.legacy_settings_file = legacy_settings_file
+        self.legacy_data_file = legacy_data_file
+        self._lock = threading.RLock()
+        self.conn = None
+        self.open()
+
+    # --------------------------
+    # Lifecycle
+    # --------------------------
+    def open(self):
+        try:
+            self.conn = self._connect()
+            ok = self.conn.execute("PRAGMA quick_check").fetchone()[0] == "ok"
+        except sqlite3.DatabaseError as e:
+            safe_log("error", f"Local store unreadable: {e}")
+            ok = False
+        if not ok:
+            corrupt = self._quarantine()
+            self.conn = self._connect()
+            self.migrate()
+            self._recover(corrupt)
+            return
+        self.migrate()
+
+    def _connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Autocommit mode; multi-statement writes use explicit transactions
+        conn = sqlite3.connect(self.path, timeout=STORE_BUSY_TIMEOUT,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _quarantine(self):
+        """Move a corrupt database (and its WAL) aside. Returns the new path; `_recover` reads it back."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.replace(self.path + suffix, f"{self.path}.corrupt-{stamp}{suffix}")
+        safe_log("error", f"⚠️ Local store was corrupt — moved to {self.path}.corrupt-{stamp}")
+        return f"{self.path}.corrupt-{stamp}"
+
+    def _recover(self, corrupt):
+        """
+        Copy every table that is still readable in the quarantined database
+        (its WAL moved with it) over the freshly migrated one — the legacy
+        JSON it was rebuilt from is months old. If the coin totals cannot be
+        read, the store is flagged `totals_unverified`: the app stops pushing
+        totals to Firestore until someone checks them (`--accept-totals`).
+        """
+        salvaged, lost = {}, []
+        try:
+            old = sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(corrupt))}?mode=ro", uri=True)
+        except sqlite3.Error as e:
+            safe_log("error", f"Quarantined store unreadable: {e}")
+            old = None
+        for table in SALVAGE_TABLES:
+            try:
+                cur = old.execute(f"SELECT * FROM {table}")
+                salvaged[table] = ([d[0] for d in cur.description], cur.fetchall())
+            except (sqlite3.Error, AttributeError):
+                lost.append(table)
+        if old is not None:
+            old.close()
+
+        with self.transaction(durable=True) as conn:
+            for table, (columns, rows) in salvaged.items():
+                live = {info[1] for info in conn.execute(f"PRAGMA table_info({table})")}
+                keep = [i for i, column in enumerate(columns) if column in live]
+                names = ", ".join(columns[i] for i in keep)
+                conn.execute(f"DELETE FROM {table}")
+                conn.executemany(f"INSERT OR REPLACE INTO {table} ({names}) VALUES ({', '.join('?' * len(keep))})",
+                                 [tuple(row[i] for i in keep) for row in rows])
+            _backfill_transaction_uid(conn)  # rows salvaged from a store older than v5
+            # An upload cursor past the recovered rows would skip every new coin
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+            conn.execute("UPDATE device SET value = ? WHERE key = 'transactions_uploaded_id' AND CAST(value AS INTEGER) > ?",
+                         (json.dumps(last_id), last_id))
+            if "totals" in lost:
+                conn.execute("INSERT OR REPLACE INTO device (key, value) VALUES ('totals_unverified', ?)",
+                             (json.dumps(corrupt),))
+
+        recovered = {table: len(rows) for table, (_, rows) in salvaged.items()}
+        safe_log("error", f"⚠️ Local store recovered from {corrupt}: rows {recovered}, unreadable {lost or 'none'}")
+        if "totals" in lost:
+            safe_log("error", f"🚨 Coin totals could not be recovered from {corrupt} — they now start from the "
+                                 f"legacy JSON and are NOT synced to Firestore until checked "
+                                 f"(python local_store.py --accept-totals)")
+
+    def migrate(self):
+        with self._lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+                with self.transaction() as conn:
+                    step(conn, self)
+                    conn.execute(f"PRAGMA user_version={number}")
+                safe_log("info", f"Local store migrated to v{number} ({step.__name__})")
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self.conn.close()
+                self.conn = None
+
+    def transaction(self, subsystem="store", durable=False):
+        """durable=True fsyncs this commit even when the store runs at synchronous=NORMAL."""
+        return _Transaction(self, subsystem, durable)
+
+    # --------------------------
+    # Settings
+    # --------------------------
+    def get_settings(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT key, value FROM settings").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_settings(self, data):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(SQL_UPSERT_SETTING, [(k, json.dumps(v), now) for k, v in data.items()])
+
+    def remote_config(self):
+        """Cached remote config documents as {scope: (version, settings)}."""
+        with self._lock:
+            rows = self.conn.execute("SELECT scope, version, settings FROM remote_config").fetchall()
+        return {scope: (version, json.loads(settings)) for scope, version, settings in rows}
+
+    def save_remote_config(self, scope, version, settings):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO remote_config (scope, version, settings, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(scope) DO UPDATE SET version = excluded.version, "
+                "settings = excluded.settings, fetched_at = excluded.fetched_at",
+                (scope, int(version), json.dumps(settings), time.time()),
+            )
+
+    # --------------------------
+    # Coins
+    # --------------------------
+    def record_coin(self, lane_key, amount, seconds=0, ts=None):
+        """
+        Hot path: log the coin and bump the lane total in one fsynced commit.
+        Each row gets a random `uid` (its Firestore document id): rowids start
+        again at 1 after a rebuild or reinstall, uids never collide.
+        """
+        field = TOTAL_FIELDS.get(lane_key)
+        if field is None:
+            return
+        with self.transaction("ledger", durable=True) as conn:
+            conn.execute(SQL_INSERT_TRANSACTION, (uuid.uuid4().hex, time.time() if ts is None else ts,
+                                                  lane_key, int(amount), int(seconds)))
+            conn.execute(SQL_ADD_TOTAL, (field, int(amount)))
+
+    def totals(self):
+        with self._lock:
+            return dict(self.conn.execute(SQL_SELECT_TOTALS).fetchall())
+
+    def transactions(self, since=0, limit=500):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, ts, lane, amount, seconds FROM transactions WHERE ts >= ? ORDER BY id LIMIT ?",
+                (since, limit),
+            ).fetchall()
+
+    def transactions_after(self, last_id, limit=500):
+        """Transactions with id > last_id as (id, uid, ts, lane, amount, seconds), oldest first (upload cursor)."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT id, uid, ts, lane, amount, seconds FROM transactions WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, limit),
+            ).fetchall()
+
+    # --------------------------
+    # Outbox
+    # --------------------------
+    def outbox_put(self, kind, payload):
+        with self.transaction() as conn:
+            cur = conn.execute(
+                "INSERT INTO outbox (created_at, kind, payload) VALUES (?, ?, ?)",
+                (time.time(), kind, json.dumps(payload)),
+            )
+            return cur.lastrowid
+
+    def outbox_batch(self, limit=50, kind=None):
+        """Oldest pending records as (id, kind, payload, attempts)."""
+        sql = "SELECT id, kind, payload, attempts FROM outbox"
+        args = ()
+        if kind is not None:
+            sql += " WHERE kind = ?"
+            args = (kind,)
+        with self._lock:
+            rows = self.conn.execute(sql + " ORDER BY id LIMIT ?", args + (limit,)).fetchall()
+        return [(row_id, k, json.loads(payload), attempts) for row_id, k, payload, attempts in rows]
+
+    def outbox_ack(self, ids):
+        """Delete records that were delivered."""
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def outbox_retry(self, ids):
+        with self.transaction() as conn:
+            conn.executemany("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", [(i,) for i in ids])
+
+    # --------------------------
+    # Remote commands
+    # --------------------------
+    def claim_command(self, key, command_type, keep_days=30):
+        """Record an idempotency key. Returns False if it was already processed."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM processed_commands WHERE processed_at < ?", (now - keep_days * 86400,))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO processed_commands (key, type, processed_at) VALUES (?, ?, ?)",
+                (key, command_type, now),
+            )
+            return cur.rowcount == 1
+
+    # --------------------------
+    # Device metadata
+    # --------------------------
+    def set_device(self, **values):
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO device (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                [(k, json.dumps(v)) for k, v in values.items()],
+            )
+
+    def accept_totals(self):
+        """Operator checked the totals after a failed recovery: sync them again."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM device WHERE key = 'totals_unverified'")
+
+    def device_info(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT key, value FROM device").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+class _Transaction:
+    """`with store.transaction() as conn:` — BEGIN IMMEDIATE … COMMIT / ROLLBACK under the store lock."""
+
+    def __init__(self, store, subsystem="store", durable=False):
+        self.store = store
+        self.subsystem = subsystem
+        # synchronous can only change outside a transaction, so it is raised around this one
+        self.upgrade = durable and store.synchronous.upper() != "FULL"
+        self.synced = durable or store.synchronous.upper() == "FULL"
+        self.written = None
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            if self.store.meter is not None:
+                self.written = thread_write_bytes()
+            if self.upgrade:
+                self.store.conn.execute("PRAGMA synchronous=FULL")
+            self.store.conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            try:
+                self._restore_synchronous()
+            finally:
+                self.store._lock.release()
+            raise
+        return self.store.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            try:
+                self.store.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            except Exception:
+                # A failed COMMIT (busy, I/O error) can leave the transaction open
+                if self.store.conn.in_transaction:
+                    self.store.conn.execute("ROLLBACK")
+                raise
+            if self.store.meter is not None and not exc_type:
+                after = thread_write_bytes()
+                written = after - self.written if after is not None and self.written is not None else 0
+                self.store.meter.add(self.subsystem, written, self.synced)
+        finally:
+            try:
+                self._restore_synchronous()
+            finally:
+                self.store._lock.release()
+        return False
+
+    def _restore_synchronous(self):
+        """Back to the store's level after a durable commit, so FULL never outlives it on the shared connection."""
+        if self.upgrade and not self.store.conn.in_transaction:
+            self.store.conn.execute(f"PRAGMA synchronous={self.store.synchronous}")
+
+
+# --------------------------
+# Write-Behind & Wear Tracking
+# --------------------------
+def thread_write_bytes():
+    """Bytes the calling thread has passed to write() so far (Linux), or None."""
+    try:
+        with open("/proc/thread-self/io", "rb") as f:
+            for line in f:
+                if line.startswith(b"wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def process_device_write_bytes():
+    """Bytes this process has caused to be written to the block device (Linux), or None."""
+    try:
+        with open("/proc/self/io", "rb") as f:
+            for line in f:
+                if line.startswith(b"write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class WearMeter:
+    """
+    Bytes written, writes and fsyncs per subsystem since start. Store commits
+    are counted by the thread's own write() total (`thread_write_bytes`), so
+    SQLite's WAL and checkpoint traffic is included exactly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # subsystem -> [bytes, writes, fsyncs]
+
+    def add(self, subsystem, nbytes, synced=False):
+        with self._lock:
+            counter = self.counters.get(subsystem)
+            if counter is None:
+                counter = self.counters[subsystem] = [0, 0, 0]
+            counter[0] += nbytes
+            counter[1] += 1
+            counter[2] += bool(synced)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {"bytes": b, "writes": w, "fsyncs": s} for name, (b, w, s) in self.counters.items()}
+
+
+class WriteBehind:
+    """
+    Holds non-critical writes in RAM and puts them on the SD card every
+    WRITE_BEHIND_INTERVAL: `put_json()` keeps only the newest content per file
+    (ten updates cost one write), `append()` spools text such as log lines to
+    tmpfs so it also survives an app crash. `put_json(..., critical=True)`
+    writes and fsyncs at once. Every write is counted in `meter`.
+    """
+
+    def __init__(self, meter=None, spool_dir=SPOOL_DIR):
+        self.meter = meter if meter is not None else WearMeter()
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time: spools copied once, JSON written in order
+        self._pending = {}  # path -> (subsystem, data, dump_kwargs)
+        self._spools = {}   # path -> [subsystem, file, bytes]
+        os.makedirs(spool_dir, exist_ok=True)
+        # Spools left by a crash are flushed with the first flush()
+        for name in os.listdir(spool_dir):
+            if name.endswith(".flushing"):
+                continue
+            spool = os.path.join(spool_dir, name)
+            if os.path.exists(spool + ".flushing"):
+                # Both survived: the .flushing copy is the older one, so this spool goes after it
+                with open(spool, "rb") as src, open(spool + ".flushing", "ab") as dst:
+                    dst.write(src.read())
+                os.remove(spool)
+            else:
+                os.replace(spool, spool + ".flushing")
+
+    def _spool_path(self, path):
+        return os.path.join(self.spool_dir, urllib.parse.quote(path, safe=""))
+
+    def put_json(self, subsystem, path, data, critical=False, **dump_kwargs):
+        if critical:
+            self.meter.add(subsystem, write_json_atomic(path, data, **dump_kwargs), synced=True)
+            return
+        with self._lock:
+            self._pending[path] = (subsystem, data, dump_kwargs)
+
+    def append(self, subsystem, path, text):
+        data = text.encode("utf-8", "replace")
+        with self._lock:
+            spool = self._spools.get(path)
+            if spool is None:
+                spool = self._spools[path] = [subsystem, open(self._spool_path(path), "ab", buffering=0), 0]
+            spool[1].write(data)
+            spool[2] += len(data)
+            full = spool[2] >= SPOOL_MAX_BYTES
+        if full:
+            self.flush(wait=False)
+
+    def tail(self, path, nbytes):
+        """Last `nbytes` of an appended file, including what is still spooled."""
+        data = b""
+        for source in (path, self._spool_path(path) + ".flushing", self._spool_path(path)):
+            try:
+                with open(source, "rb") as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - nbytes))
+                    data = (data + f.read())[-nbytes:]
+            except OSError:
+                pass
+        return data.decode("utf-8", "replace")
+
+    def flush(self, wait=True):
+        """
+        Write everything held back to the SD card (periodic service task, and
+        on exit). wait=False returns at once if a flush is already running,
+        e.g. a full log spool on a thread that is logging from inside a flush.
+        """
+        if not self._flush_lock.acquire(blocking=wait):
+            return
+        try:
+            self._flush()
+        finally:
+            self._flush_lock.release()
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            for path in list(self._spools):
+                spool_path = self._spool_path(path)
+                if os.path.exists(spool_path + ".flushing"):
+                    continue  # previous copy still failing; keep appending to this one
+                subsystem, f, _ = self._spools.pop(path)
+                f.close()
+                os.replace(spool_path, spool_path + ".flushing")
+
+        for path, (subsystem, data, dump_kwargs) in pending.items():
+            try:
+                self.meter.add(subsystem, write_json_atomic(path, data, sync=False, **dump_kwargs))
+            except OSError as e:
+                with self._lock:
+                    self._pending.setdefault(path, (subsystem, data, dump_kwargs))
+                safe_log("warning", f"Write-behind of {path} failed: {e}")
+
+        for name in os.listdir(self.spool_dir):
+            if name.endswith(".flushing"):
+                try:
+                    self._copy_spool(os.path.join(self.spool_dir, name),
+                                     urllib.parse.unquote(name[:-len(".flushing")]))
+                except OSError:
+                    pass  # kept for the next flush; not logged, the log may be what failed
+
+    def _copy_spool(self, spool_path, path):
+        with open(spool_path, "rb") as f:
+            data = f.read()
+        if data:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) + len(data) > ROTATE_BYTES:
+                os.replace(path, path + ".1")
+            with open(path, "ab") as f:
+                f.write(data)
+            self.meter.add("log" if path.endswith(".log") else "spool", len(data))
+        os.remove(spool_path)
+
+
+class WriteBehindLogHandler(logging.Handler):
+    """Log records spooled through `WriteBehind` instead of one SD write per line."""
+
+    def __init__(self, writer, path=LOG_FILE):
+        super().__init__()
+        self.writer = writer
+        self.path = path
+        self.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
+    def emit(self, record):
+        try:
+            self.writer.append("log", self.path, self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+# --------------------------
+# Settings Service
+# --------------------------
+def validate_setting(key, value):
+    """Return `value` coerced for `key`, or raise ValueError."""
+    limits = SETTING_LIMITS.get(key)
+    if limits is None:
+        return value
+    kind, low, high = limits
+    if isinstance(value, bool):
+        raise ValueError(f"{key}: expected {kind.__name__}, got {value!r}")
+    try:
+        value = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{key}: expected {kind.__name__}, got {value!r}")
+    if not low <= value <= high:
+        raise ValueError(f"{key}: {value} outside {low}..{high}")
+    return value
+
+
+class SettingsService:
+    """
+    Validated in-memory settings backed by the local store.
+
+    Reads (`get`, `[]`) are plain dict lookups on an immutable snapshot, so the
+    coin path never touches the disk. `update()` validates, commits the changed
+    keys to SQLite, rewrites the JSON mirror (through `writer` if given) and
+    then calls every subscriber with `(changed, source)` on the calling thread.
+    """
+
+    def __init__(self, store, defaults, mirror_file=None, validators=None, writer=None):
+        self.store = store
+        self.mirror_file = mirror_file
+        self.writer = writer  # WriteBehind: the mirror is a copy, SQLite is the record
+        self.validators = dict(validators or {})  # key -> fn(value) returning the value or raising ValueError
+        self._lock = threading.Lock()
+        self._subscribers = ()
+
+        values = dict(defaults)
+        for key, value in store.get_settings().items():
+            try:
+                values[key] = self.validate(key, value)
+            except ValueError as e:
+                safe_log("error", f"Stored setting rejected, using default: {e}")
+        self._values = values
+
+    def validate(self, key, value):
+        if key in self.validators:
+            return self.validators[key](value)
+        return validate_setting(key, value)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def snapshot(self):
+        return dict(self._values)
+
+    def subscribe(self, callback):
+        """`callback(changed, source)` after every update that changed something."""
+        with self._lock:
+            self._subscribers += (callback,)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(c for c in self._subscribers if c != callback)
+
+    def update(self, changes, source="local"):
+        """
+        Apply `changes` (all or nothing). Raises ValueError if any value is
+        invalid; returns the dict of keys that actually changed.
+        """
+        validated = {key: self.validate(key, value) for key, value in changes.items()}
+        with self._lock:
+            changed = {k: v for k, v in validated.items() if self._values.get(k) != v}
+            if not changed:
+                return {}
+            self.store.save_settings(changed)
+            values = dict(self._values)
+            values.update(changed)
+            self._values = values
+            subscribers = self._subscribers
+
+        if self.mirror_file and self.writer is not None:
+            self.writer.put_json("settings", self.mirror_file, values)
+        elif self.mirror_file:
+            try:
+                write_json_atomic(self.mirror_file, values)
+            except OSError as e:
+                safe_log("warning", f"Settings mirror not written: {e}")
+
+        safe_log("info", f"Settings updated ({source}): {changed}")
+        for callback in subscribers:
+            try:
+                callback(changed, source)
+            except Exception as e:
+                safe_log("warning", f"Settings subscriber failed: {e}")
+        return changed
+
+
+# --------------------------
+# Benchmark
+# --------------------------
+def run_benchmark(coins=2000):
+    """
+    Per-coin commit cost: the old read-modify-rewrite of account_data.json
+    against `record_coin` at synchronous=NORMAL and FULL, in a temp directory.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_file = os.path.join(tmp, "account_data.json")
+        with open(data_file, "w") as f:
+            json.dump({"water_coins": 0, "foaming_coins": 0}, f)
+
+        start = time.perf_counter()
+        for i in range(coins):
+            with open(data_file, "r") as f:
+                data = json.load(f)
+            field = "water_coins" if i & 1 else "foaming_coins"
+            data[field] = data.get(field, 0) + 5
+            with open(data_file, "w") as f:
+                json.dump(data, f, indent=4)
+        results["json rewrite"] = time.perf_counter() - start
+
+        for synchronous in ("NORMAL", "FULL"):
+            store = LocalStore(os.path.join(tmp, f"bench-{synchronous}.db"), synchronous=synchronous,
+                               legacy_settings_file="", legacy_data_file="")
+            start = time.perf_counter()
+            for i in range(coins):
+                store.record_coin("L" if i & 1 else "R", 5, 60)
+            results[f"sqlite WAL synchronous={synchronous}"] = time.perf_counter() - start
+            assert sum(store.totals().values()) == coins * 5
+            store.close()
+
+    for name, elapsed in results.items():
+        print(f"{name:<32} {elapsed / coins * 1e6:9.1f} µs/coin  ({coins} coins in {elapsed:.3f}s)")
+    return results
+
+
+def run_wear_benchmark(hours=24, interval=WRITE_BEHIND_INTERVAL):
+    """
+    Simulated day of traffic (coins, log lines, licence refreshes, settings
+    saves) written straight through, as before, and through `WriteBehind`,
+    in a temp directory. Prints bytes, writes and fsyncs per subsystem.
+    """
+    per_hour = {"coins": 40, "log": 900, "licence": 1, "settings": 0.25}
+    events = []
+    for kind, rate in per_hour.items():
+        count = max(1, int(rate * hours))
+        events += [(i * hours * 3600 / count, kind) for i in range(count)]
+    events.sort()
+
+    line = "2026-01-01 12:00:00,000 [INFO] 💰 Coin inserted lane L +₱5 / +60s (rate=60s per ₱5)\n"
+    token = {"payload": {"machine_id": "bench", "authorized": True, "issued_at": 0}, "sig": "0" * 64}
+    settings = {"water_timer": 60, "foaming_timer": 60, "pricing_rules": []}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("direct", "write-behind"):
+            base = os.path.join(tmp, mode)
+            os.makedirs(base)
+            meter = WearMeter()
+            store = LocalStore(os.path.join(base, "carwash.db"), legacy_settings_file="", legacy_data_file="",
+                               meter=meter)
+            writer = WriteBehind(meter, spool_dir=os.path.join(base, "spool")) if mode == "write-behind" else None
+            log_file = open(os.path.join(base, "carwash.log"), "a") if writer is None else None
+            next_flush = interval
+            for at, kind in events:
+                if writer is not None and at >= next_flush:
+                    writer.flush()
+                    next_flush += interval
+                if kind == "coins":
+                    store.record_coin("L", 5, 60)
+                elif kind == "log" and writer is not None:
+                    writer.append("log", os.path.join(base, "carwash.log"), line)
+                elif kind == "log":
+                    log_file.write(line)
+                    log_file.flush()  # what a logging.FileHandler does per record
+                    meter.add("log", len(line.encode()))
+                elif writer is not None:
+                    writer.put_json(kind, os.path.join(base, f"{kind}.json"), token if kind == "licence" else settings)
+                else:
+                    written = write_json_atomic(os.path.join(base, f"{kind}.json"),
+                                                token if kind == "licence" else settings)
+                    meter.add(kind, written, synced=True)
+            if writer is not None:
+                writer.flush()
+            else:
+                log_file.close()
+            store.close()
+            results[mode] = meter.snapshot()
+
+    print(f"{hours}h simulated, write-behind flush every {interval}s")
+    print(f"{'subsystem':<10} {'direct KB':>10} {'writes':>7} {'fsyncs':>7} {'behind KB':>10} {'writes':>7} {'fsyncs':>7}")
+    empty = {"bytes": 0, "writes": 0, "fsyncs": 0}
+    totals = [0, 0]
+    for name in sorted(set(results["direct"]) | set(results["write-behind"])):
+        a = results["direct"].get(name, empty)
+        b = results["write-behind"].get(name, empty)
+        totals[0] += a["bytes"]
+        totals[1] += b["bytes"]
+        print(f"{name:<10} {a['bytes'] / 1024:10.1f} {a['writes']:7} {a['fsyncs']:7} "
+              f"{b['bytes'] / 1024:10.1f} {b['writes']:7} {b['fsyncs']:7}")
+    print(f"{'total':<10} {totals[0] / 1024:10.1f} {'':15} {totals[1] / 1024:10.1f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Carwash local SQLite store")
+    parser.add_argument("--db", default=STORE_FILE, help="database path")
+    parser.add_argument("--bench", type=int, metavar="COINS", help="compare per-coin commit cost with the JSON rewrite")
+    parser.add_argument("--dump", action="store_true", help="print settings, totals, device info and outbox size")
+    parser.add_argument("--accept-totals", action="store_true",
+                        help="after a corrupt store: totals were checked, resume syncing them to Firestore")
+    parser.add_argument("--wear-bench", type=float, metavar="HOURS",
+                        help="SD bytes per subsystem for simulated traffic, direct vs write-behind")
+    args = parser.parse_args()
+    if args.bench:
+        run_benchmark(args.bench)
+    elif args.wear_bench:
+        run_wear_benchmark(args.wear_bench)
+    elif args.accept_totals:
+        store = LocalStore(args.db)
+        store.accept_totals()
+        print(f"Totals accepted: {store.totals()}")
+    elif args.dump:
+        store = LocalStore(args.db)
+        print(json.dumps({
+            "settings": store.get_settings(),
+            "totals": store.totals(),
+            "device": store.device_info(),
+            "outbox": len(store.outbox_batch(limit=10000)),
+        }, indent=4))
+    else:
+        parser.print_help()
@@ -4,6 +4,12 @@ Carwash Vendo Machine (Optimized for Raspberry Pi 4)
 POWERED BY: VENDOPRO x SOLE DEVELOPEMENT
 """
 
+import os
+
+# Kivy's own log file would write every line to the SD card; logs go through
+# the write-behind spool instead (see `disk` below)
+os.environ.setdefault("KIVY_NO_FILELOG", "1")
+
 # --- Kivy Graphics Optimizations for Raspberry Pi 4 ---
 from kivy.config import Config
 
@@ -36,20 +42,22 @@ from kivy.uix.label import Label
 import subprocess
 import shutil
 import json
-import os
-import threading
+import logging
 import time
 import requests
-import logging
 import platform
-import glob
 import tempfile
+import hashlib
+import hmac
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import firebase_admin
 from firebase_admin import credentials, firestore
 
 from kivy.app import App
-from kivy.clock import Clock, mainthread
+from kivy.clock import Clock
 from kivy.properties import (
     StringProperty, ListProperty, BooleanProperty,
     ObjectProperty, NumericProperty
@@ -58,38 +66,17 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.screenmanager import Screen
 from kivy.graphics import Color, RoundedRectangle
 
-# =======================================================
-#   FIX PYTHON 3.13 LOGGING + FIRESTORE CRASH
-# =======================================================
-
-# =======================================================
-#   SAFE LOGGING SYSTEM (Python 3.13 • Raspberry Pi • Windows)
-# =======================================================
-def safe_log(level, msg, *args, **kwargs):
-    """
-    Prevent RecursionError in Python 3.12–3.13 by forcing all log messages
-    into safe string form before sending to logging.
-    """
-    try:
-        text = str(msg)
-    except Exception:
-        try:
-            text = repr(msg)
-        except Exception:
-            text = "Unloggable message"
-
-    logger = logging.getLogger()
-
-    if level == "info":
-        logger.info(text)
-    elif level == "warning":
-        logger.warning(text)
-    elif level == "error":
-        logger.error(text)
-    elif level == "debug":
-        logger.debug(text)
-    else:
-        logger.log(logging.INFO, text)
+from vending_engine import (
+    safe_log, is_linux, is_windows, ServiceCore, VendingEngine, Ledger, LaneCheckpoint,
+    CoinAccepted, LaneStarted, LaneExpired, LaneStopped, SerialConnected, SerialLost,
+    DELIVER_ASYNC, DELIVER_UI, validate_pricing_rules,
+)
+from local_store import (
+    LocalStore, SettingsService, WearMeter, WriteBehind, WriteBehindLogHandler,
+    write_json_atomic, process_device_write_bytes, LOG_FILE, WRITE_BEHIND_INTERVAL,
+)
+from attract_loop import MediaLibrary, warm_file
+from asset_manifest import AssetPreloader
 
 def wifi_keep_alive():
     """Ensure Wi-Fi stays ON on Raspberry Pi. Windows ignores this safely."""
@@ -190,33 +177,42 @@ def get_device_id():
         safe_log("warning", f"get_device_id error: {e}")
         return "unknown_device"
 
-try:
-    import serial
-except ImportError:
-    serial = None
-
-def detect_serial_port():
-    if platform.system() == "Windows":
-        return "COM3"
-    else:
-        # auto-detect first USB serial device
-        ports = glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
-        return ports[0] if ports else "/dev/ttyUSB0"
-
 # --------------------------
 # Constants
 # --------------------------
 
-SERIAL_PORT = detect_serial_port()
-BAUDRATE = 9600
-SERIAL_CHECK_INTERVAL = 0.05   # Less CPU usage
-
+SYNC_INTERVAL = 120            # periodic totals sync to Firebase
+CONNECTIVITY_INTERVAL = 30     # internet probe period
+WIFI_KEEPALIVE_INTERVAL = 10
+WIFI_SCAN_INTERVAL = 1.5
 ACCOUNT_DATA = "serviceAccountKey.json"
 DATA_FILE = "json_data/account_data.json"
 SETTINGS_FILE = "json_data/carwash_settings.json"
+LICENCE_FILE = "json_data/licence_token.json"
+LICENCE_REFRESH = 24 * 3600          # revalidate online after a day
+LICENCE_OFFLINE_GRACE = 30 * 86400   # refuse to run on a token older than this
+REMOTE_CONFIG_REATTACH = 300         # re-attach Firestore config listeners (seconds)
+REMOTE_CONFIG_RETRY = 30             # re-check a deferred config while lanes are busy
+HEARTBEAT_ACTIVE_INTERVAL = 15       # health heartbeat while a lane runs (seconds)
+HEARTBEAT_IDLE_INTERVAL = 300        # idle heartbeat; also the keep-alive when nothing changed
+HEARTBEAT_DISK_STEP_MB = 50          # disk free is reported in steps so it does not cause writes
+HEARTBEAT_WRITES_STEP_KB = 1024      # SD write counters likewise (they grow with every coin and log line)
+TRANSACTION_UPLOAD_BATCH = 400       # Firestore batched writes allow at most 500 operations
+COMMAND_WORKERS = 1                  # one at a time: dispatch waits for each command to keep them in order
+COMMAND_QUEUE_LIMIT = 100            # queued commands before new ones wait for the next re-attach
+COMMAND_RESULT_FLUSH = 10            # seconds between batched result writes
+COMMAND_RESULT_BATCH = 100
+COMMAND_UI_TIMEOUT = 5               # seconds a command waits for the UI thread
+COMMAND_LOG_LINES = 500
+COMMAND_LOG_BYTES = 200_000          # keep result documents well under Firestore's 1 MB
+IDLE_CHECK_INTERVAL = 1.0            # seconds between inactivity checks (one timer for the whole app)
+SPLASH_MAX_SECONDS = 8.0             # leave the splash even if asset preloading has not finished
+ATTRACT_SYNC_INTERVAL = 900          # seconds between promo playlist checks (downloads only when online)
+STORAGE_BUCKET = None                # Firebase Storage bucket for promo clips; None = <project>.appspot.com
 DEFAULT_SETTINGS = {
     "water_timer": 60,
-    "foaming_timer": 60
+    "foaming_timer": 60,
+    "pricing_rules": []    # happy hours, weekend rates, coin bonuses (see vending_engine.compile_pricing)
 }
 
 # --------------------------
@@ -235,92 +231,816 @@ except Exception as e:
     db = None  # allows app to run offline
 
 
-def load_settings():
-    if not os.path.exists(SETTINGS_FILE):
-        save_settings(DEFAULT_SETTINGS)
-        return DEFAULT_SETTINGS
-
-    try:
-        with open(SETTINGS_FILE, "r") as f:
-            return json.load(f)
-    except:
-        return DEFAULT_SETTINGS
-
-def save_settings(data):
-    try:
-        with open(SETTINGS_FILE, "w") as f:
-            json.dump(data, f)
-        return True
-    except:
-        return False
+# --------------------------
+# Local Store (SQLite, WAL)
+# --------------------------
+# Settings, totals, transactions, outbox and device info. The first open
+# imports the old JSON files, so prices and totals carry over. Coins are
+# fsynced at once; settings mirror, licence token and logs are written
+# behind (RAM/tmpfs, flushed every WRITE_BEHIND_INTERVAL). `wear` counts
+# the bytes each subsystem writes to the SD card.
+wear = WearMeter()
+store = LocalStore(meter=wear)
+disk = WriteBehind(wear)
+logging.getLogger().addHandler(WriteBehindLogHandler(disk, LOG_FILE))
+
+def format_duration(seconds):
+    """60 → '1 minute', 100 → '1 min 40 sec', 45 → '45 seconds'."""
+    m, s = divmod(int(seconds), 60)
+    if m and s:
+        return f"{m} min {s} sec"
+    if m:
+        return f"{m} minute" if m == 1 else f"{m} minutes"
+    return f"{s} seconds"
 
 # Unique IDs (change per Raspberry Pi unit)
 OWNER_ID = get_device_id() # the Firebase Auth user ID of the machine owner
 MACHINE_ID = f"machine_{OWNER_ID[-6:]}"  # e.g., last 6 chars of serial
 LOCATION = "Imus Branch"     # optional
+FLEET_ID = "default"         # fleets/{FLEET_ID}/config/settings applies to every bay in the fleet
 
 # --------------------------
-# Screens & UI Classes
+# Licence Token
 # --------------------------
-class InactivityMixin:
-    inactivity_timeout = 20  # seconds
+LICENCE_VALID, LICENCE_STALE, LICENCE_DENIED, LICENCE_MISSING = "valid", "stale", "denied", "missing"
 
-    def on_enter(self):
-        self.start_inactivity_timer()
-        Window.bind(on_touch_down=self._on_any_touch)
+def licence_signing_key():
+    """
+    HMAC key for licence tokens, bound to this device and to the service
+    account's private key so a token cannot be copied or hand-edited. None
+    without a private key: a key made from MACHINE_ID alone could be forged.
+    """
+    try:
+        with open(ACCOUNT_DATA, "r") as f:
+            secret = str(json.load(f).get("private_key") or "").encode()
+    except Exception:
+        secret = b""
+    if not secret:
+        safe_log("error","No service account private key — licence tokens can be neither issued nor trusted.")
+        return None
+    return hashlib.sha256(b"carwash-licence\0" + secret + b"\0" + MACHINE_ID.encode()).digest()
 
-    def on_leave(self):
-        self.stop_inactivity_timer()
-        Window.unbind(on_touch_down=self._on_any_touch)
+class LicenceToken:
+    """
+    Locally cached, signed authorization result. The signature is verified
+    once when the token is loaded; after that `status()` is just two time
+    comparisons, so it can be called on every boot without touching the network.
+    """
 
-    def start_inactivity_timer(self):
-        self.stop_inactivity_timer()
-        self.inactivity_event = Clock.schedule_once(self.on_inactivity_timeout, self.inactivity_timeout)
+    def __init__(self, path=LICENCE_FILE, machine_id=MACHINE_ID, key=None, writer=None):
+        self.path = path
+        self.machine_id = machine_id
+        self.writer = writer  # WriteBehind, for its wear meter; the token itself is always fsynced
+        self.key = key if key is not None else licence_signing_key()
+        self.payload = None
+        self.load()
+
+    def _sign(self, payload):
+        body = json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+        return hmac.new(self.key, body, hashlib.sha256).hexdigest()
+
+    def load(self):
+        self.payload = None
+        if self.key is None:
+            return  # nothing can be verified: any stored token counts as missing
+        try:
+            with open(self.path, "r") as f:
+                token = json.load(f)
+            payload, sig = token["payload"], token["sig"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if not hmac.compare_digest(self._sign(payload), str(sig)):
+            safe_log("warning", "Licence token signature invalid — ignoring it.")
+            return
+        if payload.get("machine_id") != self.machine_id:
+            safe_log("warning", "Licence token belongs to another machine — ignoring it.")
+            return
+        self.payload = payload
+
+    def status(self, now=None):
+        p = self.payload
+        if p is None:
+            return LICENCE_MISSING
+        now = time.time() if now is None else now
+        if not p.get("authorized"):
+            return LICENCE_DENIED
+        if now >= p["expires_at"]:
+            return LICENCE_MISSING
+        if now >= p["refresh_at"]:
+            return LICENCE_STALE
+        return LICENCE_VALID
+
+    def issue(self, authorized, ttl=LICENCE_REFRESH):
+        """Store a freshly validated result (atomic replace, fsynced: a lost denial must not come back as a grant)."""
+        if self.key is None:
+            self.payload = None
+            return
+        now = int(time.time())
+        payload = {
+            "machine_id": self.machine_id,
+            "authorized": bool(authorized),
+            "issued_at": now,
+            "refresh_at": now + int(ttl),
+            "expires_at": now + LICENCE_OFFLINE_GRACE,
+        }
+        token = {"payload": payload, "sig": self._sign(payload)}
+        if self.writer is not None:
+            self.writer.put_json("licence", self.path, token, critical=True, indent=4)
+        else:
+            write_json_atomic(self.path, token, indent=4)
+        self.payload = payload
 
-    def stop_inactivity_timer(self):
-        if hasattr(self, "inactivity_event") and self.inactivity_event:
-            Clock.unschedule(self.inactivity_event)
-            self.inactivity_event = None
+    def migrate_legacy_flag(self, data_file=DATA_FILE):
+        """Move the old unsigned `is_authorized` flag out of the totals file."""
+        try:
+            with open(data_file, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if "is_authorized" not in data:
+            return
 
-    def _on_any_touch(self, window, touch):
-        app = App.get_running_app()
-        sm = app.root.ids.sm
-        # Don't restart timer if we're on video screen OR if video screen is active
-        if sm.current != "video" and not self._is_video_screen_active():
-            self.start_inactivity_timer()
+        legacy = data.pop("is_authorized")
+        if self.payload is None and legacy:
+            # Honour it only until the first online check
+            self.issue(True, ttl=0)
+        write_json_atomic(data_file, data, indent=4)  # the totals live in this file
+        safe_log("info", "Migrated is_authorized flag from account data to licence token.")
 
-    def _is_video_screen_active(self):
-        """Check if video screen is currently active in any way"""
-        app = App.get_running_app()
-        sm = app.root.ids.sm
-        return sm.current == "video"
+# --------------------------
+# Remote Config
+# --------------------------
+class RemoteConfig:
+    """
+    Prices/timers pushed from Firestore. Two documents, each
+    `{"version": int, "settings": {...}}`:
 
-    def on_inactivity_timeout(self, dt):
-        app = App.get_running_app()
-        sm = app.root.ids.sm
+        fleets/{FLEET_ID}/config/settings      defaults for every bay
+        machines/{MACHINE_ID}/config/settings  overrides for this bay
+
+    A `set_price` command adds a third, highest scope ("command") until a
+    newer document sets the same keys. Every newer version is cached in the
+    local store (so the bay keeps its prices offline) and applied through
+    the settings service as one update, but only while the engine is idle —
+    never in the middle of a wash.
+    """
 
-        # 🔹 Skip inactivity if we're on the Wi-Fi screen
-        if sm.current == "wifi":
-            safe_log("info","⏸️ Inactivity ignored — Wi-Fi screen open.")
-            self.start_inactivity_timer()  # restart timer for next cycle
+    SCOPES = ("fleet", "machine", "command")
+
+    def __init__(self, store, settings, engine, core):
+        self.store = store
+        self.settings = settings
+        self.engine = engine
+        self.core = core
+        self.cached = store.remote_config()  # scope -> (version, settings)
+        self.pending = bool(self.cached)     # re-apply the cache once at startup
+        self.deferred_logged = False         # "deferred" logged once per pending change, not per poll
+
+    def documents(self):
+        return {
+            "fleet": db.collection("fleets").document(FLEET_ID).collection("config").document("settings"),
+            "machine": db.collection("machines").document(MACHINE_ID).collection("config").document("settings"),
+        }
+
+    def merged(self):
+        values = {}
+        for scope in self.SCOPES:
+            values.update(self.cached.get(scope, (0, {}))[1])
+        return values
+
+    def on_document(self, scope, data):
+        """Firestore snapshot for one scope (watch thread)."""
+        try:
+            version = int(data.get("version", 0))
+            values = dict(data.get("settings") or {})
+        except (TypeError, ValueError):
+            safe_log("warning",f"Remote config ({scope}) malformed — ignored.")
+            return
+        if version <= self.cached.get(scope, (0, {}))[0]:
             return
 
-        # Don't trigger if video screen is already active
-        if self._is_video_screen_active():
-            safe_log("info","Inactivity timeout ignored - video already playing"),
+        self.store.save_remote_config(scope, version, values)
+        self.cached[scope] = (version, values)
+        # The newer document wins over an earlier set_price for the keys it sets
+        command_version, command = self.cached.get("command", (0, {}))
+        if set(command) & set(values):
+            command = {k: v for k, v in command.items() if k not in values}
+            self.store.save_remote_config("command", command_version + 1, command)
+            self.cached["command"] = (command_version + 1, command)
+        self.pending = True
+        self.deferred_logged = False
+        safe_log("info",f"📥 Remote config {scope} v{version} received: {values}")
+        # Serialised with coin crediting, which also runs on the service loop
+        self.core.call_soon(self.apply_pending)
+
+    def on_command(self, values):
+        """
+        `set_price` values (command thread): validated now, cached as the
+        "command" scope and applied with the documents once the engine is
+        idle. Raises ValueError for an invalid value.
+        """
+        values = {key: self.settings.validate(key, value) for key, value in dict(values).items()}
+        version, command = self.cached.get("command", (0, {}))
+        command = {**command, **values}
+        self.store.save_remote_config("command", version + 1, command)
+        self.cached["command"] = (version + 1, command)
+        self.pending = True
+        self.deferred_logged = False
+
+    def apply_pending(self, *args):
+        """Service loop. Returns "applied", "deferred", "rejected" or None (nothing pending)."""
+        if not self.pending:
+            return None
+        if not self.engine.is_idle():
+            if not self.deferred_logged:
+                self.deferred_logged = True
+                safe_log("info","Remote config deferred — a lane is in use.")
+            return "deferred"
+        self.pending = False
+        self.deferred_logged = False
+        try:
+            self.settings.update(self.merged(), source="remote")
+        except ValueError as e:
+            safe_log("error",f"❌ Remote config rejected: {e}")
+            return "rejected"
+        return "applied"
+
+    async def watch(self):
+        """Supervised service: keep snapshot listeners on both config documents."""
+        if db is None:
+            safe_log("warning","Firestore not initialized — using cached remote config only.")
             return
 
-        if app.is_machine_busy():  # ✅ call app version
-            safe_log("info","Inactivity ignored — machine busy (popup/coin/timer)")
-            self.start_inactivity_timer()
+        def listener(scope):
+            def on_snapshot(doc_snapshot, changes, read_time):
+                for doc in doc_snapshot:
+                    if doc.exists:
+                        self.on_document(scope, doc.to_dict() or {})
+            return on_snapshot
+
+        watches = []
+        try:
+            while True:
+                try:
+                    for w in watches:
+                        await self.core.run_blocking(w.unsubscribe)
+                    watches = []
+                    for scope, ref in self.documents().items():
+                        watches.append(await self.core.run_blocking(ref.on_snapshot, listener(scope)))
+                    safe_log("info","🔥 Remote config listeners attached.")
+                    await asyncio.sleep(REMOTE_CONFIG_REATTACH)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    safe_log("error",f"❌ Remote config listener failed: {e} — retrying in 10 seconds")
+                    await asyncio.sleep(10)
+        finally:
+            for w in watches:
+                try:
+                    w.unsubscribe()
+                except Exception:
+                    pass
+
+# --------------------------
+# Attract Loop Sync
+# --------------------------
+class AttractSync:
+    """
+    Promo playlist for the idle video screen (format in attract_loop.py):
+
+        fleets/{FLEET_ID}/config/attract      clips for every bay
+        machines/{MACHINE_ID}/config/attract  this bay's own clips, when it lists any
+
+    Polled every ATTRACT_SYNC_INTERVAL on the executor while online; the
+    library downloads and verifies new clips before the screen plays them
+    and keeps playing its cache when the network is down.
+    """
+
+    def __init__(self, library, is_online):
+        self.library = library
+        self.is_online = is_online
+
+    def documents(self):
+        return {
+            "fleet": db.collection("fleets").document(FLEET_ID).collection("config").document("attract"),
+            "machine": db.collection("machines").document(MACHINE_ID).collection("config").document("attract"),
+        }
+
+    def bucket(self):
+        try:
+            from firebase_admin import storage
+            return storage.bucket(STORAGE_BUCKET or f"{firebase_admin.get_app().project_id}.appspot.com")
+        except Exception as e:
+            safe_log("warning",f"Firebase Storage unavailable for promo clips: {e}")
+            return None
+
+    def sync(self):
+        if db is None or not self.is_online():
+            return
+        document = scope = None
+        for name, ref in self.documents().items():
+            doc = ref.get()
+            if doc.exists and (doc.to_dict() or {}).get("clips"):
+                document, scope = doc.to_dict(), name  # the machine document wins over the fleet one
+        if document is None:
             return
+        needs_bucket = any(not c.get("url") for c in document.get("clips") or () if isinstance(c, dict))
+        self.library.sync(document, bucket=self.bucket() if needs_bucket else None, scope=scope)
+
+# --------------------------
+# Heartbeat
+# --------------------------
+def app_version():
+    """Short git revision of the checkout the app runs from, or 'unknown'."""
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=2,
+        )
+        return out.stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+def read_cpu_temperature():
+    """SoC temperature in °C (Raspberry Pi / Linux thermal zone), or None."""
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
+            return round(int(f.read().strip()) / 1000)
+    except (OSError, ValueError):
+        return None
 
-        sm = app.root.ids.sm
-        app.last_screen_before_video = sm.current
-        safe_log("info",f"No touch for {self.inactivity_timeout}s → switching to video from {sm.current}")
+def read_boot_time():
+    try:
+        with open("/proc/uptime", "r") as f:
+            return int(time.time() - float(f.read().split()[0]))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Heartbeat:
+    """
+    Machine health under `machines/{MACHINE_ID}.health`. Each beat collects a
+    flat snapshot and writes only the fields that changed since the last
+    successful write (plus `last_seen`). Nothing changed → no write until the
+    idle keep-alive is due. Beats come every HEARTBEAT_ACTIVE_INTERVAL while a
+    lane runs, HEARTBEAT_IDLE_INTERVAL otherwise, and immediately on lane or
+    serial events.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.sent = {}
+        self.last_write = 0
+        self.static = {
+            "app_version": app_version(),
+            "app_started_at": int(time.time()),
+            "boot_at": read_boot_time(),
+        }
+        self._wakeup = None
+
+    def collect(self):
+        engine = self.app.engine
+        link = engine.serial_link
+        disk = shutil.disk_usage(os.path.dirname(os.path.abspath(__file__)))
+        health = dict(self.static)
+        health.update({
+            "online": self.app.online,
+            "serial": link.state,
+            "serial_port": link.port_path or "",
+            "cpu_temp_c": read_cpu_temperature(),
+            "disk_free_mb": disk.free // (1 << 20) // HEARTBEAT_DISK_STEP_MB * HEARTBEAT_DISK_STEP_MB,
+        })
+        for lane_key, lane in engine.lanes.items():
+            health[f"lanes.{lane_key}.running"] = lane.running
+            health[f"lanes.{lane_key}.remaining"] = lane.remaining
+            health[f"lanes.{lane_key}.credit"] = lane.coins
+            health[f"lanes.{lane_key}.relay"] = engine.relays.expected[lane_key]
+            health[f"lanes.{lane_key}.relay_confirmed"] = engine.relays.is_confirmed(lane_key)
+        step = HEARTBEAT_WRITES_STEP_KB
+        for subsystem, counter in wear.snapshot().items():
+            health[f"sd_writes_kb.{subsystem}"] = counter["bytes"] // 1024 // step * step
+        device = process_device_write_bytes()
+        if device is not None:
+            health["sd_writes_kb.device"] = device // 1024 // step * step  # what actually reached the block layer
+        return health
+
+    def delta(self, health):
+        return {k: v for k, v in health.items() if k not in self.sent or self.sent[k] != v}
+
+    @staticmethod
+    def nest(flat):
+        """{"lanes.L.running": True} → {"lanes": {"L": {"running": True}}} for a merge write."""
+        out = {}
+        for path, value in flat.items():
+            node = out
+            *parents, leaf = path.split(".")
+            for key in parents:
+                node = node.setdefault(key, {})
+            node[leaf] = value
+        return out
+
+    def interval(self):
+        engine = self.app.engine
+        if any(lane.running for lane in engine.lanes.values()):
+            return HEARTBEAT_ACTIVE_INTERVAL
+        return HEARTBEAT_IDLE_INTERVAL
+
+    def beat(self):
+        """Collect and write the delta (blocking; runs on the executor)."""
+        if db is None or not self.app.online:
+            return
+        health = self.collect()
+        changed = self.delta(health)
+        if not changed and time.time() - self.last_write < HEARTBEAT_IDLE_INTERVAL:
+            return
+
+        fields = self.nest(changed)
+        fields["last_seen"] = firestore.SERVER_TIMESTAMP
+        try:
+            db.collection("machines").document(MACHINE_ID).set({"health": fields}, merge=True)
+        except Exception as e:
+            safe_log("warning",f"Heartbeat failed: {e}")
+            return
+        self.sent.update(changed)
+        self.last_write = time.time()
+        safe_log("debug",f"Heartbeat sent ({len(changed)} changed fields)")
+
+    async def run(self):
+        """Supervised service: beat, then sleep for the adaptive interval or until woken."""
+        self._wakeup = asyncio.Event()
+        while True:
+            await self.app.core.run_blocking(self.beat)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def request(self, *args):
+        """Beat now (any thread); bursts of events collapse into one write."""
+        self.app.core.call_soon(self._wake)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+# --------------------------
+# Remote Commands
+# --------------------------
+class CommandProcessor:
+    """
+    Commands from `machines/{MACHINE_ID}/commands`, one document each:
+
+        {"type": "stop_lane", "args": {"lane": "L"}, "idempotency_key": "...", "created_at": ...}
+
+    Handlers are looked up in a registry (`register`). Every command is
+    claimed in the local store under its idempotency key (default: the
+    document id) before it runs, so a listener re-attach or a retried write
+    never executes it twice. Commands run strictly one after another in
+    `created_at` order on a small dedicated executor, so a burst cannot take
+    threads from serial I/O, sync or the UI. When the queue overflows, the
+    listener stops queueing until it has drained and the commands left in
+    Firestore have been re-read, so a deferred command never runs after a
+    newer one. Results go to the store outbox and are written back to
+    `command_results` in batches.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.handlers = {}
+        self.executor = ThreadPoolExecutor(max_workers=COMMAND_WORKERS, thread_name_prefix="command")
+        self.queue = None
+        self.commands_ref = None
+        self.deferred = 0  # commands the listener left in Firestore since the queue overflowed
+
+        self.register(self.restart_device, "restart_device", "restart_pi", "reboot")
+        self.register(self.restart_app, "restart_app", "app_restart")
+        self.register(self.shutdown, "shutdown", "poweroff")
+        self.register(self.set_price, "set_price")
+        self.register(self.stop_lane, "stop_lane")
+        self.register(self.pull_logs, "pull_logs")
+        self.register(self.rotate_credentials, "rotate_credentials")
+        self.register(self.run_diagnostics, "run_diagnostics", "diagnostics")
+        self.register(self.force_sync, "force_sync")
+
+    def register(self, handler, name, *aliases):
+        """`handler(args) -> dict` runs on the command executor; raise to report an error."""
+        for key in (name,) + aliases:
+            self.handlers[key] = handler
+
+    # --------------------------
+    # Listener → ordered queue
+    # --------------------------
+    async def listen(self):
+        """Supervised service: keep the Firestore listener attached and run queued commands in order."""
+        if db is None:
+            safe_log("warning","Firestore not initialized — skipping command listener.")
+            return
+
+        self.commands_ref = db.collection("machines").document(MACHINE_ID).collection("commands")
+        self.queue = asyncio.Queue(maxsize=COMMAND_QUEUE_LIMIT)
+        core = self.app.core
+        core.supervise("command-dispatch", self.dispatch)
+        core.every("command-results", COMMAND_RESULT_FLUSH, self.flush_results)
+
+        def on_snapshot(col_snapshot, changes, read_time):
+            added = [c.document for c in changes if c.type.name == "ADDED"]
+            # Oldest first; a re-attach re-delivers everything still pending
+            added.sort(key=self.command_order)
+            for doc in added:
+                core.call_soon(self._enqueue, doc.id, doc.to_dict() or {})
+
+        # 🔁 Re-attach every 5 minutes in case Firestore drops silently,
+        #    unsubscribing the previous watch so commands are not delivered twice
+        watch = None
+        try:
+            while True:
+                try:
+                    if watch is not None:
+                        await core.run_blocking(watch.unsubscribe)
+                        watch = None
+                    safe_log("info","📡 Attaching Firestore command listener...")
+                    watch = await core.run_blocking(self.commands_ref.on_snapshot, on_snapshot)
+                    safe_log("info","🔥 Firestore command listener started successfully.")
+                    await asyncio.sleep(300)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    safe_log("error",f"❌ Failed to attach Firestore listener: {e}")
+                    safe_log("info","🔁 Retrying listener in 10 seconds...")
+                    await asyncio.sleep(10)
+        finally:
+            if watch is not None:
+                try:
+                    watch.unsubscribe()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def command_order(doc):
+        """Sort key: (epoch seconds of `created_at`, else of the document's create time, doc id)."""
+        created = (doc.to_dict() or {}).get("created_at")
+        try:
+            when = float(created)
+        except (TypeError, ValueError):
+            try:
+                when = created.timestamp()  # Firestore timestamp / datetime
+            except AttributeError:
+                when = doc.create_time.timestamp() if doc.create_time is not None else 0.0
+        return when, doc.id
+
+    def _enqueue(self, doc_id, cmd):
+        if self.deferred:
+            # Older commands are waiting in Firestore; this one is re-read after them
+            self.deferred += 1
+            return
+        try:
+            self.queue.put_nowait((doc_id, cmd))
+        except asyncio.QueueFull:
+            self.deferred = 1
+            safe_log("warning",f"Command queue full — '{doc_id}' and newer commands deferred.")
+
+    async def reload_deferred(self):
+        """Queue drained after an overflow: re-read the pending commands, oldest first."""
+        dropped = self.deferred
+        docs = await self.app.core.run_blocking(lambda: list(self.commands_ref.stream()))
+        if self.deferred != dropped:
+            return  # more arrived while reading; read again
+        self.deferred = 0
+        safe_log("info",f"📥 Re-reading {len(docs)} deferred command(s).")
+        for doc in sorted(docs, key=self.command_order):
+            self._enqueue(doc.id, doc.to_dict() or {})
+
+    async def dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.deferred and self.queue.empty():
+                try:
+                    await self.reload_deferred()
+                except Exception as e:
+                    safe_log("warning",f"Deferred commands not re-read: {e}")
+                    await asyncio.sleep(10)
+                continue
+            doc_id, cmd = await self.queue.get()
+            await loop.run_in_executor(self.executor, self.execute, doc_id, cmd)
+
+    # --------------------------
+    # Execution
+    # --------------------------
+    def execute(self, doc_id, cmd):
+        cmd_type = str(cmd.get("type", "")).lower().strip()
+        key = str(cmd.get("idempotency_key") or doc_id)
+        safe_log("info",f"📥 Firestore command received: {cmd_type} ({key})")
+
+        if not store.claim_command(key, cmd_type):
+            self._delete(doc_id)
+            safe_log("info",f"Command '{key}' already processed — ignored.")
+            return
+
+        # ✅ Always delete the command FIRST (a reboot must not loop)
+        self._delete(doc_id)
+
+        handler = self.handlers.get(cmd_type)
+        started = time.time()
+        if handler is None:
+            status, result = "unknown", {}
+            safe_log("info",f"⚠️ Unknown command '{cmd_type}' ignored.")
+        else:
+            try:
+                status, result = "ok", handler(cmd.get("args") or {}) or {}
+            except Exception as e:
+                status, result = "error", {"error": str(e)}
+                safe_log("error",f"⚠️ Command execution failed: {e}")
+
+        store.outbox_put("command_result", {
+            "key": key, "type": cmd_type, "status": status, "result": result,
+            "started_at": started, "finished_at": time.time(),
+        })
+        self.app.core.call_soon(self._request_flush)
+
+    def _delete(self, doc_id):
+        try:
+            self.commands_ref.document(doc_id).delete()
+        except Exception as e:
+            safe_log("warning",f"Could not delete command '{doc_id}': {e}")
+
+    def _request_flush(self):
+        self.app.core.submit(self.flush_results)
+
+    def flush_results(self):
+        """Write pending results to machines/{MACHINE_ID}/command_results in one batch."""
+        if db is None or not self.app.online:
+            return
+        pending = store.outbox_batch(limit=COMMAND_RESULT_BATCH, kind="command_result")
+        if not pending:
+            return
+        results_ref = db.collection("machines").document(MACHINE_ID).collection("command_results")
+        batch = db.batch()
+        for _, _, payload, _ in pending:
+            batch.set(results_ref.document(payload["key"]), payload)
+        try:
+            batch.commit()
+        except Exception as e:
+            store.outbox_retry([row[0] for row in pending])
+            safe_log("warning",f"Command results not written: {e}")
+            return
+        store.outbox_ack([row[0] for row in pending])
+
+    def on_ui(self, fn, *args):
+        """Run `fn` on the Kivy thread and wait for its result."""
+        done = threading.Event()
+        box = {}
+
+        def call():
+            try:
+                box["result"] = fn(*args)
+            except Exception as e:
+                box["error"] = e
+            done.set()
+
+        self.app.core.post_ui(call)
+        if not done.wait(COMMAND_UI_TIMEOUT):
+            raise TimeoutError("UI thread did not respond")
+        if "error" in box:
+            raise box["error"]
+        return box.get("result")
+
+    # --------------------------
+    # Handlers
+    # --------------------------
+    @staticmethod
+    def _system(*argv):
+        subprocess.Popen(["/usr/bin/sudo", *argv], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def restart_device(self, args):
+        safe_log("info","⚙️ Restart device command detected — rebooting Raspberry Pi...")
+        self._system("reboot")
+
+    def restart_app(self, args):
+        safe_log("info","🔄 Restart App command detected — restarting via systemd...")
+        self._system("systemctl", "restart", "carwash.service")
+
+    def shutdown(self, args):
+        safe_log("info","🛑 Shutdown command detected — powering off...")
+        self._system("shutdown", "now")
+
+    def set_price(self, args):
+        """
+        args: any of water_timer, foaming_timer, pricing_rules. Goes through
+        RemoteConfig like a pushed document, so it waits for the lanes to be
+        idle; the result says whether it was applied or deferred.
+        """
+        remote = self.app.remote_config
+        remote.on_command(args)
+        outcome = Future()
+        self.app.core.call_soon(lambda: outcome.set_result(remote.apply_pending()))
+        status = outcome.result(COMMAND_UI_TIMEOUT) or "applied"
+        if status == "rejected":
+            raise ValueError("settings rejected — see the machine log")
+        return {"status": status, "settings": dict(args)}
+
+    def stop_lane(self, args):
+        lane_key = str(args.get("lane", "")).upper()
+        if lane_key not in ("L", "R"):
+            raise ValueError(f"unknown lane {lane_key!r}")
+        self.on_ui(self.app.stop_lane, lane_key)
+        return {"lane": lane_key}
+
+    def pull_logs(self, args):
+        lines = max(1, min(int(args.get("lines", 200)), COMMAND_LOG_LINES))
+        try:
+            out = subprocess.run(
+                ["journalctl", "-u", "carwash.service", "-n", str(lines), "--no-pager"],
+                capture_output=True, text=True, timeout=10,
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            out = ""
+        if not out:
+            # Not running under systemd: the app's own log, spooled lines included
+            out = "".join(disk.tail(LOG_FILE, COMMAND_LOG_BYTES).splitlines(True)[-lines:])
+        return {"log": out[-COMMAND_LOG_BYTES:]}
+
+    def rotate_credentials(self, args):
+        """Re-issue the licence token from a fresh authorized_machines lookup (kept if offline)."""
+        if db is None or not self.app.online:
+            raise RuntimeError("offline — cached licence token kept")
+        doc = db.collection("authorized_machines").document(MACHINE_ID).get()
+        self.app.licence.issue(doc.exists)
+        if not doc.exists:
+            safe_log("error",f"❌ MACHINE_ID '{MACHINE_ID}' NOT FOUND in authorized_machines!")
+            self.app.core.post_ui(self.app.show_unauthorized_popup)
+        return {"authorized": doc.exists, "licence": self.app.licence.status()}
+
+    def run_diagnostics(self, args):
+        engine = self.app.engine
+        return {
+            "health": self.app.heartbeat.collect(),
+            "relay_latency": engine.relay_latency.summary(),
+            "totals": engine.ledger.totals(),
+            "settings": self.app.settings.snapshot(),
+            "services": sorted(name for name, t in self.app.core.tasks.items() if not t.done()),
+        }
+
+    def force_sync(self, args):
+        self.app.request_sync()
+        self.app.heartbeat.request()
+        return {}
+
+# --------------------------
+# Screens & UI Classes
+# --------------------------
+class IdleTracker:
+    """
+    App-wide inactivity: every touch stamps a monotonic time, and one
+    low-frequency check compares it with the current screen's `idle_timeout`
+    (seconds; None = the screen never times out). A screen change, or the
+    machine being busy (see CarwashApp.update_busy), counts as activity.
+    """
+
+    def __init__(self, app, interval=IDLE_CHECK_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.last_activity = time.monotonic()
+        self._event = None
+
+    def start(self):
+        Window.bind(on_touch_down=self.touched)
+        self.app.root.ids.sm.bind(current=self.touched)
+        self._event = Clock.schedule_interval(self.check, self.interval)
+
+    def stop(self):
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+
+    def touched(self, *args):
+        self.last_activity = time.monotonic()
+
+    def check(self, dt):
+        now = time.monotonic()
+        if self.app.busy:
+            self.last_activity = now
+            return
+        sm = self.app.root.ids.sm
+        timeout = getattr(sm.current_screen, "idle_timeout", None)
+        if timeout is None or now - self.last_activity < timeout:
+            return
+
+        self.app.last_screen_before_video = sm.current
+        safe_log("info",f"No touch for {timeout}s → switching to video from {sm.current}")
         sm.current = "video"
 
-class VideoScreen(Screen, InactivityMixin):
+class VideoScreen(Screen):
+    """
+    Attract loop: plays the promo playlist (app.attract) until the screen is
+    touched. Two Video widgets take turns — while one plays, the other has
+    the next clip opened and paused on its first frame, so a clip change is
+    a swap rather than a cold open. A poster (the clip's first frame,
+    decoded once) covers the screen until the playing video has a texture.
+    With no promos cached the bundled intro plays once, as before.
+    """
+    idle_timeout = None  # closes itself when the playlist ends or on a touch
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._is_closing = False
@@ -329,6 +1049,78 @@ class VideoScreen(Screen, InactivityMixin):
         self._video_started = False
         self._video_already_playing = False
         self._last_video_state = None
+        self.front_video = None  # playing
+        self.back_video = None   # next clip, opened and paused
+
+    def on_kv_post(self, base_widget):
+        self.front_video = self.ids.intro_video
+        self.back_video = self.ids.next_video
+        for video in (self.front_video, self.back_video):
+            video.fbind("loaded", self._on_video_loaded)
+
+    def _on_video_loaded(self, video, loaded):
+        if not loaded:
+            return
+        if video is self.front_video:
+            self.ids.poster.opacity = 0
+        elif video.state == "play":
+            # Pre-opened clip has its first frame: hold it there, rewound, until advance()
+            video.state = "pause"
+            video.seek(0)
+
+    def show_poster(self, clip):
+        texture = App.get_running_app().attract.poster_texture(clip)
+        poster = self.ids.poster
+        if texture is not None:
+            poster.texture = texture
+        poster.opacity = 1 if texture is not None else 0
+
+    def preload_next(self):
+        """
+        Open the upcoming clip on the hidden player and pull its file into the
+        page cache. The ffpyplayer provider only opens a file on play(), so
+        the clip starts muted and hidden and _on_video_loaded pauses it on its
+        first frame.
+        """
+        app = App.get_running_app()
+        if not app.attract.looping:
+            return
+        clip = app.attract.peek()
+        app.core.submit(warm_file, clip)
+        back = self.back_video
+        back.unload()  # the previous clip's player, and `loaded` so the new one reports in
+        back.opacity = 0
+        back.volume = 0
+        back.options = {"eos": "stop"}
+        back.state = "play"
+        back.source = ""
+        back.source = clip  # opens on the next frame, playing because of the state above
+
+    def advance(self):
+        """Current clip ended: bring up the pre-opened next one and preload the one after."""
+        app = App.get_running_app()
+        if not app.attract.looping:
+            safe_log("info","Intro video finished playing - closing screen")
+            self.safe_auto_close_screen()
+            return False
+
+        clip = app.attract.next_clip()
+        front, back = self.front_video, self.back_video
+        if back.source != clip:  # playlist changed since the preload
+            back.unload()
+            back.options = {"eos": "stop"}
+            back.source = clip
+        if not back.loaded:
+            self.show_poster(clip)
+        back.volume = 1
+        back.state = "play"
+        back.opacity = 1
+        front.state = "stop"
+        front.opacity = 0
+        self.front_video, self.back_video = back, front
+        self._last_video_state = "play"
+        self.preload_next()
+        return True
 
     def on_enter(self):
         """Safe video screen entry with crash protection"""
@@ -361,7 +1153,7 @@ class VideoScreen(Screen, InactivityMixin):
     def _is_video_already_playing(self):
         """Detect if video is already playing to prevent conflicts"""
         try:
-            video = self.ids.intro_video
+            video = self.front_video
             if not video:
                 return False
 
@@ -426,7 +1218,7 @@ class VideoScreen(Screen, InactivityMixin):
             return  # Don't start if we're already closing or video is playing
 
         try:
-            video = self.ids.intro_video
+            video = self.front_video
             if not video:
                 safe_log("warning","Video widget not found")
                 self.safe_auto_close_screen()
@@ -440,17 +1232,24 @@ class VideoScreen(Screen, InactivityMixin):
                 self.safe_auto_close_screen()
                 return
 
-            # Reset video to beginning to ensure clean start
-            try:
-                if hasattr(video, 'seek'):
-                    video.seek(0)
-            except:
-                pass
+            clip = App.get_running_app().attract.next_clip()
+            self.show_poster(clip)
+            if video.source != clip:
+                video.source = clip
+            else:
+                # Reset video to beginning to ensure clean start
+                try:
+                    if hasattr(video, 'seek'):
+                        video.seek(0)
+                except:
+                    pass
 
+            video.opacity = 1
             video.state = "play"
             video.options = {"eos": "stop"}
             self._video_started = True
             self._last_video_state = 'play'
+            self.preload_next()
 
         except Exception as e:
             safe_log("error",f"Video start failed: {e}")
@@ -479,7 +1278,7 @@ class VideoScreen(Screen, InactivityMixin):
             return False
 
         try:
-            video = self.ids.intro_video
+            video = self.front_video
             if not video or not hasattr(video, "state"):
                 safe_log("warning","Video widget unavailable in end check")
                 self.safe_auto_close_screen()
@@ -501,9 +1300,7 @@ class VideoScreen(Screen, InactivityMixin):
             )
 
             if video_finished:
-                safe_log("info","Intro video finished playing - closing screen")
-                self.safe_auto_close_screen()
-                return False
+                return self.advance()
 
             # Safety check: if video stopped unexpectedly but we think it should be playing
             if (current_state == "stop" and
@@ -634,15 +1431,7 @@ class VideoScreen(Screen, InactivityMixin):
 
             # Ensure we're not already on the target screen
             if sm.current != screen_name:
-                sm.current = screen_name
-
-                # Restart inactivity timer if applicable
-                try:
-                    current_screen = sm.get_screen(screen_name)
-                    if isinstance(current_screen, InactivityMixin):
-                        current_screen.start_inactivity_timer()
-                except:
-                    pass
+                sm.current = screen_name  # the idle tracker restarts its count on screen changes
 
             safe_log("info",f"Successfully navigated to {screen_name}")
 
@@ -678,6 +1467,11 @@ class VideoScreen(Screen, InactivityMixin):
         try:
             self._is_closing = True
             self.safe_cleanup_events()
+            # Release both decoders; the playlist position is kept for the next visit
+            self.front_video.state = "stop"
+            self.back_video.source = ""  # closes its decoder; preload_next opens it again
+            self.back_video.opacity = 0
+            self.ids.poster.opacity = 0
             safe_log("info","Video screen safely left")
         except Exception as e:
             safe_log("error",f"Video screen leave cleanup failed: {e}")
@@ -694,6 +1488,7 @@ class ServiceLane(BoxLayout):
     lane_name = StringProperty("")
     service_type = StringProperty("")
     lane_key = StringProperty("")
+    rate_text = StringProperty("1 minute")  # time per ₱5
 
     def play_video_screen(self):
         app = App.get_running_app()
@@ -708,14 +1503,6 @@ class ServiceLane(BoxLayout):
         popup.open()
 
 
-# ---------- OS DETECTION ----------
-def is_linux():
-    return platform.system().lower() == "linux"
-
-def is_windows():
-    return platform.system().lower() == "windows"
-
-
 # ---------- nmcli detection ----------
 _nmcli_path = shutil.which("nmcli")
 
@@ -937,7 +1724,28 @@ def toggle_wifi():
     except Exception as e:
         return False, str(e)
 
-class WifiPasswordPopup(Popup):
+def forget_current_wifi():
+    ssid = get_current_ssid()
+    if ssid in ("Not connected", ""):
+        return False, "Nothing to forget"
+    return forget_wifi(ssid)
+
+class TrackedPopup(Popup):
+    """
+    Popup that registers with the app while it is open, so "is any popup
+    open?" is a set lookup instead of a walk over Window.children.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.fbind("on_open", self._track, True)
+        self.fbind("on_dismiss", self._track, False)
+
+    def _track(self, is_open, *args):
+        App.get_running_app().popup_state_changed(self, is_open)
+
+
+class WifiPasswordPopup(TrackedPopup):
     ssid = StringProperty("")
 
     def connect(self, *_):
@@ -947,14 +1755,10 @@ class WifiPasswordPopup(Popup):
             return
 
         self.ids.status_label.text = "Connecting..."
-        threading.Thread(target=self._thread, args=(password,), daemon=True).start()
+        App.get_running_app().core.submit(connect_wifi, self.ssid, password, on_done=self._done)
 
-    def _thread(self, pwd):
-        ok, msg = connect_wifi(self.ssid, pwd)
-        Clock.schedule_once(lambda dt: self._done(ok, msg))
-
-    @mainthread
-    def _done(self, ok, msg):
+    def _done(self, result):
+        ok, msg = result
         self.ids.status_label.text = msg
         if ok:
             Clock.schedule_once(lambda dt: self.dismiss(), 1.2)
@@ -964,55 +1768,54 @@ class WifiScreen(Screen):
     wifi_status_text = StringProperty("[b]Wi-Fi: Checking...[/b]")
     wifi_on = BooleanProperty(False)
 
-    scanning = False
-    scan_event = None
-
     # --------------------------------------------
     def on_pre_enter(self):
-        self.update_wifi_status()
-        self.update_current_network()
-        self.start_realtime_scan()
+        # Scans and status polls run on the service core while this screen is shown
+        App.get_running_app().core.supervise("wifi-screen", self.wifi_service)
 
-        Clock.schedule_interval(lambda dt: self.update_wifi_status(), 3)
-        Clock.schedule_interval(lambda dt: self.update_current_network(), 4)
+    def on_leave(self):
+        App.get_running_app().core.cancel("wifi-screen")
+
+    async def wifi_service(self):
+        core = App.get_running_app().core
+        tick = 0
+        while True:
+            if tick % 2 == 0:
+                self.update_wifi_status()
+                self.update_current_network()
+            networks = await core.run_blocking(scan_wifi)
+            core.post_ui(self._update_scan, networks)
+            tick += 1
+            await asyncio.sleep(WIFI_SCAN_INTERVAL)
 
     # --------------------------------------------
     def update_wifi_status(self):
-        state = wifi_is_on()
+        App.get_running_app().core.submit(wifi_is_on, on_done=self._apply_wifi_status)
+
+    def _apply_wifi_status(self, state):
         self.wifi_on = state
         self.wifi_status_text = "[b]Wi-Fi: ON[/b]" if state else "[b]Wi-Fi: OFF[/b]"
 
     # --------------------------------------------
     def toggle_wifi_button(self):
-        ok, msg = toggle_wifi()
+        App.get_running_app().core.submit(toggle_wifi, on_done=self._after_action)
+
+    def _after_action(self, result):
+        ok, msg = result
         self.update_wifi_status()
         self.update_current_network()
         self._popup(msg)
 
     # --------------------------------------------
     def update_current_network(self):
-        ssid = get_current_ssid()
+        App.get_running_app().core.submit(get_current_ssid, on_done=self._apply_current_network)
+
+    def _apply_current_network(self, ssid):
         color = (0,1,0,1) if ssid != "Not connected" else (1,0.3,0.3,1)
         self.ids.current_network_label.text = f"[b]Connected:[/b] {ssid}"
         self.ids.current_network_label.color = color
 
     # --------------------------------------------
-    def start_realtime_scan(self):
-        if not self.scan_event:
-            self.scan_event = Clock.schedule_interval(self._perform_scan, 1.5)
-
-    def _perform_scan(self, dt):
-        if self.scanning:
-            return
-        self.scanning = True
-        threading.Thread(target=self._scan_thread, daemon=True).start()
-
-    def _scan_thread(self):
-        networks = scan_wifi()
-        Clock.schedule_once(lambda dt: self._update_scan(networks))
-        self.scanning = False
-
-    @mainthread
     def _update_scan(self, networks):
         if not networks:
             self.ids.rv.data = [{"text": "[b]No networks found[/b]"}]
@@ -1033,18 +1836,11 @@ class WifiScreen(Screen):
 
     # --------------------------------------------
     def forget_network(self):
-        ssid = get_current_ssid()
-        if ssid in ("Not connected", ""):
-            self._popup("Nothing to forget")
-            return
-
-        ok, msg = forget_wifi(ssid)
-        self.update_current_network()
-        self._popup(msg)
+        App.get_running_app().core.submit(forget_current_wifi, on_done=self._after_action)
 
     # --------------------------------------------
     def _popup(self, msg):
-        popup = Popup(
+        popup = TrackedPopup(
             title="",
             size_hint=(0.5,0.25),
             auto_dismiss=True
@@ -1094,20 +1890,19 @@ class TimerSettingsScreen(Screen):
             self.ids.foaming_timer_value.text = f"{self.temp_foam}s"
 
     def save_settings(self):
-        """Save temp values to JSON + update app.settings"""
+        """Validate and save temp values (subscribers refresh the menu)"""
         app = App.get_running_app()
 
-        # Update app settings
-        app.settings["water_timer"] = self.temp_water
-        app.settings["foaming_timer"] = self.temp_foam
-
-        # Save JSON
-        save_settings(app.settings)
+        try:
+            app.settings.update({"water_timer": self.temp_water, "foaming_timer": self.temp_foam})
+        except (ValueError, OSError) as e:
+            safe_log("error", f"Timer settings not saved: {e}")
+            return
 
         safe_log("info", f"Timer settings saved: Water={self.temp_water}s, Foaming={self.temp_foam}s")
 
         # OPTIONAL: Confirm popup
-        popup = Popup(
+        popup = TrackedPopup(
             title="Saved",
             content=Label(text="Timer settings updated successfully!"),
             size_hint=(0.4, 0.25),
@@ -1117,10 +1912,13 @@ class TimerSettingsScreen(Screen):
         # Return to settings main page
         Clock.schedule_once(lambda dt: setattr(app.root.ids.sm, "current", "timer_settings"), 0.5)
 
-class TapToStartScreen(Screen, InactivityMixin):
-    pass
+class SplashScreen(Screen):
+    idle_timeout = None  # shown while assets preload; leaves by itself (CarwashApp.end_splash)
+
+class TapToStartScreen(Screen):
+    idle_timeout = 20  # seconds without a touch before the attract video
 
-class ArduinoDisconnectedPopup(Popup):
+class ArduinoDisconnectedPopup(TrackedPopup):
     """Popup shown when Arduino is not connected in the MenuScreen."""
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -1134,15 +1932,23 @@ class ArduinoDisconnectedPopup(Popup):
         app.send_serial_command("BEEP_ON")
         Clock.schedule_once(lambda dt: app.send_serial_command("BEEP_OFF"), 0.3)
 
-class MenuScreen(Screen,InactivityMixin):
+class MenuScreen(Screen):
+    idle_timeout = 20  # seconds without a touch (and no popup, credit or running lane)
+
     def refresh_menu_after_timer_change(self):
+        """Show the current time per ₱5 on both lane cards."""
         app = App.get_running_app()
-        # No direct timer labels require update now, but this prevents stale UI bugs
-        safe_log("info", "Menu refreshed after timer update")
+        self.ids.lane_left.rate_text = format_duration(app.get_timer_for_lane("L"))
+        self.ids.lane_right.rate_text = format_duration(app.get_timer_for_lane("R"))
 
     def on_enter(self):
+        self.refresh_menu_after_timer_change()
+        app = App.get_running_app()
+        for lane_key in ("L", "R"):
+            app.set_lane_labels(lane_key)  # credit restored at startup shows immediately
         # Start the always_play video when entering menu
         Clock.schedule_once(self.start_always_play_video, 0.5)
+        self.ids.car_frame_carousel.start()
         Clock.schedule_once(lambda dt: self.check_arduino_status(), 0.5)
 
     def start_always_play_video(self, dt):
@@ -1192,7 +1998,8 @@ class MenuScreen(Screen,InactivityMixin):
             safe_log("warning",f"Could not switch to default video: {e}")
 
     def on_leave(self):
-        """Pause video when leaving menu screen"""
+        """Pause video and promo frames when leaving menu screen"""
+        self.ids.car_frame_carousel.stop()
         try:
             always_play_video = self.ids.always_play
             if always_play_video and hasattr(always_play_video, 'state'):
@@ -1204,33 +2011,25 @@ class MenuScreen(Screen,InactivityMixin):
     def check_arduino_status(self):
         app = App.get_running_app()
 
-        # ✅ Try to reconnect once before showing popup
-        app.connect_serial()
-
-        if not app.serial_port or not getattr(app.serial_port, "is_open", False):
+        # Reconnection is handled by the serial link's hotplug watcher
+        if not app.serial_link.connected and not app.simulation:
             self.show_arduino_popup()
 
     def show_arduino_popup(self):
+        app = App.get_running_app()
+        if app.arduino_popup:
+            return  # already showing
+
         popup = ArduinoDisconnectedPopup()
         popup.open()
+        app.arduino_popup = popup  # closed by CarwashApp.on_serial_connected
         safe_log("info","⚠️ Arduino not connected — popup shown.")
 
-        app = App.get_running_app()
         app.send_serial_command("BEEP_ON")
         Clock.schedule_once(lambda dt: app.send_serial_command("BEEP_OFF"), 0.3)
 
-        # Auto close once
-        def auto_close(dt):
-            if app.serial_port and getattr(app.serial_port, "is_open", False):
-                popup.dismiss()
-                safe_log("info","✅ Arduino reconnected — popup closed automatically.")
-                return False
-            return True
-
-        Clock.schedule_interval(auto_close, 2)
-
 # Insert Coin Popup
-class InsertCoinPopup(Popup):
+class InsertCoinPopup(TrackedPopup):
     content_box = ObjectProperty(None)  # reference to BoxLayout in KV
 
     def __init__(self, lane_key="L", **kwargs):
@@ -1256,21 +2055,13 @@ class InsertCoinPopup(Popup):
         lane_name = "Water" if self.lane_key == "L" else "Foaming"
         lane = app.left_lane if self.lane_key == "L" else app.right_lane
 
-        # ✅ Update labels immediately
+        # ✅ Labels redraw in the next frame on their own (property change → canvas dirty)
         if "lane_label" in self.ids:
             self.ids.lane_label.text = f"Lane: {lane_name}"
-            self.ids.lane_label.texture_update()
 
         if "coin_label" in self.ids:
             # Refresh to show the current total coins when popup opens
-            self.ids.coin_label.text = f"Credit's: {lane.coins}"
-            self.ids.coin_label.texture_update()
-
-            # ✅ Extra step (for Raspberry Pi)
-            # Schedule a redraw on the next frame so the Pi GPU catches the update
-            from kivy.base import EventLoop
-            Clock.schedule_once(lambda dt: EventLoop.idle(), 0)
-            Clock.schedule_once(lambda dt: self.ids.coin_label.canvas.ask_update(), 0.05)
+            self.ids.coin_label.text = str(lane.coins)
 
         # ✅ Restart countdown timer on every open
         self.start_countdown()
@@ -1298,21 +2089,16 @@ class InsertCoinPopup(Popup):
         self.ids.countdown_label.color = [0.6, 0.9, 1, 1]
         self.countdown_event = Clock.schedule_interval(self._update_countdown, 1)
 
-    @mainthread
     def on_coin_inserted(self):
-        """Triggered by serial message; updates popup label and restarts timer safely on Pi."""
+        """CoinAccepted on the UI thread (see CarwashApp.on_coin_accepted): new credit, countdown restarted."""
         app = App.get_running_app()
         lane = app.left_lane if self.lane_key == "L" else app.right_lane
 
         # --- Update label directly ---
+        # DigitLabel swaps its glyph rectangles here; changed canvas instructions
+        # make the window redraw in the next frame, no extra event-loop pass needed
         if "coin_label" in self.ids:
-            self.ids.coin_label.text = f"Credit's: {lane.coins}"
-            self.ids.coin_label.texture_update()
-
-            # ✅ Force redraw (needed for Raspberry Pi GPU)
-            from kivy.base import EventLoop
-            Clock.schedule_once(lambda dt: EventLoop.idle(), 0.02)
-            Clock.schedule_once(lambda dt: self.ids.coin_label.canvas.ask_update(), 0.05)
+            self.ids.coin_label.text = str(lane.coins)
 
         # --- Restart countdown timer safely ---
         if hasattr(self, "countdown_event") and self.countdown_event:
@@ -1321,7 +2107,7 @@ class InsertCoinPopup(Popup):
 
         # --- Pulse animation feedback ---
         self.animate_label_color([0.0, 0.9, 0.9, 1])
-        anim = Animation(font_size=45, d=0.15) + Animation(font_size=40, d=0.15)
+        anim = Animation(scale=1.125, d=0.15) + Animation(scale=1.0, d=0.15)
         anim.start(self.ids.coin_label)
 
         safe_log("info",f"Popup updated live with {lane.coins} credits")
@@ -1356,10 +2142,10 @@ class InsertCoinPopup(Popup):
         if getattr(app, "active_popup", None) == self:
             app.active_popup = None
 
-        app.send_serial_command("DISABLE_COIN")
+        app.set_coin_input(self.lane_key, False)
         safe_log("info",f"Popup closed lane {self.lane_key} → coin input disabled.")
 
-class ConfirmStopPopup(Popup):
+class ConfirmStopPopup(TrackedPopup):
     def __init__(self, lane_key, **kwargs):
         super().__init__(**kwargs)
         self.lane_key = lane_key
@@ -1498,73 +2284,79 @@ class HoverBoxLayout(BoxLayout, HoverBehavior):
 class MainRoot(BoxLayout):
     pass
 
-# --------------------------
-# Lane State
-# --------------------------
-class LaneState:
-    def __init__(self, lane_key):
-        self.lane_key = lane_key
-        self.remaining = 0
-        self.running = False
-        self.coins = 0
-        self.pending_coin = False
-        self.wait_start = None
-        self.pending_insert = 10
-
-    def add_time(self, secs):
-        self.remaining += int(secs)
-
-    def tick(self):
-        if self.running and self.remaining > 0:
-            self.remaining -= 1
-            if self.remaining <= 0:
-                self.remaining = 0
-                self.running = False
-                return True
-        return False
-
-    def start_wait_for_coin(self):
-        self.pending_coin = True
-        self.wait_start = time.time()
-
-    def check_wait_timeout(self):
-        if self.wait_start is None:
-            self.wait_start = time.time()
-        if self.pending_coin and self.wait_start:
-            if time.time() - self.wait_start > self.pending_insert:
-                self.pending_coin = False
-                self.wait_start = None
-                return True
-        return False
-
-
 # --------------------------
 # Main App
 # --------------------------
 class CarwashApp(App):
+    busy = BooleanProperty(False)  # popup open, lane running or credit left (see update_busy)
+    assets_ready = BooleanProperty(False)  # kv images get their sources once preloaded (asset_manifest.asset)
+
     def build(self):
-        self.settings = load_settings()
-        # ✅ Always defined — prevents crashes and allows rechecking anytime
-        self.serial_port = None
-        self.serial_alive = False
-        self.simulation = False
+        self.open_popups = set()
+        self.settings = SettingsService(store, DEFAULT_SETTINGS, mirror_file=SETTINGS_FILE,
+                                        validators={"pricing_rules": validate_pricing_rules}, writer=disk)
+        self.settings.subscribe(self.on_settings_changed)
+        # ✅ One event loop thread for all background services
+        self.core = ServiceCore()
+        self.core.wake_ui = Clock.create_trigger(self.core.drain_ui_queue, 0)
+        self.core.start()
+        self.core.every("write-behind", WRITE_BEHIND_INTERVAL, disk.flush)
+        self.online = False
+        self.services_started = False
+
+        # ✅ Lanes, coins, relays and the serial link live in the headless engine;
+        #    paid time is checkpointed and restored after a crash or power loss
+        self.engine = VendingEngine(self.settings, core=self.core, ledger=Ledger(store),
+                                    checkpoint=LaneCheckpoint(meter=wear))
+        bus = self.engine.bus
+        bus.subscribe(CoinAccepted, self.on_coin_accepted, mode=DELIVER_UI)
+        bus.subscribe(CoinAccepted, lambda ev: self.request_sync(), mode=DELIVER_ASYNC)
+        for event_type in (LaneStarted, LaneExpired, LaneStopped):
+            bus.subscribe(event_type, self.on_lane_state_changed, mode=DELIVER_UI)
+        bus.subscribe(SerialConnected, lambda ev: self._dismiss_arduino_popup(), mode=DELIVER_UI)
+        for event_type in (CoinAccepted, LaneStarted, LaneExpired, LaneStopped):
+            bus.subscribe(event_type, self.update_busy, mode=DELIVER_UI)
+
+        # ✅ Fleet / per-machine prices from Firestore, applied between wash sessions
+        self.remote_config = RemoteConfig(store, self.settings, self.engine, self.core)
+        for event_type in (LaneExpired, LaneStopped):
+            bus.subscribe(event_type, self.remote_config.apply_pending, mode=DELIVER_ASYNC)
+
+        self.commands = CommandProcessor(self)
+
+        # ✅ Promo clips for the idle screen, cached and verified on disk
+        self.attract = MediaLibrary()
+        self.attract_sync = AttractSync(self.attract, lambda: self.online)
+
+        # ✅ Health heartbeat — sent early when a lane or the Arduino changes state
+        self.heartbeat = Heartbeat(self)
+        for event_type in (LaneStarted, LaneExpired, LaneStopped, SerialConnected, SerialLost):
+            bus.subscribe(event_type, self.heartbeat.request)
+        self.serial_link = self.engine.serial_link
+        self.relays = self.engine.relays
+        self.left_lane = self.engine.left_lane
+        self.right_lane = self.engine.right_lane
+        self.update_busy()  # sessions restored from the checkpoint count as busy
+
+        self.arduino_popup = None
         self.refreshing_popup = False
         self.title = "Carwash Vendo Machine"
-        self.left_lane = LaneState("L")
-        self.right_lane = LaneState("R")
 
         self.root = MainRoot()
         sm = self.root.ids.sm
         sm.transition = FadeTransition(duration=0.4)
-        self.connect_serial()
 
-        # ✅ Automatically check Arduino connection every 3 seconds
-        Clock.schedule_interval(self.check_serial_connection, 3)
-        Clock.schedule_interval(self.update_timers, 1.0)
+        # ✅ Images decode off the UI thread while the splash is up (build/assets manifest)
+        self.preloader = AssetPreloader(self.core)
+        self.preloader.start(on_done=self.end_splash)
+        Clock.schedule_once(lambda dt: self.end_splash(), SPLASH_MAX_SECONDS)
 
-        # Track previous running state to detect changes
-        self.previous_left_running = False
-        self.previous_right_running = False
+        # ✅ One inactivity check for every screen (see each screen's idle_timeout)
+        self.idle = IdleTracker(self)
+        self.idle.start()
+
+        self.engine.start()
+        Clock.schedule_interval(self.update_timers, 1.0)
 
         # Track beep states to avoid repeated beeping
         self.left_lane_beeped = False
@@ -1578,105 +2370,119 @@ class CarwashApp(App):
 
         return self.root
 
+    def end_splash(self):
+        self.assets_ready = True  # also after SPLASH_MAX_SECONDS: images then load as before
+        sm = self.root.ids.sm
+        if sm.current == "splash":
+            sm.current = "tapstart"
+
     def get_timer_for_lane(self, lane_key):
-        if lane_key == "L":
-            return self.settings.get("water_timer", 60)
-        else:
-            return self.settings.get("foaming_timer", 60)
+        return self.engine.get_timer_for_lane(lane_key)
 
     def update_timer_setting(self, lane_key, seconds):
-        if lane_key == "L":
-            self.settings["water_timer"] = seconds
-        else:
-            self.settings["foaming_timer"] = seconds
+        key = "water_timer" if lane_key == "L" else "foaming_timer"
+        self.settings.update({key: seconds})
 
-        save_settings(self.settings)
+    def on_settings_changed(self, changed, source):
+        """Settings subscriber (any thread): recompile prices and refresh what shows them."""
+        if {"water_timer", "foaming_timer", "pricing_rules"} & changed.keys():
+            self.engine.pricing.compile()
+            self.core.post_ui(self._refresh_menu_rates)
+
+    def _refresh_menu_rates(self):
+        sm = self.root.ids.sm
+        if sm.has_screen("menu"):
+            sm.get_screen("menu").refresh_menu_after_timer_change()
 
     def on_start(self):
-        Clock.schedule_interval(lambda dt: wifi_keep_alive(), 10)
+        store.set_device(machine_id=MACHINE_ID, owner_id=OWNER_ID, location=LOCATION, last_boot=int(time.time()))
+        self.core.every("wifi-keepalive", WIFI_KEEPALIVE_INTERVAL, wifi_keep_alive)
+        self.core.supervise("connectivity", self.connectivity_monitor)
+
+        self.licence = LicenceToken(writer=disk)
+        self.licence.migrate_legacy_flag()
 
-        # Delay slightly so UI loads first
-        Clock.schedule_once(lambda dt: self.check_machine_authorized(), 1)
+        # ✅ Offline token check only — the network lookup runs in the background
         ok = self.check_machine_authorized()
+        self.core.every("licence", LICENCE_REFRESH, self.revalidate_licence, initial_delay=0)
 
         if not ok:
-            safe_log("error","Machine unauthorized — system UI frozen.")
+            safe_log("info","No valid licence token yet — waiting for online authorization.")
             return
 
-        # Normal startup
-        self.background_sync_to_firebase()
+        self.start_services()
+
+    def start_services(self):
+        """Normal startup once the machine is known to be authorized."""
+        if self.services_started:
+            return
+        self.services_started = True
         self.start_realtime_sync()
-        threading.Thread(target=self.listen_for_commands, daemon=True).start()
+        self.core.supervise("commands", self.commands.listen)
+        self.core.supervise("remote-config", self.remote_config.watch)
+        self.core.supervise("heartbeat", self.heartbeat.run)
+        self.core.every("attract-sync", ATTRACT_SYNC_INTERVAL, self.attract_sync.sync, initial_delay=60)
+        self.core.every("remote-config-apply", REMOTE_CONFIG_RETRY, self.remote_config.apply_pending,
+                        initial_delay=0, blocking=False)
 
     def check_machine_authorized(self):
-        """Check if MACHINE_ID exists in Firestore authorized_machines.
-           Supports offline mode using locally stored is_authorized flag.
-        """
-        data = {}
-
-        # Load local data (if exists)
-        if os.path.exists(DATA_FILE):
-            try:
-                with open(DATA_FILE, "r") as f:
-                    data = json.load(f)
-            except json.JSONDecodeError:
-                data = {}
-
-        # Default value if missing
-        is_local_auth = data.get("is_authorized", False)
-
+        """Offline check of the cached licence token (no network, no file writes)."""
+        status = self.licence.status()
+        if status == LICENCE_STALE:
+            safe_log("info","Licence token due for revalidation — still honoured offline.")
+        return status in (LICENCE_VALID, LICENCE_STALE)
+
+    def revalidate_licence(self):
+        """Check MACHINE_ID in Firestore authorized_machines and refresh the token (background thread)."""
         try:
             # ───────────────────────────────────────────────
-            # 1️⃣ OFFLINE MODE — NO INTERNET
+            # 1️⃣ FIRESTORE NOT INITIALIZED
             # ───────────────────────────────────────────────
-            if not self.is_connected():
-                safe_log("info","No internet — offline authorization fallback.")
-
-                if not is_local_auth:
-                    Clock.schedule_once(lambda dt: self.show_unauthorized_popup(), 0.3)
-                    return False
-
-                return True  # Allowed because previously authorized offline
+            if db is None:
+                safe_log("warning","Firestore not initialized — using the cached licence token.")
+                self.apply_cached_licence()  # do NOT update token
+                return
 
             # ───────────────────────────────────────────────
-            # 2️⃣ FIRESTORE NOT INITIALIZED
+            # 2️⃣ OFFLINE MODE — NO INTERNET, keep cached token
             # ───────────────────────────────────────────────
-            if db is None:
-                safe_log("warning","Firestore not initialized — skipping authorization.")
-                return True  # allow machine to run but do NOT update local auth
+            if not self.is_connected():
+                if self.check_machine_authorized():
+                    return
+                safe_log("error","Machine unauthorized — system UI frozen.")
+                self.core.post_ui(self.show_unauthorized_popup)
+                return
 
             # ───────────────────────────────────────────────
             # 3️⃣ ONLINE CHECK — FIRESTORE LOOKUP
             # ───────────────────────────────────────────────
             doc = db.collection("authorized_machines").document(MACHINE_ID).get()
+            self.licence.issue(doc.exists)
 
             if not doc.exists:
                 safe_log("error",f"❌ MACHINE_ID '{MACHINE_ID}' NOT FOUND in authorized_machines!")
-
-                # Save local offline block state
-                data["is_authorized"] = False
-                with open(DATA_FILE, "w") as f:
-                    json.dump(data, f, indent=4)
-
-                Clock.schedule_once(lambda dt: self.show_unauthorized_popup(), 0.3)
-                return False
-
-            # ───────────────────────────────────────────────
-            # 4️⃣ AUTHORIZED — Save offline approval
-            # ───────────────────────────────────────────────
-            data["is_authorized"] = True
-            with open(DATA_FILE, "w") as f:
-                json.dump(data, f, indent=4)
+                self.core.post_ui(self.show_unauthorized_popup)
+                return
 
             safe_log("info",f"✅ MACHINE_ID '{MACHINE_ID}' is authorized.")
-            return True
+            self.core.post_ui(self.start_services)
 
         except Exception as e:
-            safe_log("error",f"Authorization check error: {e}")
-            return True  # allow app during unknown error
+            safe_log("error",f"Authorization check error: {e} — using the cached licence token.")
+            self.apply_cached_licence()
+
+    def apply_cached_licence(self):
+        """No answer from Firestore: start only if the cached token still says authorized."""
+        if self.check_machine_authorized():
+            self.core.post_ui(self.start_services)
+            return
+        safe_log("error","Machine unauthorized — system UI frozen.")
+        self.core.post_ui(self.show_unauthorized_popup)
 
-    @mainthread
     def show_unauthorized_popup(self):
+        if getattr(self, "unauthorized_popup", None):
+            return  # already frozen
+
         # Main popup container
         layout = BoxLayout(
             orientation="vertical",
@@ -1750,7 +2556,7 @@ class CarwashApp(App):
         layout.add_widget(message)
         layout.add_widget(btn)
 
-        popup = Popup(
+        popup = TrackedPopup(
             title="",
             content=layout,
             size_hint=(0.85, 0.55),
@@ -1762,183 +2568,115 @@ class CarwashApp(App):
         popup.open()
         self.unauthorized_popup = popup
 
-    @mainthread
     def update_popup_coin(self, popup):
-        """Run popup update in main UI thread."""
+        """Run popup update in main UI thread (posted through the service core)."""
         try:
             if popup and hasattr(popup, 'on_coin_inserted'):
                 popup.on_coin_inserted()
         except Exception as e:
             safe_log("warning",f"update_popup_coin error: {e}")
 
-    def start_auto_carousel(self, dt):
-        try:
-            sm = self.root.ids.sm
-            menu = sm.get_screen("menu")
-            carousel = menu.ids.car_frame_carousel
-            Clock.schedule_interval(lambda _: carousel.load_next(), 4)
-        except Exception as e:
-            safe_log("warning",f"Carousel start failed: {e}")
-
     def is_machine_busy(self):
         """Return True if any popup is open, lane running, or credit exists."""
-        popup_open = any(isinstance(w, Popup) and w._window for w in Window.children)
-
-        left_active = bool(self.left_lane.running)
-        right_active = bool(self.right_lane.running)
+        return self.busy
 
-        #  NEW: credit check
-        left_credit = self.left_lane.coins > 0
-        right_credit = self.right_lane.coins > 0
+    def popup_state_changed(self, popup, is_open):
+        """TrackedPopup opened / dismissed (UI thread)."""
+        if is_open:
+            self.open_popups.add(popup)
+        else:
+            self.open_popups.discard(popup)
+        self.update_busy()
 
-        # Logging for clarity
-        safe_log("info",
-            f"[BUSY CHECK] Popup={popup_open}, "
-            f"Left(run={self.left_lane.running}, credit={self.left_lane.coins}), "
-            f"Right(run={self.right_lane.running}, credit={self.right_lane.coins})"
+    def update_busy(self, *args):
+        """Recompute `busy` from the open popups and the two lanes (popup and lane events)."""
+        self.busy = bool(self.open_popups) or any(
+            lane.running or lane.coins > 0 for lane in (self.left_lane, self.right_lane)
         )
 
-        return popup_open or left_active or right_active or left_credit or right_credit
-
-    def process_serial_message(self, message):
-        """Handle serial messages from Arduino — supports live popup update."""
-        if not message or message.startswith("ACK"):
-            return
-
-        parts = message.split(":")
-        if parts[0] == "COIN":
-            try:
-                coin_value = int(parts[1]) if len(parts) > 1 else 5
-            except ValueError:
-                coin_value = 5
-
-            target = getattr(self, "last_interacted_lane", "L")
-            lane = self.left_lane if target == "L" else self.right_lane
+    def on_coin_accepted(self, event):
+        """CoinAccepted (UI thread): update the lane's credit label and the open popup."""
+        self.set_lane_labels(event.lane_key)
 
-            # Only accept coins if popup is waiting
-            if lane.pending_coin:
+        popup = getattr(self, "active_popup", None)
+        self.refreshing_popup = True
+        if popup and isinstance(popup, InsertCoinPopup) and popup.lane_key == event.lane_key:
+            self.update_popup_coin(popup)
+        Clock.schedule_once(lambda dt: setattr(self, "refreshing_popup", False), 0.3)
 
-                # Determine seconds per ₱5 based on lane settings
-                seconds_per_coin = self.get_timer_for_lane(target)
-
-                # Update lane credit & time
-                lane.coins += coin_value
-                time_added = seconds_per_coin * (coin_value // 5)
-                lane.add_time(time_added)
-
-                safe_log("info",
-                         f"💰 Coin inserted lane {target} +₱{coin_value} / +{time_added}s "
-                         f"(rate={seconds_per_coin}s per ₱5)"
-                         )
+    def on_lane_state_changed(self, event):
+        """LaneStarted / LaneExpired / LaneStopped (UI thread)."""
+        lane_key = event.lane_key
+        if lane_key == "L":
+            self.left_lane_beeped = False
+        else:
+            self.right_lane_beeped = False
+        if not isinstance(event, LaneStarted):
+            self.stop_countdown_beep(lane_key)
 
-                lane.wait_start = None
-                self.save_account_data(target, coin_value)
+        self.set_lane_labels(lane_key)
+        self.update_background_video()
 
-                # Update popup if open
-                app = App.get_running_app()
-                popup = getattr(app, "active_popup", None)
-                app.refreshing_popup = True
-
-                if popup and isinstance(popup, InsertCoinPopup) and popup.lane_key == target:
-                    Clock.schedule_once(lambda dt: self.update_popup_coin(popup), 0)
+    def set_lane_labels(self, lane_key):
+        """Refresh one lane's timer, credit and Start/Stop button on the menu screen."""
+        lane = self.left_lane if lane_key == "L" else self.right_lane
+        try:
+            sm = self.root.ids.sm
+            if not sm.has_screen("menu"):
+                return
+            menu = sm.get_screen("menu")
+            timer_label = menu.ids.timer_label_water if lane_key == "L" else menu.ids.timer_label_foaming
+            lane_widget = menu.ids.lane_left if lane_key == "L" else menu.ids.lane_right
 
-                Clock.schedule_once(lambda dt: setattr(app, "refreshing_popup", False), 0.3)
+            timer_label.text = self.format_time(lane.remaining)
+            lane_widget.ids.coin_count.text = str(lane.coins)
 
-                # Debounce to avoid double count
-                Clock.schedule_once(lambda dt: setattr(lane, "pending_coin", True), 0.5)
+            btn = lane_widget.ids.start_stop_btn
+            btn.text = "[b]Stop[/b]" if lane.running else "[b]Start[/b]"
+            if btn.color_instruction:
+                btn.color_instruction.rgba = (1.0, 0.3, 0.3, 1.0) if lane.running else (0.0, 0.592, 0.698, 1.0)
+        except Exception as e:
+            safe_log("warning",f"Lane label update error: {e}")
 
-            else:
-                safe_log("info", f"⚠️ Coin ignored — lane {target} not waiting for coin")
+    def set_coin_input(self, lane_key, enabled, grace=True):
+        """Arm/disarm a lane's coin acceptor and tell the Arduino."""
+        self.engine.set_coin_input(lane_key, enabled, grace=grace)
 
     # --------------------------
     # Serial
     # --------------------------
-    def connect_serial(self, *args):
-        """Try to connect to Arduino."""
-        if serial is None:
-            self.simulation = True
-            safe_log("warning","pyserial not installed — SIMULATION mode.")
-            return
-
-        try:
-            # ✅ If already open, don't reconnect
-            if self.serial_port and getattr(self.serial_port, "is_open", False):
-                safe_log("info","🔌 Arduino already connected — skipping reconnect.")
-                return
-
-            self.serial_port = serial.Serial(SERIAL_PORT, BAUDRATE, timeout=0.1)
-            self.serial_alive = True
-            self.simulation = False
-            self.serial_thread = threading.Thread(target=self.serial_listener, daemon=True)
-            self.serial_thread.start()
+    @property
+    def serial_port(self):
+        return self.serial_link.port
 
-            safe_log("info",f"✅ Arduino connected on {SERIAL_PORT}")
-        except Exception as e:
-            safe_log("warning",f"❌ Arduino connection failed: {e}")
-            self.serial_port = None
-            self.simulation = True
+    @property
+    def simulation(self):
+        return self.engine.simulation
 
-    def check_serial_connection(self, dt):
-        """Continuously check Arduino status and reconnect if lost."""
-        try:
-            # If no port or not open → try reconnect
-            if not self.serial_port or not getattr(self.serial_port, "is_open", False):
-                if not self.simulation:
-                    safe_log("warning","⚠️ Arduino not detected — attempting reconnect...")
-                    self.connect_serial()
-            else:
-                # ✅ If alive, mark as active (restores popup auto-close)
-                if not self.serial_alive:
-                    self.serial_alive = True
-                    safe_log("info","✅ Arduino connection restored.")
-        except Exception as e:
-            safe_log("warning",f"Serial check failed: {e}")
+    def connect_serial(self, *args):
+        """Try to connect to Arduino now (normally the hotplug watcher does this)."""
+        self.engine.connect_serial()
 
-    def serial_listener(self):
-        while getattr(self, "serial_alive", False):
-            try:
-                if self.serial_port and getattr(self.serial_port, "in_waiting", 0):
-                    line = self.serial_port.readline().decode(errors='ignore').strip()
-                    if line:
-                        self.process_serial_message(line)
-                else:
-                    time.sleep(SERIAL_CHECK_INTERVAL)
-            except Exception as e:
-                safe_log("warning",f"Serial read error: {e}")
-                time.sleep(0.5)
+    def _dismiss_arduino_popup(self):
+        if self.arduino_popup:
+            self.arduino_popup.dismiss()
+            self.arduino_popup = None
+            safe_log("info","✅ Arduino reconnected — popup closed automatically.")
 
     def send_serial_command(self, cmd: str):
-        threading.Thread(target=self._safe_send_serial, args=(cmd,), daemon=True).start()
-
-    def _safe_send_serial(self, cmd):
-        if getattr(self, "simulation", False):
-            safe_log("info",f"[SIM] TX: {cmd}")
-            return
-        try:
-            if self.serial_port and getattr(self.serial_port, "is_open", False):
-                self.serial_port.write((cmd + "\n").encode())
-        except Exception as e:
-            safe_log("warning",f"Serial write error: {e}")
+        """Queue a command for the Arduino (safe from any thread; written on the service loop)."""
+        self.engine.send_command(cmd)
 
     # --------------------------
     # UI Button handler
     # --------------------------
     def handle_service_request(self, lane_key, action):
         """Respond to INSERT_COIN / START button presses."""
-        lane = self.left_lane if lane_key == "L" else self.right_lane
-        self.last_interacted_lane = lane_key
-        # ✅ Track lane for Arduino COIN messages
-        App.get_running_app().last_interacted_lane = lane_key
-
-        if action == "INSERT_COIN":
-            lane.start_wait_for_coin()
-            self.send_serial_command("ENABLE_COIN")  # ✅ allow physical coin entry
-            safe_log("info",f"Insert Coin pressed for lane {lane_key} → waiting for coin...")
-
-
-        elif action == "START":
+        if action == "START":
             # start the lane if coins are available
             self.start_lane_timer(lane_key)
+        else:
+            self.engine.request(lane_key, action)
 
     # --------------------------
     # Manual Start Button
@@ -1946,32 +2684,7 @@ class CarwashApp(App):
 
     def stop_lane(self, lane_key):
         """Stop the specified lane immediately: stop relay, reset timer, and clear coins."""
-        lane = self.left_lane if lane_key == "L" else self.right_lane
-
-        if lane.running or lane.remaining > 0 or lane.coins > 0:
-            self.send_serial_command(f"RELAY_OFF:{lane_key}")
-            lane.running = False
-            lane.remaining = 0
-            lane.coins = 0  # ✅ reset all inserted coins
-            lane.pending_coin = False
-
-            try:
-                sm = self.root.ids.sm
-                menu = sm.get_screen("menu")
-                if lane_key == "L":
-                    menu.ids.timer_label_water.text = "00:00"
-                    menu.ids.lane_left.ids.coin_count.text = f"Credit's: 0"
-                    self.stop_countdown_beep("L")
-                else:
-                    menu.ids.timer_label_foaming.text = "00:00"
-                    menu.ids.lane_right.ids.coin_count.text = f"Credit's: 0"
-                    self.stop_countdown_beep("R")
-            except Exception as e:
-                safe_log("warning",f"Stop lane UI update error: {e}")
-
-            safe_log("info",f"Lane {lane_key} stopped manually — time and coins cleared.")
-        else:
-            safe_log("info",f"Stop command ignored for {lane_key} (not running or no coins).")
+        self.engine.stop_lane(lane_key)  # UI reset follows via LaneStopped
 
     def is_lane_running(self, lane_key):
         """Return True if lane is currently active."""
@@ -1993,93 +2706,24 @@ class CarwashApp(App):
     # Timers
     # --------------------------
     def update_timers(self, dt):
-        left_finished = self.left_lane.tick()
-        right_finished = self.right_lane.tick()
+        # Lane end (relay OFF, labels, video) is handled by LaneExpired subscribers
+        self.engine.tick()
 
         # ✅ Check for 10-second warning beep
         self.check_10_second_warning()
 
-        # ✅ Check if running state changed and update video accordingly
-        current_left_running = self.left_lane.running
-        current_right_running = self.right_lane.running
-
-        # If running state changed, update the video
-        if (current_left_running != self.previous_left_running or
-                current_right_running != self.previous_right_running):
-            self.update_background_video()
-            self.previous_left_running = current_left_running
-            self.previous_right_running = current_right_running
-
+        # ✅ Countdown display for running lanes
         try:
             sm = self.root.ids.sm
-            if not sm.has_screen("menu"):
-                return
-            menu = sm.get_screen("menu")
-
-            # ✅ LEFT lane finish handling
-            if left_finished or (self.left_lane.remaining <= 0 and self.left_lane.running):
-                self.send_serial_command("RELAY_OFF:L")
-                self.left_lane.running = False
-                self.left_lane.remaining = 0
-                self.left_lane.coins = 0
-                self.left_lane.pending_coin = False
-                # Reset beep state when lane finishes
-                self.left_lane_beeped = False
-                self.stop_countdown_beep("L")
-                menu.ids.timer_label_water.text = "00:00"
-                menu.ids.lane_left.ids.coin_count.text = "Credit's: 0"
-                safe_log("info","Left lane finished → relay OFF, Credit's cleared")
-
-            # ✅ RIGHT lane finish handling
-            if right_finished or (self.right_lane.remaining <= 0 and self.right_lane.running):
-                self.send_serial_command("RELAY_OFF:R")
-                self.right_lane.running = False
-                self.right_lane.remaining = 0
-                self.right_lane.coins = 0
-                self.right_lane.pending_coin = False
-                # Reset beep state when lane finishes
-                self.right_lane_beeped = False
-                self.stop_countdown_beep("R")
-                menu.ids.timer_label_foaming.text = "00:00"
-                menu.ids.lane_right.ids.coin_count.text = "Credit's: 0"
-                safe_log("info","Right lane finished → relay OFF, coins cleared")
-
-            # ✅ Update display every tick
-            menu.ids.timer_label_water.text = self.format_time(self.left_lane.remaining)
-            menu.ids.timer_label_foaming.text = self.format_time(self.right_lane.remaining)
-            menu.ids.lane_left.ids.coin_count.text = f"Credit's: {self.left_lane.coins}"
-            menu.ids.lane_right.ids.coin_count.text = f"Credit's: {self.right_lane.coins}"
-
-            # ✅ Update Start/Stop labels
-            menu.ids.lane_left.ids.start_stop_btn.text = (
-                "[b]Stop[/b]" if self.left_lane.running else "[b]Start[/b]"
-            )
-            menu.ids.lane_right.ids.start_stop_btn.text = (
-                "[b]Stop[/b]" if self.right_lane.running else "[b]Start[/b]"
-            )
-
-            # ✅ Update button color using stored reference
-            left_btn = menu.ids.lane_left.ids.start_stop_btn
-            right_btn = menu.ids.lane_right.ids.start_stop_btn
-
-            if left_btn.color_instruction:
-                left_btn.color_instruction.rgba = (
-                    (1.0, 0.3, 0.3, 1.0) if self.left_lane.running else (0.0, 0.592, 0.698, 1.0)
-                )
-            if right_btn.color_instruction:
-                right_btn.color_instruction.rgba = (
-                    (1.0, 0.3, 0.3, 1.0) if self.right_lane.running else (0.0, 0.592, 0.698, 1.0)
-                )
-
+            if sm.has_screen("menu"):
+                menu = sm.get_screen("menu")
+                if self.left_lane.running:
+                    menu.ids.timer_label_water.text = self.format_time(self.left_lane.remaining)
+                if self.right_lane.running:
+                    menu.ids.timer_label_foaming.text = self.format_time(self.right_lane.remaining)
         except Exception as e:
             safe_log("warning",f"update_timers error: {e}")
 
-        # ✅ Restart inactivity timer when all timers stop
-        if not (self.left_lane.running or self.right_lane.running):
-            current_screen = self.root.ids.sm.get_screen(self.root.ids.sm.current)
-            if isinstance(current_screen, InactivityMixin):
-                current_screen.start_inactivity_timer()
-
     def check_10_second_warning(self):
         """Check if any timer is in last 10 seconds and trigger continuous countdown"""
         # Left lane: 10 seconds or less and running
@@ -2295,22 +2939,7 @@ class CarwashApp(App):
 
     def start_lane_timer(self, lane_key):
         """Start the lane timer and relay when Start button is pressed."""
-        lane = self.left_lane if lane_key == "L" else self.right_lane
-        if lane.coins > 0 and not lane.running:
-            lane.running = True
-            if lane_key == "L":
-                self.left_lane_beeped = False
-            else:
-                self.right_lane_beeped = False
-
-            self.send_serial_command(f"RELAY_ON:{lane_key}")
-
-            # Update background video when timer starts
-            self.update_background_video()
-
-            safe_log("info",f"Lane {lane_key} started → timer + relay ON.")
-        else:
-            safe_log("info",f"Lane {lane_key}: no credit or already running.")
+        self.engine.start_lane(lane_key)  # labels and video follow via LaneStarted
 
     def format_time(self, seconds):
         m, s = divmod(int(seconds), 60)
@@ -2320,39 +2949,16 @@ class CarwashApp(App):
     # Firebase and Local
     # --------------------------
 
-    def save_account_data(self, lane_key, amount):
-        data = {}
-        if os.path.exists(DATA_FILE):
-            try:
-                with open(DATA_FILE, "r") as f:
-                    data = json.load(f)
-            except json.JSONDecodeError:
-                pass
-
-        if lane_key == "L":
-            data["water_coins"] = data.get("water_coins", 0) + int(amount)
-        elif lane_key == "R":
-            data["foaming_coins"] = data.get("foaming_coins", 0) + int(amount)
-
-        with open(DATA_FILE, "w") as f:
-            json.dump(data, f, indent=4)
-
-        threading.Thread(target=self.background_sync_to_firebase, daemon=True).start()
-
     def background_sync_to_firebase(self):
         """Sync the full local totals (not increments) to Firebase."""
-        if not os.path.exists(DATA_FILE) or db is None:
+        if db is None:
             return
-
-        try:
-            with open(DATA_FILE, "r") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            safe_log("warning","Invalid JSON file.")
+        data = self.engine.ledger.totals()
+        if not data:
             return
 
-        # Skip sync if offline
-        if not self.is_connected():
+        # Skip sync if offline (the connectivity monitor re-triggers it)
+        if not self.online:
             safe_log("info","Offline, Firebase sync postponed.")
             return
 
@@ -2363,7 +2969,17 @@ class CarwashApp(App):
 
             machine_ref = db.collection("machines").document(MACHINE_ID)
 
-            # ✅ Write absolute totals from local JSON
+            unverified = store.device_info().get("totals_unverified")
+            if unverified:
+                # Rebuilt from old data after corruption: never overwrite the cloud totals with lower ones
+                safe_log("error",f"🚨 Totals not synced: local store was rebuilt from {unverified} without its "
+                                    f"totals (water={total_water}, foam={total_foam}). Check them, then run "
+                                    f"'python local_store.py --accept-totals'.")
+                uploaded = self.upload_transactions(machine_ref)
+                safe_log("info",f"Firebase sync: transactions uploaded={uploaded}, totals held")
+                return
+
+            # ✅ Write absolute totals from the local store
             machine_ref.set({
                 "ownerId": OWNER_ID,
                 "location": LOCATION,
@@ -2374,21 +2990,36 @@ class CarwashApp(App):
                 "updated_at": firestore.SERVER_TIMESTAMP
             }, merge=True)
 
-            # ✅ Optional: Add one transaction for the last coin (with lane tracking)
-            last_lane = None
-            if total_water or total_foam:
-                if total_water >= total_foam:
-                    last_lane = "L"
-                else:
-                    last_lane = "R"
-
+            # ✅ Per-coin transactions for fleet reports (fleet_report.py)
+            uploaded = self.upload_transactions(machine_ref)
 
             safe_log("info",
-                f"Firebase sync success → totals: water={total_water}, foam={total_foam}, total={total_earnings}")
+                f"Firebase sync success → totals: water={total_water}, foam={total_foam}, "
+                f"total={total_earnings}, transactions uploaded={uploaded}")
 
         except Exception as e:
             safe_log("warning",f"Firebase sync failed: {e}")
 
+    def upload_transactions(self, machine_ref):
+        """Copy local transactions newer than the upload cursor to machines/{id}/transactions."""
+        uploaded = 0
+        last_id = store.device_info().get("transactions_uploaded_id", 0)
+        while True:
+            rows = store.transactions_after(last_id, limit=TRANSACTION_UPLOAD_BATCH)
+            if not rows:
+                return uploaded
+            batch = db.batch()
+            for row_id, uid, ts, lane, amount, seconds in rows:
+                # The row's uid as document id: a retried batch overwrites instead of duplicating,
+                # and a rebuilt store (rowids from 1 again) never overwrites older coins
+                batch.set(machine_ref.collection("transactions").document(uid), {
+                    "ts": ts, "lane": lane, "amount": amount, "seconds": seconds,
+                })
+            batch.commit()
+            last_id = rows[-1][0]
+            store.set_device(transactions_uploaded_id=last_id)
+            uploaded += len(rows)
+
     def is_connected(self):
         """Check if internet is available."""
         try:
@@ -2398,112 +3029,46 @@ class CarwashApp(App):
             return False
 
     def start_realtime_sync(self):
-        """Continuous background sync of totals every 2 minutes."""
-
-        def sync_loop():
-            while True:
-                time.sleep(120)
-                self.background_sync_to_firebase()
-
-        threading.Thread(target=sync_loop, daemon=True).start()
+        """Background sync of totals every 2 minutes, or sooner when a coin arrives."""
+        self.core.supervise("sync", self.sync_worker)
 
-    def on_stop(self):
-        self.serial_alive = False
-
-        if getattr(self, "serial_port", None) and getattr(self.serial_port, "is_open", False):
+    async def sync_worker(self):
+        self._sync_wakeup = asyncio.Event()
+        while True:
+            await self.core.run_blocking(self.background_sync_to_firebase)
             try:
-                self.serial_port.close()
-            except Exception:
+                await asyncio.wait_for(self._sync_wakeup.wait(), SYNC_INTERVAL)
+            except asyncio.TimeoutError:
                 pass
+            self._sync_wakeup.clear()
+
+    def request_sync(self):
+        """Wake the sync worker (any thread); a burst of coins collapses into one write."""
+        wakeup = getattr(self, "_sync_wakeup", None)
+        if wakeup is not None:
+            self.core.call_soon(wakeup.set)
+
+    async def connectivity_monitor(self):
+        """Probe the internet periodically so other services can read `self.online` instantly."""
+        while True:
+            online = await self.core.run_blocking(self.is_connected)
+            if online != self.online:
+                self.online = online
+                safe_log("info", "🌐 Internet available." if online else "🌐 Internet lost.")
+                if online:
+                    self.request_sync()
+                self.heartbeat.request()
+            await asyncio.sleep(CONNECTIVITY_INTERVAL)
 
-    # ───────────────────────────────────────────────
-    # FIREBASE COMMAND LISTENER (Restart / Shutdown)
-    # ───────────────────────────────────────────────
-    def listen_for_commands(self):
-        """Continuously listens to Firestore 'commands' collection for restart/shutdown commands."""
-        if db is None:
-            safe_log("warning","Firestore not initialized — skipping command listener.")
+    def on_stop(self):
+        # App.stop() dispatches on_stop, then run() dispatches it again on the way out
+        if getattr(self, "stopped", False):
             return
-
-        machine_ref = db.collection("machines").document(MACHINE_ID)
-        commands_ref = machine_ref.collection("commands")
-
-        def on_snapshot(col_snapshot, changes, read_time):
-            """Handle incoming Firestore command changes."""
-            if not changes:
-                return
-
-            for change in changes:
-                if change.type.name != "ADDED":
-                    continue
-
-                doc_id = change.document.id
-                cmd = change.document.to_dict() or {}
-                cmd_type = cmd.get("type", "").lower().strip()
-                safe_log("info",f"📥 Firestore command received: {cmd_type}")
-
-
-                try:
-                    # ✅ Always delete the command FIRST
-                    commands_ref.document(doc_id).delete()
-                    safe_log("info",f"🗑️ Command '{cmd_type}' deleted immediately before execution.")
-
-                    # ────────────── EXECUTE COMMAND ──────────────
-                    if cmd_type in ("restart_device", "restart_pi", "reboot"):
-                        safe_log("info","⚙️ Restart device command detected — rebooting Raspberry Pi...")
-                        subprocess.Popen(
-                            ["/usr/bin/sudo", "reboot"],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-
-                    elif cmd_type in ("restart_app", "app_restart"):
-                        safe_log("info","🔄 Restart App command detected — restarting via systemd...")
-                        subprocess.Popen(
-                            ["/usr/bin/sudo", "systemctl", "restart", "carwash.service"],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-
-                    elif cmd_type in ("shutdown", "poweroff"):
-                        safe_log("info","🛑 Shutdown command detected — powering off...")
-                        subprocess.Popen(
-                            ["/usr/bin/sudo", "shutdown", "now"],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL,
-                        )
-
-                    else:
-                        safe_log("info",f"⚠️ Unknown command '{cmd_type}' ignored.")
-
-                except Exception as e:
-                    safe_log("error",f"⚠️ Command execution failed: {e}")
-
-        def attach_listener():
-            """Attach a Firestore snapshot listener and auto-recover on failure."""
-            try:
-                safe_log("info","📡 Attaching Firestore command listener...")
-                commands_ref.on_snapshot(on_snapshot)
-                safe_log("info","🔥 Firestore command listener started successfully.")
-            except Exception as e:
-                safe_log("error",f"❌ Failed to attach Firestore listener: {e}")
-
-                safe_log("info","🔁 Retrying listener in 10 seconds...")
-                Clock.schedule_once(lambda dt: attach_listener(), 10)
-
-        # 🔁 Start and monitor listener in a background thread
-        def listener_loop():
-            while True:
-                try:
-                    attach_listener()
-                    # Wait 5 minutes before reattaching just in case Firestore drops silently
-                    time.sleep(300)
-                except Exception as e:
-                    safe_log("error",f"Listener loop crashed: {e}")
-
-                    time.sleep(10)
-
-        threading.Thread(target=listener_loop, daemon=True).start()
+        self.stopped = True
+        self.engine.stop()
+        self.core.stop()
+        disk.flush()
+        store.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,448 @@
+"""
+Carwash UI Benchmarks
+=====================
+Latency of the real kiosk UI (main.py + carwash.kv) measured on an offscreen
+SDL window, so it runs without a display. The app starts in a temporary
+working directory with a copy of json_data/ and no Firestore credentials,
+so the machine's database, logs, checkpoints and cloud documents are never
+touched.
+
+    python ui_bench.py frame-latency --coins 50    # COIN frame → first frame showing the new credit
+    python ui_bench.py touch-latency --taps 20     # button tap → serial command and → first changed frame
+    python ui_bench.py touch-latency --save-baseline ui_baseline.json
+    python ui_bench.py touch-latency --baseline ui_baseline.json    # exit 1 if a p99 regressed
+
+A frame "shows" a change when the expected UI state holds and the watched
+widget's pixels, read back with glReadPixels right after the frame is drawn,
+differ from the last frame drawn before the input. Frames are the ones drawn
+after the input arrives (an idle window draws nothing), so 1 means the first
+frame the app draws; one already being drawn when the input lands counts too.
+
+Taps go through a Kivy input provider, like the touchscreen's: the app sees
+them in the next frame's input dispatch and routes them through
+Window → HoverButton.on_touch_down/on_touch_up → on_release
+(ServiceLane.do_action, CarwashApp.toggle_lane, InsertCoinPopup.dismiss,
+ConfirmStopPopup.confirm). Serial commands are captured at the engine's
+transport, which stands in for the Arduino and ACKs relay commands.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STEP_TIMEOUT = 2.0  # seconds before a command or frame counts as missed
+SETTLE = (0.5, 0.7)  # pause between steps (s), lets open/close animations finish
+COIN_PIXEL_LIMITS = (150.0, 3)  # frame-latency p99 budget: ms, drawn frames
+
+
+def prepare_environment(workdir):
+    """Offscreen window, private working directory; must run before main/kivy are imported."""
+    os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    os.environ["CARWASH_SPOOL_DIR"] = os.path.join(workdir, "spool")
+    shutil.copytree(os.path.join(REPO_DIR, "json_data"), os.path.join(workdir, "json_data"),
+                    ignore=shutil.ignore_patterns("carwash.db*", "lane_state.bin", "logs"))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    from kivy.resources import resource_add_path
+    resource_add_path(REPO_DIR)  # fonts, images and videos referenced by carwash.kv
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+def region_crc(widget):
+    """CRC of the widget's pixels in the frame just drawn (call from Window.on_flip)."""
+    from kivy.graphics.opengl import GL_RGBA, GL_UNSIGNED_BYTE, glReadPixels
+
+    x, y = widget.to_window(widget.x, widget.y)
+    width, height = max(1, int(widget.width)), max(1, int(widget.height))
+    return zlib.crc32(glReadPixels(int(x), int(y), width, height, GL_RGBA, GL_UNSIGNED_BYTE))
+
+
+class FrameProbe:
+    """
+    Watches every drawn frame (Window.on_flip runs after on_draw, before the
+    buffer swap) for a condition set by `expect()`, and reports the time and
+    number of frames it took. While nothing is expected it keeps the pixels
+    of the `watch()`ed widget, so `changed()` can tell a frame that differs.
+    """
+
+    def __init__(self, window):
+        self.frames = 0
+        self.widget = None
+        self.crc = None
+        self.pending = None  # (started, frame, predicate, event, result)
+        window.bind(on_flip=self._on_flip)
+
+    def watch(self, widget):
+        self.widget = widget
+        self.crc = None
+
+    def changed(self):
+        return region_crc(self.widget) != self.crc
+
+    def expect(self, predicate, started=None):
+        """Arm the probe; returns (event, result) — result gets [seconds, frames] when seen."""
+        event, result = threading.Event(), []
+        self.pending = (started or time.perf_counter(), self.frames, predicate, event, result)
+        return event, result
+
+    def _on_flip(self, *args):
+        self.frames += 1
+        pending = self.pending
+        if pending is None:
+            if self.widget is not None:
+                self.crc = region_crc(self.widget)
+            return
+        started, frame, predicate, event, result = pending
+        if predicate():
+            result[:] = [time.perf_counter() - started, self.frames - frame]
+            self.pending = None
+            event.set()
+
+
+class BenchArduino:
+    """
+    Engine transport in place of the serial link: times the command a step
+    expects and answers relay commands with the ACK the firmware would send.
+    """
+
+    def __init__(self, engine, core, probe):
+        self.engine = engine
+        self.core = core
+        self.probe = probe
+        self.pending = None  # (command, started, frame, event, result)
+
+    def expect(self, command, started):
+        event, result = threading.Event(), []
+        self.pending = (command, started, self.probe.frames, event, result)
+        return event, result
+
+    def __call__(self, cmd):
+        pending = self.pending
+        if pending is not None and pending[0] == cmd:
+            _, started, frame, event, result = pending
+            result[:] = [time.perf_counter() - started, self.probe.frames - frame + 1]
+            self.pending = None
+            event.set()
+        if cmd.startswith("RELAY_"):
+            self.core.call_soon(self.engine.process_serial_message, f"ACK:{cmd}")
+
+
+def make_touch_provider():
+    """Input provider fed from the benchmark thread; polled once per frame like a touchscreen."""
+    from kivy.input.motionevent import MotionEvent
+    from kivy.input.provider import MotionEventProvider
+
+    class BenchTouch(MotionEvent):
+        def depack(self, args):
+            self.sx, self.sy = args
+            if not self.profile:
+                self.profile.append("pos")
+            super().depack(args)
+
+    class BenchTouchProvider(MotionEventProvider):
+        def __init__(self):
+            super().__init__("bench", None)
+            self.queue = deque()
+            self.uid = 0
+
+        def tap(self, x, y, size):
+            """Queue a touch down + up at window position (x, y)."""
+            self.uid += 1
+            args = (x / max(1, size[0] - 1), y / max(1, size[1] - 1))
+            touch = BenchTouch(self.device, self.uid, args, is_touch=True)
+            self.queue.extend((("begin", touch), ("end", touch)))
+
+        def update(self, dispatch_fn):
+            while self.queue:
+                dispatch_fn(*self.queue.popleft())
+
+    return BenchTouchProvider()
+
+
+def call_ui(app, fn, *args):
+    """Run fn on the UI thread and return its result."""
+    done, result = threading.Event(), []
+
+    def run():
+        try:
+            result.append(fn(*args))
+        finally:
+            done.set()
+
+    app.core.post_ui(run)
+    if not done.wait(STEP_TIMEOUT):
+        raise TimeoutError(f"UI thread did not run {getattr(fn, '__name__', fn)}")
+    return result[0] if result else None
+
+
+def wait_until(app, predicate, timeout=STEP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if call_ui(app, predicate):
+            return True
+        time.sleep(0.02)
+    return False
+
+
+class Results:
+    """Samples per metric: "screen" metrics end at a drawn frame, "command" ones at the transport."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, kind, sample):
+        metric = self.metrics.setdefault(name, {"kind": kind, "samples": [], "misses": 0})
+        if sample:
+            metric["samples"].append(sample)
+        else:
+            metric["misses"] += 1
+
+    def summary(self):
+        rows = {}
+        for name, metric in self.metrics.items():
+            ms = [s * 1000 for s, _ in metric["samples"]] or [float("nan")]
+            frames = [f for _, f in metric["samples"]] or [0]
+            rows[name] = {
+                "kind": metric["kind"], "n": len(metric["samples"]), "misses": metric["misses"],
+                "p50_ms": round(percentile(ms, 50), 2), "p99_ms": round(percentile(ms, 99), 2),
+                "p50_frames": percentile(frames, 50), "p99_frames": percentile(frames, 99),
+            }
+        return rows
+
+
+# --------------------------
+# Scenarios
+# --------------------------
+def frame_latency(app, probe, args):
+    """Driver thread: insert coins through the serial path and time them to the screen."""
+    from main import InsertCoinPopup
+
+    def open_popup():
+        app.handle_service_request("L", "INSERT_COIN")
+        popup = InsertCoinPopup(lane_key="L")
+        popup.open()
+        return popup
+
+    popup = call_ui(app, open_popup)
+    time.sleep(1.0)  # open animation
+
+    label = popup.ids.coin_label
+    probe.watch(label)
+    results = Results()
+    rng = random.Random(1)
+    for seq in range(1, args.coins + 1):
+        time.sleep(rng.uniform(0.05, 0.3))  # arrive at a random point of the frame
+        expected = str(app.engine.lane("L").coins + 5)
+        event, result = probe.expect(lambda: label.text == expected and probe.changed())
+        app.core.call_soon(app.engine.process_serial_message, f"COIN:5:L:{seq}")
+        if not event.wait(STEP_TIMEOUT):
+            probe.pending = None
+        results.add("coin → pixel", "screen", result)
+    return results
+
+
+def touch_latency(app, probe, args):
+    """
+    Driver thread: on the left lane, repeat Insert P5 → (coin) → FINISH →
+    Start → Stop → OK, timing each tap to its serial command and to the
+    first frame where the lane looks different.
+    """
+    from kivy.base import EventLoop
+    from kivy.core.window import Window
+    from kivy.uix.modalview import ModalView
+    from main import ConfirmStopPopup, HoverButton, InsertCoinPopup
+
+    app.idle.stop()  # keep the menu up between rounds
+    touches = make_touch_provider()
+    EventLoop.add_input_provider(touches)
+    arduino = app.engine.transport = BenchArduino(app.engine, app.core, probe)
+
+    def show_menu():
+        app.root.ids.sm.current = "menu"
+        menu = app.root.ids.sm.get_screen("menu")
+        return menu.ids.lane_left
+
+    lane_widget = call_ui(app, show_menu)
+    lane = app.engine.lane("L")
+    start_btn = lane_widget.ids.start_stop_btn
+    insert_btn = next(w for w in lane_widget.walk() if isinstance(w, HoverButton) and "Insert" in w.text)
+
+    def popup(cls):
+        return next((w for w in Window.children if isinstance(w, cls)), None)
+
+    def button(root, text):
+        return next(w for w in root.walk() if isinstance(w, HoverButton) and text in w.text)
+
+    def watch(widget):
+        """Watch `widget` from the next drawn frame on (an idle window draws nothing)."""
+        call_ui(app, lambda: (probe.watch(widget), Window.canvas.ask_update()))
+        wait_until(app, lambda: probe.crc is not None)
+
+    def reset():
+        for view in [w for w in Window.children if isinstance(w, ModalView)]:
+            view.dismiss(animation=False)
+        app.engine.stop_lane("L")
+        app.set_coin_input("L", False)
+
+    results = Results()
+    rng = random.Random(1)
+    seq = 0
+
+    def settle():
+        time.sleep(rng.uniform(*SETTLE))
+
+    def tap(name, widget, command, predicate):
+        """Tap `widget`; record tap → command (if any) and tap → first matching changed frame."""
+        x, y = call_ui(app, lambda: widget.to_window(*widget.center))
+        started = time.perf_counter()
+        frame_event, frame_result = probe.expect(predicate, started)
+        if command:
+            command_event, command_result = arduino.expect(command, started)
+        touches.tap(x, y, Window.size)
+        if not frame_event.wait(STEP_TIMEOUT):
+            probe.pending = None
+        results.add(f"{name} → frame", "screen", frame_result)
+        if command:
+            if not command_event.wait(STEP_TIMEOUT):
+                arduino.pending = None
+            results.add(f"{name} → {command.split(':')[0]}", "command", command_result)
+        settle()
+
+    time.sleep(2.0)  # screen transition and the menu's on_enter checks
+    for _ in range(args.taps):
+        call_ui(app, reset)
+        settle()
+
+        watch(lane_widget)
+        tap("insert", insert_btn, "ENABLE_COIN:L",
+            lambda: popup(InsertCoinPopup) is not None and probe.changed())
+        coin_popup = call_ui(app, popup, InsertCoinPopup)
+        if coin_popup is None:
+            continue
+
+        seq += 1
+        expected = str(lane.coins + 5)
+        app.core.call_soon(app.engine.process_serial_message, f"COIN:5:L:{seq}")
+        wait_until(app, lambda: coin_popup.ids.coin_label.text == expected)
+        settle()
+
+        watch(coin_popup.ids.content_box)
+        tap("finish", button(coin_popup, "FINISH"), "DISABLE_COIN:L", probe.changed)
+        watch(lane_widget)
+        tap("start", start_btn, "RELAY_ON:L", lambda: lane.running and "Stop" in start_btn.text and probe.changed())
+        tap("stop", start_btn, None, lambda: popup(ConfirmStopPopup) is not None and probe.changed())
+        confirm = call_ui(app, popup, ConfirmStopPopup)
+        if confirm is not None:
+            tap("stop-ok", button(confirm, "OK"), "RELAY_OFF:L", lambda: not lane.running and probe.changed())
+
+    call_ui(app, reset)
+    EventLoop.remove_input_provider(touches)
+    return results
+
+
+SCENARIOS = {"frame-latency": frame_latency, "touch-latency": touch_latency}
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="carwash-ui-bench-")
+    prepare_environment(workdir)
+    import main
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+
+    outcome = {"code": 1}
+
+    class BenchApp(main.CarwashApp):
+        kv_file = os.path.join(REPO_DIR, "carwash.kv")
+
+        def on_start(self):
+            super().on_start()
+            probe = FrameProbe(Window)
+            threading.Thread(target=self.drive, args=(probe,), daemon=True).start()
+
+        def drive(self, probe):
+            try:
+                time.sleep(args.warmup)
+                results = SCENARIOS[args.scenario](self, probe, args)
+                outcome["code"] = report(results.summary(), args)
+            finally:
+                Clock.schedule_once(lambda dt: self.stop(), 0)
+
+    try:
+        BenchApp().run()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return outcome["code"]
+
+
+def report(summary, args):
+    """Print the table, apply the limits and the baseline; returns the exit code."""
+    failures = []
+    print(f"{'metric':<22} {'n':>4} {'miss':>4} {'p50 ms':>8} {'p99 ms':>8} {'p50 fr':>6} {'p99 fr':>6}")
+    for name, row in summary.items():
+        print(f"{name:<22} {row['n']:>4} {row['misses']:>4} {row['p50_ms']:>8.1f} {row['p99_ms']:>8.1f} "
+              f"{row['p50_frames']:>6} {row['p99_frames']:>6}")
+        if row["misses"] or not row["n"]:
+            failures.append(f"{name}: {row['misses']} missed")
+        elif row["kind"] == "screen" and ((args.max_ms and row["p99_ms"] > args.max_ms)
+                                          or (args.max_frames and row["p99_frames"] > args.max_frames)):
+            failures.append(f"{name}: p99 {row['p99_ms']:.1f} ms / {row['p99_frames']} frames "
+                            f"(limit {args.max_ms} ms / {args.max_frames} frames)")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        for name, base in baseline.items():
+            row = summary.get(name)
+            if row is None:
+                continue
+            allowed = base["p99_ms"] * (1 + args.tolerance) + args.slack_ms
+            if row["p99_ms"] > allowed:
+                failures.append(f"{name}: p99 {row['p99_ms']:.1f} ms regressed from {base['p99_ms']:.1f} ms "
+                                f"(allowed {allowed:.1f} ms)")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        print(f"Baseline written to {args.save_baseline}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless latency benchmarks for the carwash kiosk UI")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--coins", type=int, default=50, help="coins to insert (frame-latency)")
+    parser.add_argument("--taps", type=int, default=20, help="insert/finish/start/stop rounds (touch-latency)")
+    parser.add_argument("--warmup", type=float, default=3.0, help="seconds to let the app settle first")
+    parser.add_argument("--max-ms", type=float, help="fail if a screen p99 exceeds this "
+                        f"(frame-latency default {COIN_PIXEL_LIMITS[0]})")
+    parser.add_argument("--max-frames", type=int, help="fail if a screen p99 needs more drawn frames "
+                        f"(frame-latency default {COIN_PIXEL_LIMITS[1]})")
+    parser.add_argument("--baseline", help="JSON from --save-baseline; fail if a p99 regressed past it")
+    parser.add_argument("--save-baseline", metavar="FILE", help="write this run's percentiles as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p99 growth over the baseline")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="absolute p99 jitter allowed over the baseline")
+    args = parser.parse_args()
+    if args.scenario == "frame-latency":
+        args.max_ms = args.max_ms or COIN_PIXEL_LIMITS[0]
+        args.max_frames = args.max_frames or COIN_PIXEL_LIMITS[1]
+    raise SystemExit(run(args))
@@ -0,0 +1,1529 @@
+"""
+Carwash Vending Engine (headless)
+=================================
+Lane timing, coin crediting, relay control, the Arduino serial link and the
+coin ledger, with no Kivy dependency. `main.py` builds the kiosk UI on top of
+`VendingEngine` and subscribes to its events; the same engine can be driven
+from scripts and benchmarks without a display:
+
+    python vending_engine.py --bench 100000
+"""
+
+import argparse
+import asyncio
+import collections
+import ctypes
+import ctypes.util
+import glob
+import json
+import logging
+import mmap
+import os
+import platform
+import queue
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+# =======================================================
+#   SAFE LOGGING SYSTEM (Python 3.13 • Raspberry Pi • Windows)
+# =======================================================
+def safe_log(level, msg, *args, **kwargs):
+    """
+    Prevent RecursionError in Python 3.12–3.13 by forcing all log messages
+    into safe string form before sending to logging.
+    """
+    try:
+        text = str(msg)
+    except Exception:
+        try:
+            text = repr(msg)
+        except Exception:
+            text = "Unloggable message"
+
+    logger = logging.getLogger()
+
+    if level == "info":
+        logger.info(text)
+    elif level == "warning":
+        logger.warning(text)
+    elif level == "error":
+        logger.error(text)
+    elif level == "debug":
+        logger.debug(text)
+    else:
+        logger.log(logging.INFO, text)
+
+# ---------- OS DETECTION ----------
+def is_linux():
+    return platform.system().lower() == "linux"
+
+def is_windows():
+    return platform.system().lower() == "windows"
+
+try:
+    import serial
+    from serial.tools import list_ports
+except ImportError:
+    serial = None
+    list_ports = None
+
+def detect_serial_port():
+    # Explicit override (e.g. the pty link created by arduino_sim.py)
+    override = os.environ.get("CARWASH_SERIAL_PORT")
+    if override:
+        return override
+
+    if platform.system() == "Windows":
+        return "COM3"
+    else:
+        # auto-detect first USB serial device
+        ports = glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
+        return ports[0] if ports else "/dev/ttyUSB0"
+
+def find_arduino_port():
+    """
+    Resolve the Arduino's current device path. Matches the USB serial number
+    (CARWASH_ARDUINO_SERIAL) first, then known VID/PIDs, then the glob fallback,
+    so a re-enumeration from ttyUSB0 to ttyUSB1 is followed.
+    """
+    if os.environ.get("CARWASH_SERIAL_PORT"):
+        return os.environ["CARWASH_SERIAL_PORT"]
+
+    if list_ports is not None:
+        try:
+            wanted_serial = os.environ.get("CARWASH_ARDUINO_SERIAL")
+            candidates = []
+            for p in list_ports.comports():
+                if wanted_serial and p.serial_number == wanted_serial:
+                    return p.device
+                if p.vid is None:
+                    continue
+                for vid, pid in ARDUINO_USB_IDS:
+                    if p.vid == vid and (pid is None or p.pid == pid):
+                        candidates.append(p.device)
+                        break
+            if candidates:
+                return sorted(candidates)[0]
+        except Exception as e:
+            safe_log("warning", f"USB port enumeration failed: {e}")
+
+    return detect_serial_port()
+
+# --------------------------
+# Constants
+# --------------------------
+
+BAUDRATE = 9600
+SERIAL_CHECK_INTERVAL = 0.05   # serial read timeout (reader thread wake-up period)
+SERIAL_RESCAN_INTERVAL = 30    # safety rescan when no hotplug event arrives
+SERIAL_POLL_INTERVAL = 3       # rescan period where inotify is unavailable
+SERVICE_WORKERS = 4            # executor threads for blocking I/O (Firestore, nmcli, HTTP)
+SERVICE_RESTART_DELAY = 5      # seconds before a crashed background service is restarted
+SERVICE_STOP_TIMEOUT = 3       # seconds on_stop waits for services to cancel
+SERIAL_HOTPLUG_RETRIES = 10    # open attempts after a tty add event (udev may still be chmod-ing)
+SERIAL_HOTPLUG_RETRY_DELAY = 0.02
+# (VID, PID) of boards we accept; PID None = any product from that vendor
+ARDUINO_USB_IDS = (
+    (0x2341, None),     # Arduino SA
+    (0x2A03, None),     # Arduino.org
+    (0x1A86, 0x7523),   # CH340 clones
+    (0x0403, 0x6001),   # FTDI FT232R
+    (0x10C4, 0xEA60),   # CP210x
+)
+RELAY_ACK_TIMEOUT = 0.5        # seconds before an unconfirmed relay command is resent
+RELAY_MAX_RETRIES = 5          # log an error every N unconfirmed resends
+RELAY_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Coin acceptors — frames are `COIN:<value>:<acceptor>[:<seq>]`
+COIN_ACCEPTOR_LANES = {"L": "L", "R": "R", "1": "L", "2": "R"}
+COIN_IDLE, COIN_ARMED, COIN_GRACE = "idle", "armed", "grace"
+COIN_GRACE_PERIOD = 2.0        # seconds a lane still credits coins after its popup closes
+COIN_DEBOUNCE = 0.03           # an identical frame without a sequence number this soon is a duplicate
+COIN_SEQ_WINDOW = 64           # sequence numbers remembered per lane to catch late retransmits
+PRICING_BUCKET_MINUTES = 15    # time-of-day pricing resolution
+PRICING_BUCKETS = 7 * 24 * 60 // PRICING_BUCKET_MINUTES
+PRICING_LANE_TIMERS = {"L": "water_timer", "R": "foaming_timer"}
+CHECKPOINT_FILE = "json_data/lane_state.bin"
+CHECKPOINT_INTERVAL = 0.25     # seconds between lane checkpoints (written only when a lane changed)
+CHECKPOINT_SLOT = mmap.PAGESIZE
+CHECKPOINT_MAGIC = b"CWL1"
+
+# --------------------------
+# Lane State
+# --------------------------
+class LaneState:
+    """
+    Timer + credit for one lane, plus the lane's coin acceptor state machine:
+
+        idle  --arm_coin()-->  armed  --disarm_coin()-->  grace  --(COIN_GRACE_PERIOD)-->  idle
+
+    Coins are credited while `armed`, and during `grace` so a coin that was
+    already in the acceptor when the popup closed is not lost. Frames that
+    carry a sequence number are de-duplicated against the last
+    COIN_SEQ_WINDOW seqs seen on the lane, so a late retransmit (5, 6, 5) is
+    still caught; the window is cleared when the board resets. A legacy frame
+    without a seq is only a duplicate when it repeats the previous legacy
+    frame within COIN_DEBOUNCE, far quicker than an acceptor takes two coins.
+    """
+
+    def __init__(self, lane_key):
+        self.lane_key = lane_key
+        self.remaining = 0
+        self.running = False
+        self.coins = 0
+        self.coin_state = COIN_IDLE
+        self.coin_state_since = time.monotonic()
+        self.recent_seqs = collections.deque(maxlen=COIN_SEQ_WINDOW)
+        self.last_legacy_value = None
+        self.last_legacy_at = 0.0
+        self._lock = threading.Lock()
+
+    def add_time(self, secs):
+        with self._lock:
+            self.remaining += int(secs)
+
+    def tick(self):
+        with self._lock:
+            if self.running and self.remaining > 0:
+                self.remaining -= 1
+                if self.remaining <= 0:
+                    self.remaining = 0
+                    self.running = False
+                    return True
+            return False
+
+    def _set_coin_state(self, state):
+        self.coin_state = state
+        self.coin_state_since = time.monotonic()
+
+    def arm_coin(self):
+        with self._lock:
+            self._set_coin_state(COIN_ARMED)
+
+    def disarm_coin(self, grace=True):
+        with self._lock:
+            if self.coin_state == COIN_ARMED and grace:
+                self._set_coin_state(COIN_GRACE)
+            else:
+                self._set_coin_state(COIN_IDLE)
+
+    def _accepting(self, now):
+        if self.coin_state == COIN_GRACE:
+            return now - self.coin_state_since <= COIN_GRACE_PERIOD
+        return self.coin_state != COIN_IDLE
+
+    @property
+    def accepting_coins(self):
+        with self._lock:
+            return self._accepting(time.monotonic())
+
+    def credit_coin(self, value, seconds, seq=None):
+        """
+        Apply one COIN frame. Returns "credited", "duplicate" or "rejected".
+        Safe to call from the serial thread.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if seq is not None:
+                if seq in self.recent_seqs:
+                    return "duplicate"
+            elif (value == self.last_legacy_value
+                  and now - self.last_legacy_at < COIN_DEBOUNCE):
+                return "duplicate"
+
+            if not self._accepting(now):
+                if self.coin_state == COIN_GRACE:
+                    self._set_coin_state(COIN_IDLE)
+                return "rejected"
+
+            if seq is not None:
+                self.recent_seqs.append(seq)
+            else:
+                self.last_legacy_value = value
+                self.last_legacy_at = now
+            self.coins += value
+            self.remaining += int(seconds)
+            return "credited"
+
+    def reset_coin_seqs(self):
+        """The board restarts its sequence numbers when it resets."""
+        with self._lock:
+            self.recent_seqs.clear()
+
+
+# --------------------------
+# Relay Command Layer
+# --------------------------
+class LatencyHistogram:
+    """Fixed-bucket histogram of round-trip times (milliseconds)."""
+
+    def __init__(self, buckets_ms=RELAY_LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self.counts = [0] * (len(self.buckets_ms) + 1)  # last bucket = overflow
+        self.total = 0
+        self.max_ms = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        for i, bound in enumerate(self.buckets_ms):
+            if ms <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += 1
+        self.max_ms = max(self.max_ms, ms)
+
+    def summary(self):
+        labels = [f"<={b}ms" for b in self.buckets_ms] + [f">{self.buckets_ms[-1]}ms"]
+        parts = [f"{l}:{c}" for l, c in zip(labels, self.counts) if c]
+        return f"n={self.total} max={self.max_ms:.1f}ms " + " ".join(parts)
+
+
+class RelayCommander:
+    """
+    Tracks the relay state each lane is expected to have and keeps sending
+    RELAY_ON/RELAY_OFF until the Arduino confirms it with `ACK:<command>`
+    (e.g. `ACK:RELAY_ON:L`). Unconfirmed commands are retransmitted with
+    backoff while the link is up; `reconcile()` re-asserts every lane after
+    a reconnect (the Arduino resets and drops all relays when the port opens).
+    """
+
+    def __init__(self, send_func, link_up, lanes=("L", "R"),
+                 timeout=RELAY_ACK_TIMEOUT, max_retries=RELAY_MAX_RETRIES, on_confirmed=None):
+        self._send = send_func
+        self._link_up = link_up
+        self.on_confirmed = on_confirmed  # on_confirmed(lane_key, on, rtt_seconds)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.expected = {k: False for k in lanes}
+        self.confirmed = {k: None for k in lanes}  # None = unknown
+        self.pending = {}  # lane_key -> {"cmd", "sent_at", "attempts"}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def command_for(lane_key, on):
+        return f"RELAY_{'ON' if on else 'OFF'}:{lane_key}"
+
+    def set_relay(self, lane_key, on):
+        """Record the wanted relay state for a lane and send it."""
+        cmd = self.command_for(lane_key, on)
+        with self._lock:
+            self.expected[lane_key] = bool(on)
+            self.pending[lane_key] = {"cmd": cmd, "sent_at": time.monotonic(), "attempts": 1}
+        self._send(cmd)
+
+    def is_confirmed(self, lane_key):
+        return self.confirmed.get(lane_key) == self.expected.get(lane_key)
+
+    def handle_ack(self, message):
+        """Consume an `ACK:RELAY_xx:L` frame. Returns True if it matched a pending command."""
+        acked = message[4:].strip() if message.startswith("ACK:") else ""
+        if not acked.startswith("RELAY_"):
+            return False
+
+        with self._lock:
+            for lane_key, entry in list(self.pending.items()):
+                if entry["cmd"] != acked:
+                    continue
+                rtt = time.monotonic() - entry["sent_at"]
+                on = self.confirmed[lane_key] = self.expected[lane_key]
+                del self.pending[lane_key]
+                break
+            else:
+                return False
+
+        safe_log("debug", f"Relay confirmed {acked} in {rtt * 1000:.1f}ms (attempt {entry['attempts']})")
+        if self.on_confirmed:
+            self.on_confirmed(lane_key, on, rtt)
+        return True
+
+    def check_timeouts(self, dt=None):
+        """Retransmit any command whose ACK is overdue (periodic service task)."""
+        if not self._link_up():
+            return
+
+        now = time.monotonic()
+        resend = []
+        with self._lock:
+            for lane_key, entry in self.pending.items():
+                # Back off 1x, 2x, 4x, 8x the base timeout
+                wait = self.timeout * (2 ** min(entry["attempts"] - 1, 3))
+                if now - entry["sent_at"] < wait:
+                    continue
+                entry["attempts"] += 1
+                entry["sent_at"] = now
+                resend.append((entry["cmd"], entry["attempts"]))
+
+        for cmd, attempts in resend:
+            if attempts > self.max_retries and attempts % self.max_retries == 1:
+                safe_log("error", f"⚠️ Relay command {cmd} still unconfirmed after {attempts - 1} tries")
+            else:
+                safe_log("warning", f"Relay ACK timeout — resending {cmd} (attempt {attempts})")
+            self._send(cmd)
+
+    def reconcile(self):
+        """Re-send the expected state of every lane (after connect/reconnect)."""
+        with self._lock:
+            lanes = list(self.expected.items())
+            for lane_key in self.confirmed:
+                self.confirmed[lane_key] = None
+
+        for lane_key, on in lanes:
+            self.set_relay(lane_key, on)
+        safe_log("info", f"Relay state reconciled: {dict(lanes)}")
+
+
+# --------------------------
+# Service Core (asyncio)
+# --------------------------
+class ServiceCore:
+    """
+    One asyncio event loop on a dedicated thread that runs every background
+    service (serial I/O, sync, connectivity, Wi-Fi, licence) as a supervised
+    task. Blocking calls (Firestore, subprocess, HTTP) go through one bounded
+    executor, so the thread count stays constant however busy the bay is.
+    Results reach the UI thread through a single queue (`post_ui`).
+    """
+
+    def __init__(self, max_workers=SERVICE_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="service-io")
+        self.loop.set_default_executor(self.executor)
+        self.tasks = {}
+        self._ui_queue = queue.SimpleQueue()
+        self.wake_ui = None  # set by the UI layer, e.g. a Kivy Clock trigger that calls drain_ui_queue()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="service-core", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self, timeout=SERVICE_STOP_TIMEOUT):
+        """Cancel every task, wait for them, then stop the loop and the executor."""
+        if not self._thread or not self.loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._cancel_all(), self.loop).result(timeout)
+        except Exception as e:
+            safe_log("warning", f"Service shutdown incomplete: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        safe_log("info", "Service core stopped.")
+
+    async def _cancel_all(self):
+        tasks = [t for t in self.tasks.values() if not t.done()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # --- scheduling (safe from any thread) ---
+    def call_soon(self, fn, *args):
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def spawn(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def supervise(self, name, factory, restart_delay=SERVICE_RESTART_DELAY):
+        """Run `factory()` (a coroutine function) as a named task, restarting it if it crashes."""
+        self.call_soon(self._create_supervised, name, factory, restart_delay)
+
+    def every(self, name, interval, fn, *args, initial_delay=None, blocking=True):
+        """Supervised periodic task; a blocking `fn` runs on the executor, others on the loop."""
+        async def periodic():
+            await asyncio.sleep(interval if initial_delay is None else initial_delay)
+            while True:
+                if blocking:
+                    await self.run_blocking(fn, *args)
+                else:
+                    fn(*args)
+                await asyncio.sleep(interval)
+
+        self.supervise(name, periodic)
+
+    def cancel(self, name):
+        def _cancel():
+            task = self.tasks.pop(name, None)
+            if task:
+                task.cancel()
+        self.call_soon(_cancel)
+
+    def submit(self, fn, *args, on_done=None):
+        """Run blocking `fn` on the executor; `on_done(result)` is called on the Kivy thread."""
+        async def job():
+            result = await self.run_blocking(fn, *args)
+            if on_done is not None:
+                self.post_ui(on_done, result)
+            return result
+
+        return self.spawn(job())
+
+    async def run_blocking(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def _create_supervised(self, name, factory, restart_delay):
+        old = self.tasks.get(name)
+        if old and not old.done():
+            return
+        self.tasks[name] = self.loop.create_task(self._supervisor(name, factory, restart_delay), name=name)
+
+    async def _supervisor(self, name, factory, restart_delay):
+        while True:
+            try:
+                await factory()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                safe_log("error", f"Service '{name}' crashed: {e} — restarting in {restart_delay}s")
+                await asyncio.sleep(restart_delay)
+
+    # --- bridge to Kivy ---
+    def post_ui(self, fn, *args):
+        self._ui_queue.put((fn, args))
+        if self.wake_ui:
+            self.wake_ui()
+
+    def drain_ui_queue(self, *args):
+        while True:
+            try:
+                fn, args = self._ui_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                safe_log("warning", f"UI callback error: {e}")
+
+
+# --------------------------
+# Serial Link (hotplug-aware)
+# --------------------------
+class DeviceWatcher:
+    """
+    Reports tty add/remove events in a directory (default /dev) through
+    inotify, read on the service loop. Falls back to a plain periodic rescan
+    when inotify is not available (Windows, non-Linux dev machines).
+    """
+
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0o4000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, callback, directory="/dev", match=None, rescan_interval=SERIAL_RESCAN_INTERVAL):
+        self.callback = callback  # callback(kind, name) with kind in add/remove/rescan
+        self.directory = directory
+        self.match = match or (lambda name: name.startswith("tty"))
+        self.rescan_interval = rescan_interval
+        self.core = None
+        self._fd = None
+
+    def _open_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(self.IN_NONBLOCK)
+            if fd < 0:
+                return None
+            mask = self.IN_CREATE | self.IN_DELETE | self.IN_ATTRIB | self.IN_MOVED_TO
+            if libc.inotify_add_watch(fd, self.directory.encode(), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except Exception as e:
+            safe_log("warning", f"inotify unavailable ({e}) — polling for serial devices")
+            return None
+
+    def start(self, core):
+        """Must run on the service loop."""
+        self.core = core
+        if is_linux():
+            self._fd = self._open_inotify()
+        if self._fd is not None:
+            core.loop.add_reader(self._fd, self._on_inotify)
+        core.supervise("device-rescan", self._rescan_loop)
+
+    def stop(self):
+        if self._fd is not None:
+            try:
+                self.core.loop.remove_reader(self._fd)
+                os.close(self._fd)
+            except Exception:
+                pass
+            self._fd = None
+
+    async def _rescan_loop(self):
+        interval = self.rescan_interval if self._fd is not None else SERIAL_POLL_INTERVAL
+        while True:
+            await asyncio.sleep(interval)
+            self.callback("rescan", None)
+
+    def _on_inotify(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except OSError:
+            return
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            _, mask, _, length = self._EVENT.unpack_from(data, offset)
+            offset += self._EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="ignore")
+            offset += length
+            if not self.match(name):
+                continue
+            kind = "remove" if mask & self.IN_DELETE else "add"
+            self.callback(kind, name)
+
+
+class SerialLink:
+    """
+    Connection state machine for the Arduino, independent of the UI:
+
+        disconnected --(device found / tty added)--> connected --(read error / tty removed)--> disconnected
+
+    Runs entirely on the service loop: the port is read through
+    `loop.add_reader` (or an executor read loop on Windows), so no thread
+    is dedicated to it. `on_line(text)` is called for each received frame;
+    `on_connected(path)` and `on_lost(reason)` on every transition.
+    """
+
+    DISCONNECTED, CONNECTED, SIMULATION = "disconnected", "connected", "simulation"
+
+    def __init__(self, on_line, on_connected=None, on_lost=None, baudrate=BAUDRATE):
+        self.on_line = on_line
+        self.on_connected = on_connected
+        self.on_lost = on_lost
+        self.baudrate = baudrate
+        self.state = self.DISCONNECTED if serial is not None else self.SIMULATION
+        self.port = None
+        self.port_path = None
+        self.core = None
+        self._rx = b""
+        self._running = False
+        self._hotplug_task = None
+        override = os.environ.get("CARWASH_SERIAL_PORT")
+        if override:
+            self.watcher = DeviceWatcher(
+                self._on_device_event,
+                directory=os.path.dirname(override) or ".",
+                match=lambda name: name == os.path.basename(override),
+            )
+        else:
+            self.watcher = DeviceWatcher(self._on_device_event)
+
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def start(self, core):
+        self.core = core
+        self._running = True
+        if self.state == self.SIMULATION:
+            safe_log("warning", "pyserial not installed — SIMULATION mode.")
+            return
+        core.call_soon(self._start_on_loop)
+
+    def _start_on_loop(self):
+        self.watcher.start(self.core)
+        self.connect("startup")
+
+    def stop(self):
+        """Must run on the service loop (called from ServiceCore shutdown)."""
+        self._running = False
+        self.watcher.stop()
+        self._close()
+
+    def connect(self, reason=""):
+        """Open the Arduino port if it is present (service loop). Returns True when connected."""
+        if not self._running or self.state == self.SIMULATION:
+            return False
+        if self.state == self.CONNECTED:
+            return True
+
+        path = find_arduino_port()
+        try:
+            port = serial.Serial(path, self.baudrate, timeout=SERIAL_CHECK_INTERVAL)
+        except Exception as e:
+            safe_log("debug", f"Arduino open failed on {path} ({reason}): {e}")
+            return False
+
+        self.port, self.port_path = port, path
+        self.state = self.CONNECTED
+        self._rx = b""
+        loop = self.core.loop
+        if hasattr(port, "fileno") and not is_windows():
+            loop.add_reader(port.fileno(), self._on_readable, port)
+        else:
+            loop.create_task(self._read_loop(port))
+
+        safe_log("info", f"✅ Arduino connected on {path} ({reason})")
+        if self.on_connected:
+            self.on_connected(path)
+        return True
+
+    def write(self, cmd):
+        """Service loop only — use VendingEngine.send_command elsewhere."""
+        port = self.port
+        if port is None:
+            return False
+        try:
+            port.write((cmd + "\n").encode())
+            return True
+        except Exception as e:
+            self._lost(port, f"write error: {e}")
+            return False
+
+    def _on_readable(self, port):
+        try:
+            data = port.read(port.in_waiting or 1)
+            if not data:
+                raise OSError("device returned no data")
+        except Exception as e:
+            self._lost(port, f"read error: {e}")
+            return
+        self._feed(data)
+
+    async def _read_loop(self, port):
+        while self._running and self.port is port:
+            try:
+                data = await self.core.run_blocking(port.readline)
+            except Exception as e:
+                self._lost(port, f"read error: {e}")
+                return
+            if data:
+                self._feed(data)
+
+    def _feed(self, data):
+        self._rx += data
+        while b"\n" in self._rx:
+            raw, self._rx = self._rx.split(b"\n", 1)
+            line = raw.decode(errors="ignore").strip()
+            if not line:
+                continue
+            try:
+                self.on_line(line)
+            except Exception as e:
+                safe_log("warning", f"Serial message handling error: {e}")
+
+    def _close(self):
+        port, self.port = self.port, None
+        if self.state == self.CONNECTED:
+            self.state = self.DISCONNECTED
+        if port is None:
+            return
+        try:
+            self.core.loop.remove_reader(port.fileno())
+        except Exception:
+            pass
+        try:
+            port.close()
+        except Exception:
+            pass
+
+    def _lost(self, port, reason):
+        if self.port is not port:
+            return  # already handled
+        self._close()
+        safe_log("warning", f"⚠️ Arduino link lost: {reason}")
+        if self.on_lost:
+            self.on_lost(reason)
+        # The device may still be there (e.g. a glitch) — try straight away
+        self.connect("after loss")
+
+    def _on_device_event(self, kind, name):
+        if kind == "remove":
+            path = self.port_path or ""
+            if self.connected and os.path.basename(path) == name:
+                self._lost(self.port, f"{name} removed")
+            return
+
+        if self.connected or (self._hotplug_task and not self._hotplug_task.done()):
+            return
+        self._hotplug_task = self.core.loop.create_task(self._hotplug_connect(kind, name))
+
+    async def _hotplug_connect(self, kind, name):
+        # udev creates the node before fixing permissions; retry briefly
+        for _ in range(SERIAL_HOTPLUG_RETRIES if kind == "add" else 1):
+            if self.connect(f"{kind} {name}" if name else kind):
+                return
+            await asyncio.sleep(SERIAL_HOTPLUG_RETRY_DELAY)
+
+
+# --------------------------
+# Event Bus
+# --------------------------
+class CoinAccepted(NamedTuple):
+    lane_key: str
+    value: int       # pesos
+    seconds: int     # time added to the lane
+
+
+class LaneStarted(NamedTuple):
+    lane_key: str
+
+
+class LaneExpired(NamedTuple):
+    lane_key: str    # paid time ran out
+
+
+class LaneStopped(NamedTuple):
+    lane_key: str    # stopped by the customer
+
+
+class RelayConfirmed(NamedTuple):
+    lane_key: str
+    on: bool
+    latency: float   # seconds from first send to ACK
+
+
+class SerialConnected(NamedTuple):
+    path: str
+
+
+class SerialLost(NamedTuple):
+    reason: str
+
+
+DELIVER_SYNC = "sync"    # called in the publishing thread before publish() returns
+DELIVER_ASYNC = "async"  # called on the service loop; coroutine functions are awaited there
+DELIVER_UI = "ui"        # called on the UI thread through ServiceCore.post_ui
+
+
+class EventBus:
+    """
+    In-process publish/subscribe for engine state changes. Subscribers pick
+    the event types they care about and how they are called (`DELIVER_*`);
+    without a service core every subscriber is called synchronously.
+
+    Subscriber lists are copy-on-write tuples, so `publish()` takes no lock
+    and a subscriber may (un)subscribe from inside a callback.
+    """
+
+    def __init__(self, core=None):
+        self.core = core
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, event_type, callback, mode=DELIVER_SYNC):
+        if mode not in (DELIVER_SYNC, DELIVER_ASYNC, DELIVER_UI):
+            raise ValueError(f"Unknown delivery mode: {mode}")
+        with self._lock:
+            self._subscribers[event_type] = self._subscribers.get(event_type, ()) + ((callback, mode),)
+        return callback
+
+    def unsubscribe(self, event_type, callback):
+        with self._lock:
+            self._subscribers[event_type] = tuple(
+                s for s in self._subscribers.get(event_type, ()) if s[0] != callback
+            )
+
+    def publish(self, event):
+        for callback, mode in self._subscribers.get(type(event), ()):
+            if mode == DELIVER_SYNC or self.core is None:
+                self._deliver(callback, event)
+            elif mode == DELIVER_ASYNC:
+                self.core.call_soon(self._deliver, callback, event)
+            else:
+                self.core.post_ui(self._deliver, callback, event)
+
+    def _deliver(self, callback, event):
+        try:
+            result = callback(event)
+            if asyncio.iscoroutine(result):
+                if self.core is None:
+                    result.close()
+                    raise RuntimeError("coroutine subscriber needs a service core")
+                self.core.spawn(result)
+        except Exception as e:
+            name = getattr(callback, "__name__", repr(callback))
+            safe_log("warning", f"{type(event).__name__} subscriber {name} failed: {e}")
+
+
+# --------------------------
+# Pricing
+# --------------------------
+def _parse_hhmm(text, field):
+    try:
+        hours, minutes = (int(x) for x in str(text).split(":"))
+    except ValueError:
+        raise ValueError(f"{field}: expected HH:MM, got {text!r}")
+    total = hours * 60 + minutes
+    if not 0 <= total <= 24 * 60 or total % PRICING_BUCKET_MINUTES:
+        raise ValueError(f"{field}: {text} is not a {PRICING_BUCKET_MINUTES}-minute boundary")
+    return total
+
+
+def _rule_buckets(rule):
+    """Week bucket indexes a rule covers (Monday 00:00 = bucket 0)."""
+    days = rule.get("days", range(7))
+    start = _parse_hhmm(rule.get("start", "00:00"), "start")
+    end = _parse_hhmm(rule.get("end", "24:00"), "end")
+    step = PRICING_BUCKET_MINUTES
+    buckets = set()
+    for day in days:
+        if not 0 <= int(day) <= 6:
+            raise ValueError(f"days: {day} is not 0 (Mon) .. 6 (Sun)")
+        base = int(day) * 24 * 60
+        # end <= start wraps past midnight into the next day
+        stop = end if end > start else end + 24 * 60
+        for minute in range(start, stop, step):
+            buckets.add(((base + minute) // step) % PRICING_BUCKETS)
+    return buckets
+
+
+def compile_pricing(rules, base_seconds):
+    """
+    Compile pricing rules into per-lane week tables of
+    `(seconds_per_5, {coin_value: bonus_seconds})`, one entry per time bucket.
+    Later rules win. A rule may set:
+
+        days       [0..6] (Mon..Sun), default every day
+        start/end  "HH:MM" on a bucket boundary, default the whole day
+        lanes      ["L", "R"], default both
+        seconds    seconds per ₱5 (replaces the lane rate)
+        multiplier scales the rate in effect (e.g. 1.5 for happy hour)
+        bonus      {"20": 30} extra seconds for a ₱20 coin
+    """
+    tables = {lane: [(int(sec), {})] * PRICING_BUCKETS for lane, sec in base_seconds.items()}
+    for index, rule in enumerate(rules or ()):
+        if not isinstance(rule, dict):
+            raise ValueError(f"rule {index}: expected an object")
+        try:
+            lanes = rule.get("lanes", list(tables))
+            buckets = _rule_buckets(rule)
+            seconds = int(rule["seconds"]) if "seconds" in rule else None
+            multiplier = float(rule.get("multiplier", 1.0))
+            bonus = {int(k): int(v) for k, v in (rule.get("bonus") or {}).items()}
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"rule {index} ({rule.get('name', 'unnamed')}): {e}")
+        if seconds is not None and seconds <= 0 or multiplier <= 0:
+            raise ValueError(f"rule {index}: seconds and multiplier must be positive")
+
+        for lane in lanes:
+            if lane not in tables:
+                raise ValueError(f"rule {index}: unknown lane {lane!r}")
+            table = tables[lane]
+            for b in buckets:
+                rate, extra = table[b]
+                rate = round((seconds if seconds is not None else rate) * multiplier)
+                table[b] = (rate, {**extra, **bonus} if bonus else extra)
+    return tables
+
+
+def validate_pricing_rules(rules):
+    """Settings validator: raise ValueError unless `rules` compiles."""
+    if not isinstance(rules, list):
+        raise ValueError("pricing_rules: expected a list")
+    compile_pricing(rules, {lane: 60 for lane in PRICING_LANE_TIMERS})
+    return rules
+
+
+class PricingEngine:
+    """
+    Seconds of wash time for a coin. Rules from the `pricing_rules` setting
+    (happy hours, weekend rates, coin bonuses, per-lane overrides) are
+    compiled once into week tables, so pricing a coin is one bucket index
+    and one list lookup. `clock` returns epoch seconds and can be replaced by
+    a simulated clock.
+    """
+
+    def __init__(self, settings, clock=time.time):
+        self.settings = settings
+        self.clock = clock
+        self.tables = {}
+        self.compile()
+
+    def compile(self):
+        base = {lane: self.settings.get(key, 60) for lane, key in PRICING_LANE_TIMERS.items()}
+        try:
+            tables = compile_pricing(self.settings.get("pricing_rules") or [], base)
+        except ValueError as e:
+            safe_log("error", f"Pricing rules invalid, using flat rates: {e}")
+            tables = compile_pricing([], base)
+        self.tables = tables  # swapped in one assignment; readers never see a half-built table
+
+    def bucket(self, now=None):
+        t = time.localtime(self.clock() if now is None else now)
+        return (t.tm_wday * 24 * 60 + t.tm_hour * 60 + t.tm_min) // PRICING_BUCKET_MINUTES
+
+    def rate(self, lane_key, now=None):
+        """Seconds per ₱5 in effect for a lane."""
+        return self.tables[lane_key][self.bucket(now)][0]
+
+    def seconds_for(self, lane_key, coin_value, now=None):
+        rate, bonus = self.tables[lane_key][self.bucket(now)]
+        return rate * (coin_value // 5) + bonus.get(coin_value, 0)
+
+
+# --------------------------
+# Lane Checkpoint
+# --------------------------
+class LaneCheckpoint:
+    """
+    Lane sessions (remaining seconds, credit, running) in a small memory-mapped
+    file so paid time survives a brownout or a crash. Two copies alternate,
+    each in its own page with a sequence number and CRC: a torn write spoils
+    only the copy being written and `load()` falls back to the other one.
+    `save()` writes (and syncs) one page, and only when a lane changed.
+    """
+
+    _HEADER = struct.Struct("<4sQI")   # magic, sequence, crc32 of the body
+    _LANE = struct.Struct("<1siiB")    # lane key, remaining, coins, running
+
+    def __init__(self, path=CHECKPOINT_FILE, sync=True, meter=None):
+        self.path = path
+        self.sync = sync
+        self.meter = meter  # local_store.WearMeter: one page per checkpoint
+        self.seq = 0
+        self.writes = 0
+        self._last_body = None
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < 2 * CHECKPOINT_SLOT:
+            os.ftruncate(self._fd, 2 * CHECKPOINT_SLOT)
+        self.map = mmap.mmap(self._fd, 2 * CHECKPOINT_SLOT)
+
+    def _read_slot(self, offset):
+        magic, seq, crc = self._HEADER.unpack_from(self.map, offset)
+        if magic != CHECKPOINT_MAGIC:
+            return None
+        start = offset + self._HEADER.size
+        (count,) = struct.unpack_from("<B", self.map, start)
+        body = self.map[start:start + 1 + count * self._LANE.size]
+        if zlib.crc32(body) != crc:
+            return None
+        lanes = {}
+        for i in range(count):
+            key, remaining, coins, running = self._LANE.unpack_from(body, 1 + i * self._LANE.size)
+            lanes[key.decode()] = (remaining, coins, bool(running))
+        return seq, lanes
+
+    def load(self):
+        """Newest intact checkpoint as {lane_key: (remaining, coins, running)}; {} if there is none."""
+        with self._lock:
+            slots = [s for s in (self._read_slot(0), self._read_slot(CHECKPOINT_SLOT)) if s]
+            if not slots:
+                return {}
+            self.seq, lanes = max(slots, key=lambda s: s[0])
+            return lanes
+
+    def save(self, lanes):
+        """Checkpoint `lanes` ({lane_key: LaneState}). Returns False if nothing changed."""
+        body = struct.pack("<B", len(lanes)) + b"".join(
+            self._LANE.pack(key.encode(), max(0, lane.remaining), lane.coins, lane.running)
+            for key, lane in lanes.items()
+        )
+        with self._lock:
+            if body == self._last_body:
+                return False
+            self.seq += 1
+            offset = (self.seq & 1) * CHECKPOINT_SLOT
+            start = offset + self._HEADER.size
+            self.map[start:start + len(body)] = body
+            self._HEADER.pack_into(self.map, offset, CHECKPOINT_MAGIC, self.seq, zlib.crc32(body))
+            if self.sync:
+                self.map.flush(offset, CHECKPOINT_SLOT)
+            self._last_body = body
+            self.writes += 1
+        if self.meter is not None:
+            self.meter.add("checkpoint", CHECKPOINT_SLOT, synced=self.sync)
+        return True
+
+    def close(self):
+        with self._lock:
+            self.map.close()
+            os.close(self._fd)
+
+
+# --------------------------
+# Ledger
+# --------------------------
+class Ledger:
+    """
+    Lifetime coin totals per lane. Backed by the local SQLite store
+    (`local_store.LocalStore`); with `store=None` the totals live in memory
+    only (benchmarks, tests).
+    """
+
+    LANE_FIELDS = {"L": "water_coins", "R": "foaming_coins"}
+
+    def __init__(self, store=None):
+        self.store = store
+        self._memory = {}
+
+    def totals(self):
+        if self.store is None:
+            return dict(self._memory)
+        return self.store.totals()
+
+    def add(self, lane_key, amount, seconds=0):
+        field = self.LANE_FIELDS.get(lane_key)
+        if field is None:
+            return
+        if self.store is None:
+            self._memory[field] = self._memory.get(field, 0) + int(amount)
+            return
+        self.store.record_coin(lane_key, amount, seconds)
+
+
+# --------------------------
+# Vending Engine
+# --------------------------
+class VendingEngine:
+    """
+    Owns the lanes, coin crediting, relay control, the serial link and the
+    ledger. Nothing here touches Kivy; every state change is published on
+    `self.bus` (CoinAccepted, LaneStarted, LaneExpired, LaneStopped,
+    RelayConfirmed, SerialConnected, SerialLost) and the UI, sync worker and
+    metrics subscribe to what they need.
+
+    Events are published on the thread that caused them: serial frames on the
+    service loop, `tick()` wherever it is called from. Use DELIVER_UI or
+    DELIVER_ASYNC to be called somewhere else.
+    """
+
+    def __init__(self, settings, core=None, ledger=None, transport=None, clock=time.time, checkpoint=None):
+        self.settings = settings
+        self.pricing = PricingEngine(settings, clock=clock)
+        self.core = core
+        self.ledger = ledger if ledger is not None else Ledger()
+        # transport(cmd) replaces the serial link (benchmarks / simulations)
+        self.transport = transport
+        self.lanes = {"L": LaneState("L"), "R": LaneState("R")}
+        self.left_lane = self.lanes["L"]
+        self.right_lane = self.lanes["R"]
+        self.last_interacted_lane = "L"
+        self.bus = EventBus(core)
+        self.relay_latency = LatencyHistogram()
+        self.bus.subscribe(RelayConfirmed, lambda ev: self.relay_latency.record(ev.latency))
+
+        self.serial_link = SerialLink(
+            self.process_serial_message,
+            on_connected=self._on_serial_connected,
+            on_lost=self._on_serial_lost,
+        )
+        self.relays = RelayCommander(
+            self.send_command, self.is_serial_link_up,
+            on_confirmed=lambda lane_key, on, rtt: self.bus.publish(RelayConfirmed(lane_key, on, rtt)),
+        )
+        # checkpoint: LaneCheckpoint that keeps paid time across crashes and power loss
+        self.checkpoint = checkpoint
+        if checkpoint is not None:
+            self.restore_sessions()
+
+    # --------------------------
+    # Lifecycle
+    # --------------------------
+    def start(self):
+        if self.core is None or self.transport is not None:
+            return
+        # ✅ Hotplug-driven — reconnects as soon as the Arduino (re)appears
+        self.serial_link.start(self.core)
+        self.core.every("relay-acks", RELAY_ACK_TIMEOUT / 2, self.relays.check_timeouts, blocking=False)
+        self.core.every("relay-latency-log", 600, self.log_relay_latency, blocking=False)
+        if self.checkpoint is not None:
+            self.core.every("lane-checkpoint", CHECKPOINT_INTERVAL, self.save_checkpoint)
+
+    def stop(self):
+        self.log_relay_latency()
+        if self.core is not None:
+            self.core.call_soon(self.serial_link.stop)
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        try:
+            self.checkpoint.save(self.lanes)
+        except (OSError, ValueError) as e:
+            safe_log("warning", f"Lane checkpoint failed: {e}")
+
+    def restore_sessions(self):
+        """
+        Startup after a crash or power loss: every relay OFF (its state is
+        unknown), and paid-but-unused time back on its lane, paused until the
+        customer presses Start again.
+        """
+        for lane_key in self.lanes:
+            self.relays.set_relay(lane_key, False)
+        try:
+            saved = self.checkpoint.load()
+        except (OSError, ValueError) as e:
+            safe_log("warning", f"Lane checkpoint unreadable: {e}")
+            return
+        for lane_key, (remaining, coins, running) in saved.items():
+            lane = self.lanes.get(lane_key)
+            if lane is None or remaining <= 0 or coins <= 0:
+                continue
+            lane.remaining = remaining
+            lane.coins = coins
+            lane.running = False
+            safe_log("info", f"♻️ Lane {lane_key} session restored: {remaining}s / ₱{coins} "
+                             f"({'was running' if running else 'not started'}) — press Start to resume")
+
+    def lane(self, lane_key):
+        return self.left_lane if lane_key == "L" else self.right_lane
+
+    def is_idle(self):
+        """No lane running, holding credit or waiting for a coin (safe to change prices)."""
+        return not any(
+            lane.running or lane.coins > 0 or lane.accepting_coins
+            for lane in self.lanes.values()
+        )
+
+    # --------------------------
+    # Serial
+    # --------------------------
+    @property
+    def simulation(self):
+        return self.transport is None and self.serial_link.state == SerialLink.SIMULATION
+
+    def is_serial_link_up(self):
+        return self.transport is not None or self.serial_link.connected
+
+    def connect_serial(self):
+        """Try to connect to Arduino now (normally the hotplug watcher does this)."""
+        if self.core is not None:
+            self.core.call_soon(self.serial_link.connect, "manual")
+
+    def send_command(self, cmd):
+        """Queue a command for the Arduino (safe from any thread; written on the service loop)."""
+        if self.transport is not None:
+            self.transport(cmd)
+            return
+        if self.simulation:
+            safe_log("info", f"[SIM] TX: {cmd}")
+            return
+        if self.core is not None:
+            self.core.call_soon(self.serial_link.write, cmd)
+
+    def _on_serial_connected(self, path):
+        # Re-assert expected relay states — the board resets on port open
+        self.relays.reconcile()
+        for lane in self.lanes.values():
+            lane.reset_coin_seqs()
+        self.bus.publish(SerialConnected(path))
+
+    def _on_serial_lost(self, reason):
+        safe_log("warning", f"Arduino disconnected ({reason}) — waiting for hotplug event")
+        self.bus.publish(SerialLost(reason))
+
+    def log_relay_latency(self):
+        if self.relay_latency.total:
+            safe_log("info", f"Relay ACK latency: {self.relay_latency.summary()}")
+
+    # --------------------------
+    # Coins
+    # --------------------------
+    def get_timer_for_lane(self, lane_key):
+        """Seconds per ₱5 for a lane right now (pricing rules applied)."""
+        return self.pricing.rate(lane_key)
+
+    def process_serial_message(self, message):
+        """Handle one frame from the Arduino (ACKs and coins)."""
+        if not message:
+            return
+
+        if message.startswith("ACK"):
+            self.relays.handle_ack(message)
+            return
+
+        parts = message.split(":")
+        if parts[0] == "COIN":
+            coin_value, target, seq = self.parse_coin_frame(parts)
+            lane = self.lane(target)
+
+            # Seconds per ₱5 and coin bonus from the compiled pricing table
+            seconds_per_coin = self.get_timer_for_lane(target)
+            time_added = self.pricing.seconds_for(target, coin_value)
+
+            result = lane.credit_coin(coin_value, time_added, seq)
+            if result == "duplicate":
+                safe_log("info", f"Duplicate coin frame ignored: {message}")
+                return
+            if result == "rejected":
+                safe_log("info", f"⚠️ Coin ignored — lane {target} not waiting for coin")
+                return
+
+            safe_log("info",
+                     f"💰 Coin inserted lane {target} +₱{coin_value} / +{time_added}s "
+                     f"(rate={seconds_per_coin}s per ₱5)"
+                     )
+
+            self.ledger.add(target, coin_value, time_added)
+            self.bus.publish(CoinAccepted(target, coin_value, time_added))
+
+    def parse_coin_frame(self, parts):
+        """
+        Split a `COIN:<value>[:<acceptor>[:<seq>]]` frame into (value, lane_key, seq).
+        Old firmware only sends `COIN:<value>`; those coins go to the last touched lane.
+        """
+        try:
+            coin_value = int(parts[1]) if len(parts) > 1 else 5
+        except ValueError:
+            coin_value = 5
+
+        target = None
+        if len(parts) > 2:
+            target = COIN_ACCEPTOR_LANES.get(parts[2].strip().upper())
+        if target is None:
+            target = self.last_interacted_lane
+
+        seq = parts[3].strip() if len(parts) > 3 and parts[3].strip() else None
+        return coin_value, target, seq
+
+    def set_coin_input(self, lane_key, enabled, grace=True):
+        """Arm/disarm a lane's coin acceptor and tell the Arduino."""
+        lane = self.lane(lane_key)
+        if enabled:
+            lane.arm_coin()
+            self.send_command(f"ENABLE_COIN:{lane_key}")
+        else:
+            lane.disarm_coin(grace=grace)
+            self.send_command(f"DISABLE_COIN:{lane_key}")
+
+    # --------------------------
+    # Lanes
+    # --------------------------
+    def request(self, lane_key, action):
+        """INSERT_COIN / START from the lane buttons."""
+        self.last_interacted_lane = lane_key
+        if action == "INSERT_COIN":
+            self.set_coin_input(lane_key, True)  # ✅ allow physical coin entry
+            safe_log("info", f"Insert Coin pressed for lane {lane_key} → waiting for coin...")
+        elif action == "START":
+            self.start_lane(lane_key)
+
+    def start_lane(self, lane_key):
+        """Start the lane timer and relay. Returns False if there is no credit or it already runs."""
+        lane = self.lane(lane_key)
+        if lane.coins > 0 and not lane.running:
+            lane.running = True
+            self.relays.set_relay(lane_key, True)
+            safe_log("info", f"Lane {lane_key} started → timer + relay ON.")
+            self.bus.publish(LaneStarted(lane_key))
+            return True
+        safe_log("info", f"Lane {lane_key}: no credit or already running.")
+        return False
+
+    def _clear_lane(self, lane_key):
+        lane = self.lane(lane_key)
+        self.relays.set_relay(lane_key, False)
+        lane.running = False
+        lane.remaining = 0
+        lane.coins = 0  # ✅ reset all inserted coins
+        lane.disarm_coin(grace=False)
+
+    def stop_lane(self, lane_key):
+        """Stop a lane immediately: relay off, time and coins cleared."""
+        lane = self.lane(lane_key)
+        if lane.running or lane.remaining > 0 or lane.coins > 0:
+            self._clear_lane(lane_key)
+            safe_log("info", f"Lane {lane_key} stopped manually — time and coins cleared.")
+            self.bus.publish(LaneStopped(lane_key))
+            return True
+        safe_log("info", f"Stop command ignored for {lane_key} (not running or no coins).")
+        return False
+
+    def tick(self):
+        """Advance every lane by one second. Returns the keys of lanes that just finished."""
+        finished = []
+        for lane_key, lane in self.lanes.items():
+            if lane.tick() or (lane.running and lane.remaining <= 0):
+                self._clear_lane(lane_key)
+                safe_log("info", f"Lane {lane_key} finished → relay OFF, credit cleared")
+                finished.append(lane_key)
+                self.bus.publish(LaneExpired(lane_key))
+        return finished
+
+
+# --------------------------
+# Benchmark
+# --------------------------
+def run_benchmark(events=100000, seed=1):
+    """
+    Drive coin, relay-ACK and tick paths headlessly and report events/second.
+    Uses an in-memory ledger and a no-op transport, so it measures the engine
+    itself rather than disk or serial I/O.
+    """
+    import random
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rng = random.Random(seed)
+    sent = []
+    engine = VendingEngine({"water_timer": 1, "foaming_timer": 1}, transport=sent.append)
+    for lane_key in engine.lanes:
+        engine.set_coin_input(lane_key, True)
+    # Next customer arrives as soon as a lane frees up
+    engine.bus.subscribe(LaneExpired, lambda ev: engine.set_coin_input(ev.lane_key, True))
+    engine.bus.subscribe(LaneStopped, lambda ev: engine.set_coin_input(ev.lane_key, True))
+
+    seq = 0
+    start = time.perf_counter()
+    for i in range(events):
+        lane_key = "L" if i & 1 else "R"
+        roll = rng.random()
+        if roll < 0.3:
+            seq += 1
+            engine.process_serial_message(f"COIN:5:{lane_key}:{seq}")
+        elif roll < 0.5:
+            if not engine.lane(lane_key).running:
+                engine.start_lane(lane_key)
+            if sent:
+                engine.process_serial_message(f"ACK:{sent[-1]}")
+        else:
+            engine.tick()
+    elapsed = time.perf_counter() - start
+
+    rate = events / elapsed if elapsed else float("inf")
+    print(f"{events} events in {elapsed:.3f}s → {rate:,.0f} events/s "
+          f"(relay ACK latency {engine.relay_latency.summary()})")
+    return rate
+
+
+def run_crash_child(path, seed):
+    """Crash-test worker: random lane traffic, printing every checkpoint it completes."""
+    import random
+
+    logging.getLogger().setLevel(logging.ERROR)
+    rng = random.Random(seed)
+    checkpoint = LaneCheckpoint(path)
+    engine = VendingEngine({"water_timer": 60, "foaming_timer": 60}, transport=lambda cmd: None,
+                           checkpoint=checkpoint)
+    seq = 0
+    while True:
+        lane_key = rng.choice("LR")
+        roll = rng.random()
+        if roll < 0.3:
+            seq += 1
+            engine.set_coin_input(lane_key, True)
+            engine.process_serial_message(f"COIN:{rng.choice((5, 10, 20))}:{lane_key}:{seq}")
+        elif roll < 0.45:
+            engine.start_lane(lane_key)
+        elif roll < 0.5:
+            engine.stop_lane(lane_key)
+        else:
+            engine.tick()
+        if checkpoint.save(engine.lanes):
+            state = {k: [lane.remaining, lane.coins, lane.running] for k, lane in engine.lanes.items()}
+            print(checkpoint.seq, json.dumps(state), flush=True)
+        time.sleep(rng.random() * 0.002)
+
+
+def run_crash_test(rounds=50, seed=1):
+    """
+    Kill a checkpointing engine with SIGKILL at random points, then check that
+    the restarted engine finds the last completed checkpoint (or the one that
+    was in flight), sends RELAY_OFF for every lane and restores paid time
+    paused. Every third round the newest copy is also scribbled over to check
+    the fallback to the older one.
+    """
+    import random
+    import signal
+    import subprocess
+    import sys
+    import tempfile
+
+    rng = random.Random(seed)
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in range(rounds):
+            path = os.path.join(tmp, f"lanes-{n}.bin")
+            child = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--crash-child", path, "--seed", str(n)],
+                stdout=subprocess.PIPE, text=True,
+            )
+            time.sleep(rng.uniform(0.05, 0.5))
+            child.send_signal(signal.SIGKILL)
+            out, _ = child.communicate()
+
+            written = {0: {}}
+            for line in out.splitlines():
+                seq, _, state = line.partition(" ")
+                try:
+                    written[int(seq)] = {k: tuple(v[:2]) + (bool(v[2]),) for k, v in json.loads(state).items()}
+                except ValueError:
+                    pass  # line cut by the kill
+            last = max(written)
+
+            checkpoint = LaneCheckpoint(path)
+            state, seq = checkpoint.load(), checkpoint.seq
+            problem = None
+            if seq not in (last, last + 1):
+                problem = f"restored checkpoint {seq}, last completed {last}"
+            elif seq == last and state != written[last]:
+                problem = f"checkpoint {seq} restored as {state}, written as {written[last]}"
+
+            if problem is None and seq and n % 3 == 0:
+                # Torn write: the newest copy must be rejected in favour of the older one
+                offset = (seq & 1) * CHECKPOINT_SLOT + LaneCheckpoint._HEADER.size + 2
+                checkpoint.map[offset] ^= 0xFF
+                state, older = checkpoint.load(), checkpoint.seq
+                expected = written.get(seq - 1)
+                if seq - 1 > 0 and older != seq - 1 or expected is not None and state != expected:
+                    problem = f"corrupt checkpoint {seq} restored {older} {state}, expected {expected}"
+
+            if problem is None:
+                sent = []
+                engine = VendingEngine({"water_timer": 60, "foaming_timer": 60}, transport=sent.append,
+                                       checkpoint=checkpoint)
+                if not {"RELAY_OFF:L", "RELAY_OFF:R"} <= set(sent):
+                    problem = f"startup sent {sent}, expected RELAY_OFF for every lane"
+                elif any(lane.running for lane in engine.lanes.values()):
+                    problem = "a lane was restored running"
+                else:
+                    for lane_key, (remaining, coins, _) in state.items():
+                        lane = engine.lane(lane_key)
+                        paid = remaining if remaining > 0 and coins > 0 else 0
+                        if lane.remaining != paid:
+                            problem = f"lane {lane_key} restored {lane.remaining}s, checkpoint had {remaining}s"
+            checkpoint.close()
+
+            if problem:
+                failures += 1
+                print(f"round {n}: FAIL — {problem}")
+        print(f"{rounds} random kills, {failures} failures")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless carwash vending engine")
+    parser.add_argument("--bench", type=int, metavar="EVENTS", help="run the headless engine benchmark")
+    parser.add_argument("--min-rate", type=float, default=10000, help="fail if events/s is below this")
+    parser.add_argument("--crash-test", type=int, metavar="ROUNDS", help="kill a checkpointing engine at random points")
+    parser.add_argument("--crash-child", metavar="FILE", help=argparse.SUPPRESS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--quote", nargs=2, metavar=("LANE", "COIN"), help="seconds a coin buys on a lane")
+    parser.add_argument("--at", help='simulated local time for --quote, "YYYY-MM-DD HH:MM"')
+    parser.add_argument("--settings", default="json_data/carwash_settings.json",
+                        help="settings JSON with timers and pricing_rules")
+    args = parser.parse_args()
+    if args.bench:
+        raise SystemExit(0 if run_benchmark(args.bench) >= args.min_rate else 1)
+    if args.crash_child:
+        run_crash_child(args.crash_child, args.seed)
+    if args.crash_test:
+        raise SystemExit(1 if run_crash_test(args.crash_test, args.seed) else 0)
+    if args.quote:
+        with open(args.settings, "r") as f:
+            settings = json.load(f)
+        at = time.mktime(time.strptime(args.at, "%Y-%m-%d %H:%M")) if args.at else time.time()
+        pricing = PricingEngine(settings, clock=lambda: at)
+        lane_key, coin = args.quote[0].upper(), int(args.quote[1])
+        print(f"{time.strftime('%a %Y-%m-%d %H:%M', time.localtime(at))} lane {lane_key} ₱{coin}: "
+              f"{pricing.seconds_for(lane_key, coin)}s (rate {pricing.rate(lane_key)}s per ₱5)")
+        raise SystemExit(0)
+    parser.print_help()